@@ -6,6 +6,8 @@ from django.contrib.auth.models import User
 from django.contrib.auth.admin import UserAdmin
 from django import forms
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
+from activity.models import (
+    QueryFingerprint, QueryFingerprintAdmin, SlowQuery, SlowQueryAdmin, Notification, NotificationAdmin)
 
 
 # use these form classes to enforce unique emails, if required
@@ -49,3 +51,7 @@ class MyUserAdmin(UserAdmin):
 # Re-register UserAdmin with custom options
 admin.site.unregister(User)
 admin.site.register(User, MyUserAdmin)
+
+admin.site.register(QueryFingerprint, QueryFingerprintAdmin)
+admin.site.register(SlowQuery, SlowQueryAdmin)
+admin.site.register(Notification, NotificationAdmin)
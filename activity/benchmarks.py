@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import statistics
+import time
+
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+
+from indicators.models import Indicator, CollectedData
+from workflow.models import Country, Program, ProjectAgreement, SiteProfile
+
+# name and url of the timed entry points, {program} is the benchmarked program
+BENCHMARKS = (
+    ('index', '/'),
+    ('tva_report', '/indicators/tvareport/'),
+    ('disaggregation_report', '/indicators/disrep/{program}/'),
+    ('default_custom_dashboard', '/customdashboard/{program}/'),
+    ('public_dashboard', '/customdashboard/program_dashboard/{program}/1/'),
+    ('feed_programs', '/api/programs/'),
+    ('feed_indicators', '/api/indicator/'),
+    ('feed_collecteddata', '/api/collecteddata/'),
+    ('feed_sites', '/api/siteprofile/'),
+    ('feed_agreements', '/api/initiations/'),
+    ('indicator_export', '/indicators/export/0/{program}/0/'),
+    ('collecteddata_export', '/indicators/collecteddata_report_data/{program}/0/0/export/'),
+    ('sites_export', '/workflow/export_sites_list/{program}/'),
+)
+
+# a slower median is only a regression past both the relative tolerance
+# and this many milliseconds, fast views jitter by more than 25%
+MIN_REGRESSION_MS = 5
+
+
+def get_benchmark_program(country_ids):
+    """
+    :return: the program with the most collected data in the countries
+    """
+    return Program.objects.filter(country__in=country_ids)\
+        .annotate(data_count=Count('i_program')).order_by('-data_count', 'id').first()
+
+
+def run_benchmark(client, url, repeat=5):
+    """
+    Request a url repeat times, the query count is the one of the last run,
+    the first runs warm the caches
+    :return: dict of status, queries, median_ms, min_ms and max_ms, or of
+        error when the view raised
+    """
+    timings = []
+    for i in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            try:
+                response = client.get(url)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+            except Exception as e:
+                return {'url': url, 'error': '%s: %s' % (e.__class__.__name__, e)}
+            timings.append((time.perf_counter() - started) * 1000)
+    return {
+        'url': url,
+        'status': response.status_code,
+        'queries': len(queries),
+        'bytes': len(response.content) if not response.streaming else None,
+        'median_ms': round(statistics.median(timings), 1),
+        'min_ms': round(min(timings), 1),
+        'max_ms': round(max(timings), 1),
+    }
+
+
+def get_dataset_counts():
+    """
+    Size of the database the results were measured on
+    """
+    return {
+        'countries': Country.objects.count(),
+        'sites': SiteProfile.objects.count(),
+        'programs': Program.objects.count(),
+        'agreements': ProjectAgreement.objects.count(),
+        'indicators': Indicator.objects.count(),
+        'collected_data': CollectedData.objects.count(),
+    }
+
+
+def compare_results(baseline, results, tolerance=0.25):
+    """
+    :param baseline: dict of name to result of an earlier run
+    :param results: dict of name to result of this run
+    :param tolerance: slowdown of the median allowed, 0.25 for 25%
+    :return: list of regression messages
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None or 'error' in before:
+            continue
+        if 'error' in result:
+            regressions.append('%s: %s' % (name, result['error']))
+            continue
+        if result['status'] != before['status']:
+            regressions.append('%s: status %s, baseline %s' % (name, result['status'], before['status']))
+        if result['queries'] > before['queries']:
+            regressions.append('%s: %s queries, baseline %s' % (name, result['queries'], before['queries']))
+        slower = result['median_ms'] - before['median_ms']
+        if slower > MIN_REGRESSION_MS and result['median_ms'] > before['median_ms'] * (1 + tolerance):
+            regressions.append('%s: %sms median, baseline %sms' % (name, result['median_ms'], before['median_ms']))
+    return regressions
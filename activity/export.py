@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import csv
+from itertools import islice
+
+from django.db.models import QuerySet, prefetch_related_objects
+from django.http import StreamingHttpResponse
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+class Echo(object):
+    """
+    File-like object for csv.writer that hands each written row back
+    instead of buffering it
+    """
+
+    def write(self, value):
+        return value
+
+
+def export_rows(resource, queryset=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield the header and data rows of an import-export resource one at a time,
+    the same columns Resource.export() puts in its Dataset
+    :param resource: ModelResource instance
+    :param queryset: queryset or iterable of objects, defaults to the resource queryset
+    :param chunk_size: rows fetched from the database at a time
+    """
+    resource.before_export(queryset)
+    if queryset is None:
+        queryset = resource.get_queryset()
+
+    yield resource.get_export_headers()
+
+    if not isinstance(queryset, QuerySet):
+        for obj in queryset:
+            yield resource.export_resource(obj)
+        return
+
+    # iterator() skips prefetch_related, so run the prefetches per chunk
+    prefetch_lookups = queryset._prefetch_related_lookups
+    objects = queryset.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(objects, chunk_size))
+        if not chunk:
+            break
+        if prefetch_lookups:
+            prefetch_related_objects(chunk, *prefetch_lookups)
+        for obj in chunk:
+            yield resource.export_resource(obj)
+
+
+def export_csv_response(resource, queryset, filename, content_type='application/ms-excel'):
+    """
+    Stream a resource export as a CSV attachment, rows are written as the
+    queryset is read so memory does not grow with the row count
+    :param resource: ModelResource instance
+    :param queryset: queryset to export
+    :param filename: attachment file name
+    :param content_type: response content type
+    :return: StreamingHttpResponse
+    """
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse(
+        (writer.writerow(row) for row in export_rows(resource, queryset)),
+        content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
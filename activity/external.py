@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeouts in seconds of the requests to ActivityTables and
+# the external indicator services
+EXTERNAL_HTTP_TIMEOUT = getattr(settings, 'EXTERNAL_HTTP_TIMEOUT', (5, 30))
+# requests running at once when many urls are fetched together
+EXTERNAL_HTTP_WORKERS = getattr(settings, 'EXTERNAL_HTTP_WORKERS', 4)
+# a cached response is served without a request for EXTERNAL_CACHE_TTL
+# seconds, then revalidated with its ETag or Last-Modified date. The cached
+# responses were fetched with the site token, keep them out of MEDIA_ROOT
+EXTERNAL_CACHE_TTL = getattr(settings, 'EXTERNAL_CACHE_TTL', 300)
+EXTERNAL_CACHE_DIR = getattr(
+    settings, 'EXTERNAL_CACHE_DIR', os.path.join(settings.SITE_ROOT, 'cache', 'external'))
+EXTERNAL_CACHE_ENTRIES = getattr(settings, 'EXTERNAL_CACHE_ENTRIES', 256)
+# responses cached on disk are deleted EXTERNAL_CACHE_MAX_AGE seconds after
+# they were fetched, checked at most every EXTERNAL_PRUNE_SECONDS
+EXTERNAL_CACHE_MAX_AGE = getattr(settings, 'EXTERNAL_CACHE_MAX_AGE', 7 * 24 * 3600)
+EXTERNAL_PRUNE_SECONDS = 3600
+
+
+class CachedResponse(object):
+    """
+    Status, body and validators of a response, what the cache keeps of it
+    """
+
+    def __init__(self, url, status_code, content, etag=None, last_modified=None, fetched=None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched or time.time()
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 300
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def meta(self):
+        return {'url': self.url, 'status_code': self.status_code, 'etag': self.etag,
+                'last_modified': self.last_modified, 'fetched': self.fetched}
+
+
+class ExternalDataClient(object):
+    """
+    GET client of the external data sources: one pooled session with
+    timeouts, a response cache in memory and on disk revalidated with
+    conditional requests, and a bounded pool for fetching many urls
+    """
+
+    def __init__(self, timeout=EXTERNAL_HTTP_TIMEOUT, ttl=EXTERNAL_CACHE_TTL, cache_dir=EXTERNAL_CACHE_DIR,
+                 workers=EXTERNAL_HTTP_WORKERS, max_entries=EXTERNAL_CACHE_ENTRIES,
+                 max_age=EXTERNAL_CACHE_MAX_AGE):
+        self.timeout = timeout
+        self.max_age = max_age
+        self.pruned = 0
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.workers = max(workers, 1)
+        self.max_entries = max_entries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers, max_retries=1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cache_key(self, url, headers):
+        # the headers carry the token, two tokens never share a response
+        return hashlib.sha1(json.dumps([url, sorted((headers or {}).items())]).encode('utf-8')).hexdigest()
+
+    def cache_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def cache_get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry
+        if not self.cache_dir:
+            return None
+        path = self.cache_path(key)
+        try:
+            with open(path + '.json') as meta_file, open(path + '.body', 'rb') as body_file:
+                entry = CachedResponse(content=body_file.read(), **json.load(meta_file))
+        except (IOError, ValueError, TypeError):
+            return None
+        self.cache_memory(key, entry)
+        return entry
+
+    def cache_memory(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def cache_set(self, key, entry):
+        self.cache_memory(key, entry)
+        if not self.cache_dir:
+            return
+        if time.time() - self.pruned >= EXTERNAL_PRUNE_SECONDS:
+            self.prune()
+        path = self.cache_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # body then metadata, each replaced atomically, a reader never
+            # sees the metadata of a body that is not written yet
+            temp_path = '%s.%s.tmp' % (path, threading.get_ident())
+            with open(temp_path, 'wb') as body_file:
+                body_file.write(entry.content)
+            os.replace(temp_path, path + '.body')
+            with open(temp_path, 'w') as meta_file:
+                json.dump(entry.meta(), meta_file)
+            os.replace(temp_path, path + '.json')
+        except (IOError, OSError) as e:
+            logger.warning('could not cache %s on disk: %s', entry.url, e)
+
+    def prune(self, max_age=None):
+        """
+        Delete the responses cached on disk longer than max_age seconds
+        :return: number of files deleted
+        """
+        self.pruned = time.time()
+        cutoff = self.pruned - (self.max_age if max_age is None else max_age)
+        deleted = 0
+        if not self.cache_dir:
+            return deleted
+        for directory, subdirectories, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        deleted += 1
+                except OSError:
+                    continue
+        return deleted
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+    def get(self, url, headers=None, ttl=None, verify=True):
+        """
+        :param url: url to GET
+        :param headers: request headers, part of the cache key
+        :param ttl: seconds a cached response is served without a request,
+            0 revalidates it every time
+        :return: CachedResponse, the successful responses are cached
+        """
+        ttl = self.ttl if ttl is None else ttl
+        key = self.cache_key(url, headers)
+        cached = self.cache_get(key)
+        if cached is not None and time.time() - cached.fetched < ttl:
+            return cached
+
+        request_headers = dict(headers or {})
+        if cached is not None:
+            if cached.etag:
+                request_headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                request_headers['If-Modified-Since'] = cached.last_modified
+        response = self.session.get(url, headers=request_headers, timeout=self.timeout, verify=verify)
+
+        if response.status_code == 304 and cached is not None:
+            entry = CachedResponse(cached.url, cached.status_code, cached.content,
+                                   response.headers.get('ETag', cached.etag),
+                                   response.headers.get('Last-Modified', cached.last_modified))
+        else:
+            entry = CachedResponse(url, response.status_code, response.content,
+                                   response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            if not entry.ok:
+                return entry
+        self.cache_set(key, entry)
+        return entry
+
+    def get_json(self, url, **kwargs):
+        return self.get(url, **kwargs).json()
+
+    def get_many(self, urls, **kwargs):
+        """
+        GET urls in parallel, at most `workers` at a time
+        :return: list of CachedResponse in the order of the urls, None for
+            the ones that could not be fetched
+        """
+        def fetch(url):
+            try:
+                return self.get(url, **kwargs)
+            except requests.RequestException as e:
+                logger.warning('could not fetch %s: %s', url, e)
+                return None
+
+        urls = list(urls)
+        if len(urls) <= 1:
+            return [fetch(url) for url in urls]
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(urls))) as executor:
+            return list(executor.map(fetch, urls))
+
+
+external_data = ExternalDataClient()
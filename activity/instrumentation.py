@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+from bisect import bisect_left
+
+from django.conf import settings
+
+# upper bounds in milliseconds of the latency histogram buckets, the last
+# bucket holds everything slower
+LATENCY_BUCKETS = (5, 10, 25, 50, 75, 100, 150, 200, 300, 500, 750, 1000,
+                   1500, 2000, 3000, 5000, 7500, 10000, 20000, 30000, 60000)
+
+# with PERF_METRICS_DIR set each process writes its histograms to
+# metrics-<pid>.json there every PERF_METRICS_FLUSH_SECONDS, the report
+# merges the files of every process
+PERF_METRICS_DIR = getattr(settings, 'PERF_METRICS_DIR', None)
+PERF_METRICS_FLUSH_SECONDS = getattr(settings, 'PERF_METRICS_FLUSH_SECONDS', 60)
+
+# columns of the report a caller may sort by
+REPORT_COLUMNS = ('count', 'p50_ms', 'p95_ms', 'p99_ms', 'avg_ms', 'max_ms',
+                  'avg_sql_count', 'avg_sql_ms', 'avg_template_ms')
+
+# queries slower than SLOW_QUERY_MS are stored with their parameters and
+# stack, see activity.models.SlowQuery, capture is off when it is None
+SLOW_QUERY_MS = getattr(settings, 'SLOW_QUERY_MS', None)
+SLOW_QUERY_STACK_DEPTH = getattr(settings, 'SLOW_QUERY_STACK_DEPTH', 8)
+
+logger = logging.getLogger(__name__)
+
+_request_state = threading.local()
+
+
+class RequestTimer(object):
+    """
+    Wall clock, SQL and template render time of the request being served
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.slow_queries = []
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def start_request():
+    _request_state.timer = RequestTimer()
+    return _request_state.timer
+
+
+def end_request():
+    timer = getattr(_request_state, 'timer', None)
+    _request_state.timer = None
+    return timer
+
+
+def current_timer():
+    return getattr(_request_state, 'timer', None)
+
+
+def sql_timer(execute, sql, params, many, context):
+    """
+    connection.execute_wrapper counting the queries of the current request
+    """
+    timer = current_timer()
+    if timer is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - started
+        timer.sql_count += 1
+        timer.sql_time += duration
+        if SLOW_QUERY_MS is not None and duration * 1000 >= SLOW_QUERY_MS:
+            timer.slow_queries.append({
+                'sql': sql, 'params': repr(params)[:2000], 'duration_ms': duration * 1000,
+                'stack': format_stack(),
+            })
+
+
+# literals and the placeholders of an IN list vary between two runs of the
+# same statement
+_SQL_LITERALS = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+
+def normalize_sql(sql):
+    for pattern, replacement in _SQL_LITERALS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def fingerprint_sql(sql):
+    """
+    :return: tuple of (sha1 hex digest, normalized statement) grouping the
+        runs of a query whatever their parameters
+    """
+    normalized = normalize_sql(sql)
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest(), normalized
+
+
+def format_stack():
+    """
+    :return: the innermost SLOW_QUERY_STACK_DEPTH frames of the project code
+        running the query, Django and the libraries are left out
+    """
+    root = settings.SITE_ROOT + os.sep
+    frames = [frame for frame in traceback.extract_stack()[:-2]
+              if frame.filename.startswith(root) and frame.filename != __file__
+              and os.sep + 'site-packages' + os.sep not in frame.filename]
+    return ''.join('%s:%s in %s\n    %s\n' % (
+        os.path.relpath(frame.filename, root), frame.lineno, frame.name, frame.line)
+        for frame in frames[-SLOW_QUERY_STACK_DEPTH:])
+
+
+def instrument_template_render():
+    """
+    Time Template.render of the Django template backend, which render() and
+    TemplateResponse go through, included templates are part of their parent
+    """
+    from django.template.backends.django import Template
+    if getattr(Template.render, 'instrumented', False):
+        return
+    render = Template.render
+
+    def timed_render(self, context=None, request=None):
+        timer = current_timer()
+        if timer is None:
+            return render(self, context, request)
+        started = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            timer.template_time += time.perf_counter() - started
+
+    timed_render.instrumented = True
+    Template.render = timed_render
+
+
+class ViewStats(object):
+    """
+    Latency histogram and totals of a view
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.sql_count = 0
+        self.sql_ms = 0.0
+        self.template_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, total_ms, sql_count, sql_ms, template_ms):
+        self.count += 1
+        self.total_ms += total_ms
+        self.max_ms = max(self.max_ms, total_ms)
+        self.sql_count += sql_count
+        self.sql_ms += sql_ms
+        self.template_ms += template_ms
+        self.buckets[bisect_left(LATENCY_BUCKETS, total_ms)] += 1
+
+    def merge(self, data):
+        self.count += data['count']
+        self.total_ms += data['total_ms']
+        self.max_ms = max(self.max_ms, data['max_ms'])
+        self.sql_count += data['sql_count']
+        self.sql_ms += data['sql_ms']
+        self.template_ms += data['template_ms']
+        self.buckets = [a + b for a, b in zip(self.buckets, data['buckets'])]
+
+    def percentile(self, fraction):
+        """
+        :return: upper bound in ms of the bucket holding the percentile,
+            the slowest request for the last bucket
+        """
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self):
+        return {
+            'count': self.count, 'total_ms': self.total_ms, 'max_ms': self.max_ms,
+            'sql_count': self.sql_count, 'sql_ms': self.sql_ms, 'template_ms': self.template_ms,
+            'buckets': self.buckets,
+        }
+
+    def summary(self):
+        count = self.count or 1
+        return {
+            'count': self.count,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'avg_ms': round(self.total_ms / count, 1),
+            'max_ms': round(self.max_ms, 1),
+            'avg_sql_count': round(self.sql_count / float(count), 1),
+            'avg_sql_ms': round(self.sql_ms / count, 1),
+            'avg_template_ms': round(self.template_ms / count, 1),
+        }
+
+
+class MetricsRegistry(object):
+    """
+    Per view statistics of this process
+    """
+
+    def __init__(self, directory=PERF_METRICS_DIR):
+        self.directory = directory
+        self.views = {}
+        self.flushed = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, view_name, timer):
+        with self._lock:
+            stats = self.views.setdefault(view_name, ViewStats())
+            stats.add(timer.elapsed * 1000, timer.sql_count, timer.sql_time * 1000, timer.template_time * 1000)
+            flush = self.directory and time.time() - self.flushed >= PERF_METRICS_FLUSH_SECONDS
+            if flush:
+                # the other threads of the process skip this flush
+                self.flushed = time.time()
+        if flush:
+            self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            return dict((name, stats.to_dict()) for name, stats in self.views.items())
+
+    def flush(self):
+        """
+        Write the statistics of this process to its own file, replaced atomically
+        """
+        with self._lock:
+            self.flushed = time.time()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, 'metrics-%s.json' % os.getpid())
+        temp_path = '%s.%s.tmp' % (path, threading.get_ident())
+        with open(temp_path, 'w') as metrics_file:
+            json.dump(self.snapshot(), metrics_file)
+        os.replace(temp_path, path)
+
+    def reset(self):
+        with self._lock:
+            self.views = {}
+        if self.directory:
+            for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+                os.remove(path)
+
+    def collect(self):
+        """
+        :return: dict of view name to ViewStats merged over every process
+            that wrote to the metrics directory, or of this process only
+        """
+        snapshots = []
+        if self.directory:
+            self.flush()
+            for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+                try:
+                    with open(path) as metrics_file:
+                        snapshots.append(json.load(metrics_file))
+                except (IOError, ValueError):
+                    continue
+        else:
+            snapshots.append(self.snapshot())
+
+        views = {}
+        for snapshot in snapshots:
+            for name, data in snapshot.items():
+                views.setdefault(name, ViewStats()).merge(data)
+        return views
+
+    def report(self, order_by='p95_ms', limit=20):
+        """
+        :return: list of view summaries, slowest first
+        """
+        rows = []
+        for name, stats in self.collect().items():
+            row = stats.summary()
+            row['view'] = name
+            rows.append(row)
+        rows.sort(key=lambda row: row[order_by], reverse=True)
+        return rows[:limit] if limit else rows
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,337 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import random
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from formlibrary.models import Beneficiary
+from indicators.models import (
+    Indicator, IndicatorType, Level, PeriodicTarget, CollectedData, IndicatorRollup,
+    DisaggregationType, DisaggregationLabel, DisaggregationValue)
+from workflow.models import (
+    Country, Province, District, AdminLevelThree, Village, Office, Sector, ProfileType,
+    Program, SiteProfile, ProjectAgreement, ProjectComplete, ActivityUser)
+
+APPROVAL_STATUSES = ('approved', 'approved', 'in progress', 'awaiting approval', 'rejected', '')
+INDICATOR_TYPES = ('Outcome', 'Output', 'Impact')
+LEVELS = ('Goal', 'Outcome', 'Output', 'Activity')
+SEX_LABELS = ('Male', 'Female')
+
+
+class Command(BaseCommand):
+    help = """
+        Generate a synthetic tenant on the local database: countries with their admin level tree,
+        offices and sites, programs with agreements, tracking and beneficiaries, and monthly
+        indicators with periodic targets and disaggregated collected data. Every country is
+        given to the --username user so the benchmarks see the tenant.
+        usage: manage.py generate_tenant --countries 2 --programs 5 --indicators 20 --collected 1000
+        """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--countries', type=int, default=2)
+        parser.add_argument('--provinces', type=int, default=4, help='admin level 1 per country')
+        parser.add_argument('--districts', type=int, default=4, help='admin level 2 per province')
+        parser.add_argument('--admin3', type=int, default=3, help='admin level 3 per district')
+        parser.add_argument('--villages', type=int, default=3, help='admin level 4 per admin level 3')
+        parser.add_argument('--sites', type=int, default=100, help='sites per country')
+        parser.add_argument('--beneficiaries', type=int, default=10, help='beneficiaries per site')
+        parser.add_argument('--programs', type=int, default=5, help='programs per country')
+        parser.add_argument('--agreements', type=int, default=20, help='agreements per program')
+        parser.add_argument('--indicators', type=int, default=20, help='indicators per program')
+        parser.add_argument('--periods', type=int, default=12, help='monthly periodic targets per indicator')
+        parser.add_argument('--collected', type=int, default=1000, help='collected data per indicator')
+        parser.add_argument('--prefix', default='Synthetic', help='prefix of the generated names')
+        parser.add_argument('--username', default='benchmark',
+                            help='superuser given access to the generated countries')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch_size', type=int, default=2000)
+        parser.add_argument('--force', action='store_true',
+                            help='generate even when DEBUG is off, never run it on a production database')
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError('DEBUG is off, use --force to generate a tenant on this database')
+
+        started = time.time()
+        self.options = options
+        self.batch_size = options['batch_size']
+        self.random = random.Random(options['seed'])
+        self.counts = {}
+        self.now = timezone.now()
+        # tag of the run, the program ids (gaitid) are unique
+        self.tag = uuid.uuid4().hex[:8]
+
+        with transaction.atomic():
+            self.create_reference_data()
+            countries = self.create_countries()
+            programs = []
+            for country in countries:
+                sites = self.create_geography(country)
+                labels = self.create_disaggregation(country)
+                country_programs = self.create_programs(country)
+                self.create_beneficiaries(sites, country_programs)
+                for program in country_programs:
+                    agreements = self.create_agreements(program, sites)
+                    self.create_indicators(program, agreements, sites, labels)
+                programs.extend(country_programs)
+            self.create_user(countries)
+
+        rows = IndicatorRollup.objects.rebuild(program_id__in=[program.id for program in programs])
+        self.counts[IndicatorRollup._meta.label] = rows
+
+        for name, count in sorted(self.counts.items()):
+            self.stdout.write('%s: %s' % (name, count))
+        self.stdout.write(self.style.SUCCESS(
+            'tenant "%s" generated in %.1fs, programs %s' % (
+                options['prefix'], time.time() - started, ', '.join(str(program.id) for program in programs))))
+
+    def insert(self, model, objs):
+        """
+        bulk_create the rows and set their ids, read back in id order on the
+        backends that do not return them from a bulk insert
+        :return: list of the saved rows
+        """
+        objs = list(objs)
+        self.counts[model._meta.label] = self.counts.get(model._meta.label, 0) + len(objs)
+        batch_size = self.get_batch_size(model, objs)
+        if connection.features.can_return_ids_from_bulk_insert:
+            return model.objects.bulk_create(objs, batch_size=batch_size)
+        last_id = model.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+        model.objects.bulk_create(objs, batch_size=batch_size)
+        ids = model.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)
+        for obj, pk in zip(objs, ids):
+            obj.id = pk
+        return objs
+
+    def link(self, field, pairs):
+        """
+        Insert many to many rows
+        :param field: ManyToManyField descriptor of the source model, Program.country
+        :param pairs: iterable of (source id, target id)
+        """
+        through = field.through
+        source = field.field.m2m_field_name()
+        target = field.field.m2m_reverse_field_name()
+        rows = [through(**{'%s_id' % source: source_id, '%s_id' % target: target_id})
+                for source_id, target_id in pairs]
+        through.objects.bulk_create(rows, batch_size=self.get_batch_size(through, rows))
+
+    def get_batch_size(self, model, objs):
+        """
+        --batch_size within the limit of the backend, SQLite caps the number
+        of rows and parameters of a statement
+        """
+        return max(min(self.batch_size, connection.ops.bulk_batch_size(model._meta.concrete_fields, objs)), 1)
+
+    def create_reference_data(self):
+        self.sector = Sector.objects.get_or_create(sector='%s Sector' % self.options['prefix'])[0]
+        self.profile_type = ProfileType.objects.get_or_create(profile='%s Site' % self.options['prefix'])[0]
+        self.indicator_types = [IndicatorType.objects.get_or_create(indicator_type=name)[0]
+                                for name in INDICATOR_TYPES]
+        self.levels = []
+        for name in LEVELS:
+            level = Level.objects.filter(name=name).first()
+            if level is None:
+                level = Level(name=name)
+                level.save()
+            self.levels.append(level)
+
+    def create_countries(self):
+        prefix = self.options['prefix']
+        return self.insert(Country, [
+            Country(country='%s Country %s' % (prefix, i + 1), code='S%s' % (i + 1),
+                    create_date=self.now, edit_date=self.now)
+            for i in range(self.options['countries'])])
+
+    def create_geography(self, country):
+        """
+        Admin level tree, an office per province and the sites of a country
+        :return: list of SiteProfile
+        """
+        options = self.options
+        provinces = self.insert(Province, [
+            Province(name='%s P%s' % (country.country, i + 1), country=country,
+                     create_date=self.now, edit_date=self.now)
+            for i in range(options['provinces'])])
+        offices = self.insert(Office, [
+            Office(name='%s Office' % province.name, code='O%s' % province.id, province=province,
+                   create_date=self.now, edit_date=self.now)
+            for province in provinces])
+        districts = self.insert(District, [
+            District(name='%s D%s' % (province.name, i + 1), province=province,
+                     create_date=self.now, edit_date=self.now)
+            for province in provinces for i in range(options['districts'])])
+        admin3 = self.insert(AdminLevelThree, [
+            AdminLevelThree(name='%s A%s' % (district.name, i + 1), district=district,
+                            create_date=self.now, edit_date=self.now)
+            for district in districts for i in range(options['admin3'])])
+        self.insert(Village, [
+            Village(name='%s V%s' % (level.name, i + 1), district_id=level.district_id, admin_3=level,
+                    create_date=self.now, edit_date=self.now)
+            for level in admin3 for i in range(options['villages'])])
+
+        province_offices = dict((office.province_id, office) for office in offices)
+        district_provinces = dict((district.id, district.province_id) for district in districts)
+        sites = []
+        for i in range(options['sites']):
+            level = self.random.choice(admin3)
+            province_id = district_provinces[level.district_id]
+            sites.append(SiteProfile(
+                name='%s Site %s' % (country.country, i + 1), type=self.profile_type, country=country,
+                office=province_offices[province_id], province_id=province_id, district_id=level.district_id,
+                admin_level_three=level, latitude=Decimal(self.random.uniform(-30, 30)).quantize(Decimal('0.0001')),
+                longitude=Decimal(self.random.uniform(-30, 30)).quantize(Decimal('0.0001')),
+                approval=self.random.choice(APPROVAL_STATUSES), create_date=self.now, edit_date=self.now))
+        self.offices = offices
+        return self.insert(SiteProfile, sites)
+
+    def create_programs(self, country):
+        prefix = self.options['prefix']
+        programs = self.insert(Program, [
+            Program(gaitid='%s-%s-%s-%s' % (prefix, self.tag, country.id, i + 1),
+                    name='%s Program %s' % (country.country, i + 1), funding_status='Funded',
+                    public_dashboard=True, create_date=self.now, edit_date=self.now)
+            for i in range(self.options['programs'])])
+        self.link(Program.country, [(program.id, country.id) for program in programs])
+        self.link(Program.sector, [(program.id, self.sector.id) for program in programs])
+        return programs
+
+    def create_beneficiaries(self, sites, programs):
+        beneficiaries = self.insert(Beneficiary, [
+            Beneficiary(beneficiary_name='%s %s' % (site.name, i + 1), age=self.random.randint(1, 90),
+                        gender=self.random.choice(SEX_LABELS), site=site,
+                        create_date=self.now, edit_date=self.now)
+            for site in sites for i in range(self.options['beneficiaries'])])
+        self.link(Beneficiary.program, [
+            (beneficiary.id, self.random.choice(programs).id) for beneficiary in beneficiaries])
+
+    def create_agreements(self, program, sites):
+        """
+        Agreements of a program in every approval status, the approved ones
+        are tracked with an actual budget
+        :return: list of ProjectAgreement
+        """
+        agreements = []
+        for i in range(self.options['agreements']):
+            budget = Decimal(self.random.randint(1000, 500000))
+            start = self.now - timedelta(days=self.random.randint(0, 720))
+            agreements.append(ProjectAgreement(
+                program=program, project_name='%s Project %s' % (program.name, i + 1),
+                office=self.random.choice(self.offices), sector=self.sector,
+                approval=self.random.choice(APPROVAL_STATUSES), total_estimated_budget=budget,
+                mc_estimated_budget=budget / 2, local_total_estimated_budget=budget,
+                local_mc_estimated_budget=budget / 2, expected_start_date=start,
+                expected_end_date=start + timedelta(days=365), create_date=self.now, edit_date=self.now))
+        agreements = self.insert(ProjectAgreement, agreements)
+        self.link(ProjectAgreement.site, [
+            (agreement.id, site.id)
+            for agreement in agreements for site in self.random.sample(sites, min(2, len(sites)))])
+
+        self.insert(ProjectComplete, [
+            ProjectComplete(
+                program=program, project_agreement=agreement, project_name=agreement.project_name,
+                office=agreement.office, sector=self.sector, approval=agreement.approval,
+                on_time=self.random.random() > 0.3, community_handover=False,
+                estimated_budget=agreement.total_estimated_budget,
+                actual_budget=(agreement.total_estimated_budget * Decimal(self.random.uniform(0.6, 1.2)))
+                .quantize(Decimal('0.01')),
+                total_cost=agreement.mc_estimated_budget, agency_cost=agreement.mc_estimated_budget,
+                expected_start_date=agreement.expected_start_date, expected_end_date=agreement.expected_end_date,
+                create_date=self.now, edit_date=self.now)
+            for agreement in agreements if agreement.approval == 'approved'])
+        return agreements
+
+    def create_disaggregation(self, country):
+        """
+        :return: list of the DisaggregationLabel of the sex disaggregation of a country
+        """
+        sex = DisaggregationType.objects.create(
+            disaggregation_type='Sex', country=country, create_date=self.now, edit_date=self.now)
+        return self.insert(DisaggregationLabel, [
+            DisaggregationLabel(disaggregation_type=sex, label=label, customsort=i + 1,
+                                create_date=self.now, edit_date=self.now)
+            for i, label in enumerate(SEX_LABELS)])
+
+    def create_indicators(self, program, agreements, sites, labels):
+        """
+        Monthly indicators of a program with their periodic targets and the
+        collected data of every period, split by sex
+        """
+        options = self.options
+        start = date(self.now.year - 1, self.now.month, 1)
+        indicators = self.insert(Indicator, [
+            Indicator(name='%s Indicator %s' % (program.name, i + 1), number='%s.%s' % (program.id, i + 1),
+                      source='%s Survey' % self.random.choice(INDICATOR_TYPES), unit_of_measure='people',
+                      baseline='0', lop_target=str(options['periods'] * 100), target_frequency=Indicator.MONTHLY,
+                      target_frequency_start=start, target_frequency_num_periods=options['periods'],
+                      sector=self.sector, key_performance_indicator=i % 5 == 0,
+                      create_date=self.now, edit_date=self.now)
+            for i in range(options['indicators'])])
+        self.link(Indicator.program, [(indicator.id, program.id) for indicator in indicators])
+        self.link(Indicator.indicator_type, [
+            (indicator.id, self.random.choice(self.indicator_types).id) for indicator in indicators])
+        self.link(Indicator.level, [(indicator.id, self.random.choice(self.levels).id) for indicator in indicators])
+        self.link(Indicator.disaggregation, [
+            (indicator.id, labels[0].disaggregation_type_id) for indicator in indicators])
+
+        targets = []
+        for indicator in indicators:
+            period_start = start
+            for i in range(options['periods']):
+                period_end = (period_start + timedelta(days=32)).replace(day=1)
+                targets.append(PeriodicTarget(
+                    indicator=indicator, period='%s %s' % (period_start.strftime('%b'), period_start.year),
+                    target=Decimal(100), start_date=period_start, end_date=period_end - timedelta(days=1),
+                    customsort=i, create_date=self.now, edit_date=self.now))
+                period_start = period_end
+        targets = self.insert(PeriodicTarget, targets)
+        indicator_targets = {}
+        for target in targets:
+            indicator_targets.setdefault(target.indicator_id, []).append(target)
+
+        collected = []
+        for indicator in indicators:
+            for i in range(options['collected']):
+                target = self.random.choice(indicator_targets[indicator.id])
+                collected_date = timezone.make_aware(datetime.combine(
+                    target.start_date + timedelta(days=self.random.randint(0, 27)), datetime.min.time()))
+                collected.append(CollectedData(
+                    indicator=indicator, program=program, periodic_target=target,
+                    achieved=Decimal(self.random.randint(0, 20)), date_collected=collected_date,
+                    agreement=self.random.choice(agreements) if agreements and self.random.random() < 0.5 else None,
+                    description='synthetic', create_date=self.now, edit_date=self.now))
+        collected = self.insert(CollectedData, collected)
+        self.link(CollectedData.site, [(data.id, self.random.choice(sites).id) for data in collected])
+
+        values = []
+        for data in collected:
+            male = self.random.randint(0, int(data.achieved))
+            values.append(DisaggregationValue(disaggregation_label=labels[0], value=str(male),
+                                              create_date=self.now, edit_date=self.now))
+            values.append(DisaggregationValue(disaggregation_label=labels[1], value=str(int(data.achieved) - male),
+                                              create_date=self.now, edit_date=self.now))
+        values = self.insert(DisaggregationValue, values)
+        self.link(CollectedData.disaggregation_value, [
+            (data.id, value.id) for data, pair in zip(collected, zip(values[::2], values[1::2])) for value in pair])
+
+    def create_user(self, countries):
+        user, created = User.objects.get_or_create(username=self.options['username'], defaults={
+            'email': '%s@example.com' % self.options['username'], 'is_staff': True, 'is_superuser': True})
+        if created:
+            user.set_unusable_password()
+            user.save()
+        activity_user = ActivityUser.objects.filter(user=user).first()
+        if activity_user is None:
+            activity_user = ActivityUser(user=user, name=user.username, country=countries[0], organization=None)
+            activity_user.save()
+        activity_user.countries.add(*countries)
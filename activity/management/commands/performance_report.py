@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from activity.instrumentation import metrics, PERF_METRICS_DIR, REPORT_COLUMNS
+
+
+class Command(BaseCommand):
+    help = """
+        Report the request latency percentiles, SQL and template time of the slowest views,
+        from the histograms the web processes write to PERF_METRICS_DIR.
+        usage: manage.py performance_report [--order p99_ms] [--limit 20] [--json] [--reset]
+        """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--order', default='p95_ms', choices=REPORT_COLUMNS)
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--json', action='store_true', help='print the report as JSON')
+        parser.add_argument('--reset', action='store_true', help='clear the collected histograms')
+
+    def handle(self, *args, **options):
+        if not PERF_METRICS_DIR:
+            raise CommandError('set PERF_METRICS_DIR so the web processes write their metrics')
+
+        if options['reset']:
+            metrics.reset()
+            self.stdout.write(self.style.SUCCESS('performance metrics cleared'))
+            return
+
+        rows = metrics.report(order_by=options['order'], limit=options['limit'])
+        if options['json']:
+            self.stdout.write(json.dumps(rows, indent=2))
+            return
+
+        self.stdout.write('%-60s %8s %8s %8s %8s %8s %6s %8s %8s' % (
+            'view', 'count', 'p50', 'p95', 'p99', 'max', 'sql', 'sql ms', 'tpl ms'))
+        for row in rows:
+            self.stdout.write('%-60s %8s %8s %8s %8s %8.0f %6.1f %8.1f %8.1f' % (
+                row['view'][:60], row['count'], row['p50_ms'], row['p95_ms'], row['p99_ms'], row['max_ms'],
+                row['avg_sql_count'], row['avg_sql_ms'], row['avg_template_ms']))
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from activity.benchmarks import (
+    BENCHMARKS, get_benchmark_program, run_benchmark, get_dataset_counts, compare_results)
+from activity.util import get_country_ids
+
+
+class Command(BaseCommand):
+    help = """
+        Time the main views and count their queries as the --username user, on the program with
+        the most collected data unless --program_id is given, see generate_tenant for a dataset.
+        The results are written as JSON; with --baseline a run that issues more queries or is
+        slower than the baseline by more than --tolerance fails.
+        usage: manage.py run_benchmarks --output baseline.json
+               manage.py run_benchmarks --baseline baseline.json --tolerance 0.25
+        """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--username', default='benchmark')
+        parser.add_argument('--program_id', type=int)
+        parser.add_argument('--repeat', type=int, default=5, help='requests per view')
+        parser.add_argument('--only', nargs='+', choices=[name for name, url in BENCHMARKS],
+                            help='benchmarks to run, all by default')
+        parser.add_argument('--output', help='file the JSON results are written to, stdout by default')
+        parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='slowdown of the median allowed over the baseline')
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['username']).first()
+        if user is None:
+            raise CommandError('user "%s" does not exist, see generate_tenant' % options['username'])
+        program_id = options['program_id']
+        if program_id is None:
+            program = get_benchmark_program(get_country_ids(user))
+            if program is None:
+                raise CommandError('%s has no program, see generate_tenant' % user)
+            program_id = program.id
+
+        # the test client needs testserver in ALLOWED_HOSTS, unless the
+        # command runs in a test already
+        try:
+            setup_test_environment()
+            teardown = True
+        except RuntimeError:
+            teardown = False
+        try:
+            client = Client()
+            client.force_login(user)
+            results = {}
+            for name, url in BENCHMARKS:
+                if options['only'] and name not in options['only']:
+                    continue
+                result = run_benchmark(client, url.format(program=program_id), max(options['repeat'], 1))
+                results[name] = result
+                if 'error' in result:
+                    self.stderr.write(self.style.ERROR('%s: %s' % (name, result['error'])))
+                else:
+                    self.stderr.write('%s: %sms, %s queries' % (name, result['median_ms'], result['queries']))
+        finally:
+            if teardown:
+                teardown_test_environment()
+
+        report = json.dumps({
+            'date': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'program': program_id,
+            'dataset': get_dataset_counts(),
+            'results': results,
+        }, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report + '\n')
+        else:
+            self.stdout.write(report)
+
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                regressions = compare_results(json.load(baseline)['results'], results, options['tolerance'])
+            if regressions:
+                raise CommandError('%s regressions over %s:\n%s' % (
+                    len(regressions), options['baseline'], '\n'.join(regressions)))
+            self.stderr.write(self.style.SUCCESS('no regression over %s' % options['baseline']))
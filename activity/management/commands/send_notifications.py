@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.core.management.base import BaseCommand
+from activity.models import Notification
+
+
+class Command(BaseCommand):
+    help = """
+        Send the queued approval emails, a batch at a time over a single SMTP connection.
+        Failed emails are retried with an exponential backoff, see activity.models.Notification.
+        usage: manage.py send_notifications [--batch_size 100] [--loop --interval 30]
+        """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size', type=int, default=100)
+        parser.add_argument('--loop', action='store_true',
+                            help='keep draining the outbox, waiting --interval seconds when it is empty')
+        parser.add_argument('--interval', type=int, default=30)
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+        while True:
+            sent, failed = Notification.objects.send_pending(batch_size=options['batch_size'])
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                self.stdout.write('%s sent, %s failed' % (sent, failed))
+            if sent + failed < options['batch_size']:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(
+            '%s notifications sent, %s to retry or failed' % (total_sent, total_failed)))
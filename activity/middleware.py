@@ -1,32 +1,57 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-import time
+import logging
+
+from django.db import connections
+
+from activity.instrumentation import (
+    start_request, end_request, sql_timer, instrument_template_render, metrics)
+from activity.models import QueryFingerprint
+
+logger = logging.getLogger(__name__)
 
 
 class TimingMiddleware(object):
     """
-    Appends the X-PROCESSING_TIME_MS header to all responses.
-    This value is the total time spent processing a user request in microseconds.
+    Times every request: wall clock, SQL query count and time, and template
+    render time. They are sent back in the X-PROCESSING_TIME_MS and
+    Server-Timing headers and added to the latency histogram of the view,
+    see activity.instrumentation and the performance_report command. With
+    SLOW_QUERY_MS set the slower queries are stored after the response is
+    built, see activity.models.SlowQuery.
     """
-    REQUEST_ATTR = '_timing_start'
     RESPONSE_HEADER = 'X-PROCESSING_TIME_MS'
 
     def __init__(self, get_response):
         self.get_response = get_response
         # One-time configuration and initialization.
+        instrument_template_render()
 
     def __call__(self, request):
-        # Code to be executed for each request before
-        # the view (and later middleware) are called.
-        setattr(request, self.REQUEST_ATTR, time.clock())
-
-        response = self.get_response(request)
-        # Code to be executed for each request/response after
-        # the view is called.
-        start = getattr(request, self.REQUEST_ATTR, None)
-        if start:
-            length = time.clock() - start
-            response[self.RESPONSE_HEADER] = "%i" % (length * 1000)
+        timer = start_request()
+        try:
+            with connections['default'].execute_wrapper(sql_timer):
+                response = self.get_response(request)
+        finally:
+            end_request()
 
+        elapsed = timer.elapsed
+        response[self.RESPONSE_HEADER] = "%i" % (elapsed * 1000)
+        response['Server-Timing'] = 'total;dur=%.1f, db;dur=%.1f;desc="%s queries", tpl;dur=%.1f' % (
+            elapsed * 1000, timer.sql_time * 1000, timer.sql_count, timer.template_time * 1000)
+        view_name = self.get_view_name(request)
+        try:
+            metrics.record(view_name, timer)
+        except Exception as e:
+            # the metrics file is not worth the response
+            logger.error('could not record the metrics of %s: %s', view_name, e)
+        if timer.slow_queries:
+            QueryFingerprint.objects.record(view_name, timer.slow_queries)
         return response
+
+    def get_view_name(self, request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return 'unresolved'
+        return match.view_name or match._func_path
@@ -0,0 +1,47 @@
+# Generated by Django 2.2 on 2026-10-17 19:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryFingerprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=40, unique=True)),
+                ('sql', models.TextField(verbose_name='Normalized SQL')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total_ms', models.FloatField(default=0, verbose_name='Total time (ms)')),
+                ('max_ms', models.FloatField(default=0, verbose_name='Slowest (ms)')),
+                ('last_seen', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'ordering': ('-total_ms',),
+            },
+        ),
+        migrations.CreateModel(
+            name='SlowQuery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('view', models.CharField(db_index=True, max_length=255)),
+                ('sql', models.TextField()),
+                ('params', models.TextField(blank=True)),
+                ('duration_ms', models.FloatField(verbose_name='Duration (ms)')),
+                ('stack', models.TextField(blank=True)),
+                ('create_date', models.DateTimeField()),
+                ('fingerprint', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='samples', to='activity.QueryFingerprint')),
+            ],
+            options={
+                'verbose_name_plural': 'Slow queries',
+                'ordering': ('-id',),
+            },
+        ),
+    ]
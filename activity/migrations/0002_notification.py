@@ -0,0 +1,38 @@
+# Generated by Django 2.2 on 2026-10-17 19:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0002_loggeduser_login_date'),
+        ('activity', '0001_slow_query'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(db_index=True, max_length=40)),
+                ('subject', models.CharField(max_length=255)),
+                ('message', models.TextField()),
+                ('country_ids', models.CharField(blank=True, max_length=255)),
+                ('submitter', models.CharField(blank=True, max_length=255)),
+                ('notify_admins', models.BooleanField(default=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField()),
+                ('last_error', models.TextField(blank=True)),
+                ('create_date', models.DateTimeField(auto_now_add=True)),
+                ('sent_date', models.DateTimeField(blank=True, null=True)),
+                ('approver', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='workflow.ActivityUser')),
+            ],
+            options={
+                'ordering': ('-id',),
+                'index_together': {('status', 'next_attempt')},
+            },
+        ),
+    ]
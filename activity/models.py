@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.mail import EmailMessage, get_connection, mail_admins
+from django.db import models, transaction, DatabaseError
+from django.db.models import F
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import format_html
+
+from activity.instrumentation import fingerprint_sql
+from workflow.models import ActivityUser
+
+logger = logging.getLogger(__name__)
+
+# number of SlowQuery samples kept, the oldest ones are deleted past it
+SLOW_QUERY_MAX_ROWS = getattr(settings, 'SLOW_QUERY_MAX_ROWS', 10000)
+
+NOTIFICATION_FROM_EMAIL = getattr(settings, 'NOTIFICATION_FROM_EMAIL', 'systems@mercycorps.org')
+# a failed notification is retried after NOTIFICATION_RETRY_SECONDS, the
+# delay doubles on each attempt up to NOTIFICATION_MAX_RETRY_SECONDS and
+# the notification is given up after NOTIFICATION_MAX_ATTEMPTS
+NOTIFICATION_RETRY_SECONDS = getattr(settings, 'NOTIFICATION_RETRY_SECONDS', 60)
+NOTIFICATION_MAX_RETRY_SECONDS = getattr(settings, 'NOTIFICATION_MAX_RETRY_SECONDS', 6 * 3600)
+NOTIFICATION_MAX_ATTEMPTS = getattr(settings, 'NOTIFICATION_MAX_ATTEMPTS', 8)
+
+
+class QueryFingerprintManager(models.Manager):
+
+    def record(self, view_name, slow_queries):
+        """
+        Store the slow queries of a request and add them to the totals of
+        their fingerprint, errors are logged so the response is not lost
+        :param view_name: view that ran the queries
+        :param slow_queries: list of dicts of sql, params, duration_ms and stack
+        """
+        try:
+            with transaction.atomic():
+                self._record(view_name, slow_queries)
+        except DatabaseError as e:
+            logger.error('could not store %s slow queries of %s: %s', len(slow_queries), view_name, e)
+
+    def _record(self, view_name, slow_queries):
+        now = timezone.now()
+        samples = []
+        for query in slow_queries:
+            digest, normalized = fingerprint_sql(query['sql'])
+            fingerprint, created = self.get_or_create(digest=digest, defaults={
+                'sql': normalized, 'count': 0, 'total_ms': 0, 'max_ms': 0, 'last_seen': now})
+            self.filter(pk=fingerprint.pk).update(
+                count=F('count') + 1, total_ms=F('total_ms') + query['duration_ms'], last_seen=now)
+            self.filter(pk=fingerprint.pk, max_ms__lt=query['duration_ms']).update(max_ms=query['duration_ms'])
+            samples.append(SlowQuery(
+                fingerprint=fingerprint, view=view_name[:255], sql=query['sql'], params=query['params'],
+                duration_ms=query['duration_ms'], stack=query['stack'], create_date=now))
+        SlowQuery.objects.bulk_create(samples)
+
+        # cap the table, the ids grow so everything below the cutoff is older
+        newest = SlowQuery.objects.order_by('-id').values_list('id', flat=True).first()
+        if newest and newest > SLOW_QUERY_MAX_ROWS:
+            SlowQuery.objects.filter(id__lte=newest - SLOW_QUERY_MAX_ROWS).delete()
+
+
+class QueryFingerprint(models.Model):
+    """
+    Slow runs of a statement whatever its parameters, see
+    activity.instrumentation.normalize_sql
+    """
+    digest = models.CharField(max_length=40, unique=True)
+    sql = models.TextField("Normalized SQL")
+    count = models.PositiveIntegerField(default=0)
+    total_ms = models.FloatField("Total time (ms)", default=0)
+    max_ms = models.FloatField("Slowest (ms)", default=0)
+    last_seen = models.DateTimeField(db_index=True)
+
+    objects = QueryFingerprintManager()
+
+    class Meta:
+        ordering = ('-total_ms',)
+
+    def __str__(self):
+        return self.sql[:100]
+
+    @property
+    def mean_ms(self):
+        return self.total_ms / self.count if self.count else 0
+
+
+class SlowQuery(models.Model):
+    """
+    Sample of a query slower than SLOW_QUERY_MS with the view and the
+    stack that ran it
+    """
+    fingerprint = models.ForeignKey(QueryFingerprint, related_name='samples', on_delete=models.CASCADE)
+    view = models.CharField(max_length=255, db_index=True)
+    sql = models.TextField()
+    params = models.TextField(blank=True)
+    duration_ms = models.FloatField("Duration (ms)")
+    stack = models.TextField(blank=True)
+    create_date = models.DateTimeField()
+
+    class Meta:
+        ordering = ('-id',)
+        verbose_name_plural = 'Slow queries'
+
+    def __str__(self):
+        return '%s %.0fms' % (self.view, self.duration_ms)
+
+
+class QueryFingerprintAdmin(admin.ModelAdmin):
+    list_display = ('short_sql', 'count', 'total_ms', 'mean', 'max_ms', 'last_seen', 'sample_list')
+    search_fields = ('sql',)
+    readonly_fields = ('digest', 'sql', 'count', 'total_ms', 'max_ms', 'last_seen')
+    ordering = ('-total_ms',)
+    display = 'Slow query fingerprints'
+
+    def short_sql(self, obj):
+        return obj.sql[:150]
+    short_sql.short_description = 'SQL'
+
+    def mean(self, obj):
+        return '%.1f' % obj.mean_ms
+    mean.short_description = 'Mean (ms)'
+
+    def sample_list(self, obj):
+        url = reverse('admin:activity_slowquery_changelist')
+        return format_html('<a href="{}?fingerprint__id__exact={}">samples</a>', url, obj.pk)
+    sample_list.short_description = 'Samples'
+
+    def has_add_permission(self, request):
+        return False
+
+
+class SlowQueryAdmin(admin.ModelAdmin):
+    list_display = ('view', 'duration_ms', 'create_date', 'fingerprint')
+    list_filter = ('view',)
+    search_fields = ('sql', 'view')
+    readonly_fields = ('fingerprint', 'view', 'sql', 'params', 'duration_ms', 'stack', 'create_date')
+    list_select_related = ('fingerprint',)
+    display = 'Slow queries'
+
+    def has_add_permission(self, request):
+        return False
+
+
+class NotificationManager(models.Manager):
+
+    def queue(self, subject, message, approver=None, country_ids=(), submitter=None, notify_admins=True):
+        """
+        Add an email to the outbox, the recipients are looked up when it is
+        sent by the send_notifications command. The same pending email is
+        only queued once
+        :param approver: ActivityUser emailed in each of the countries
+        :param country_ids: Country IDs of the program
+        :param submitter: email address copied
+        :return: Notification, None when it is already pending
+        """
+        country_ids = ','.join(str(pk) for pk in sorted(set(country_ids)))
+        key = hashlib.sha1('\n'.join([
+            subject, message, str(getattr(approver, 'pk', approver) or ''), country_ids, submitter or '',
+        ]).encode('utf-8')).hexdigest()
+        if self.filter(key=key, status=Notification.PENDING).exists():
+            return None
+        return self.create(
+            key=key, subject=subject, message=message, approver_id=getattr(approver, 'pk', approver),
+            country_ids=country_ids, submitter=submitter or '', notify_admins=notify_admins,
+            next_attempt=timezone.now())
+
+    def send_pending(self, batch_size=100, connection=None):
+        """
+        Send the pending notifications due now over a single SMTP connection,
+        the ones that fail are retried with an exponential backoff
+        :return: tuple of (sent count, failed count)
+        """
+        sent = failed = 0
+        with transaction.atomic():
+            # workers running side by side skip the rows another one holds
+            notifications = list(self.select_for_update(skip_locked=True)
+                                 .filter(status=Notification.PENDING, next_attempt__lte=timezone.now())
+                                 .order_by('next_attempt', 'id')[:batch_size])
+            if not notifications:
+                return sent, failed
+            connection = connection or get_connection()
+            try:
+                connection.open()
+            except Exception as e:
+                for notification in notifications:
+                    notification.retry(e)
+                return sent, len(notifications)
+            try:
+                for notification in notifications:
+                    try:
+                        notification.send(connection)
+                        sent += 1
+                    except Exception as e:
+                        notification.retry(e)
+                        failed += 1
+            finally:
+                connection.close()
+        return sent, failed
+
+
+class Notification(models.Model):
+    """
+    Outbox of the approval emails, the request only inserts a row
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+    key = models.CharField(max_length=40, db_index=True)
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    approver = models.ForeignKey(ActivityUser, null=True, blank=True, on_delete=models.SET_NULL)
+    country_ids = models.CharField(max_length=255, blank=True)
+    submitter = models.CharField(max_length=255, blank=True)
+    notify_admins = models.BooleanField(default=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField()
+    last_error = models.TextField(blank=True)
+    create_date = models.DateTimeField(auto_now_add=True)
+    sent_date = models.DateTimeField(null=True, blank=True)
+
+    objects = NotificationManager()
+
+    class Meta:
+        ordering = ('-id',)
+        index_together = (('status', 'next_attempt'),)
+
+    def __str__(self):
+        return self.subject
+
+    def get_recipients(self):
+        """
+        Emails of the approver's users in the program countries, once each,
+        and of the submitter
+        """
+        recipients = []
+        if self.approver_id and self.country_ids:
+            recipients = list(User.objects.filter(
+                activity_user=self.approver_id, activity_user__country__in=self.country_ids.split(','))
+                .exclude(email='').values_list('email', flat=True).distinct())
+        if self.submitter and self.submitter not in recipients:
+            recipients.append(self.submitter)
+        return recipients
+
+    def send(self, connection):
+        recipients = self.get_recipients()
+        if recipients:
+            EmailMessage(self.subject, self.message, NOTIFICATION_FROM_EMAIL, recipients,
+                         connection=connection).send()
+        if self.notify_admins:
+            mail_admins(self.subject, self.message, connection=connection)
+        self.status = Notification.SENT
+        self.attempts += 1
+        self.sent_date = timezone.now()
+        self.last_error = ''
+        self.save(update_fields=['status', 'attempts', 'sent_date', 'last_error'])
+
+    def retry(self, error):
+        self.attempts += 1
+        self.last_error = '%s: %s' % (error.__class__.__name__, error)
+        if self.attempts >= NOTIFICATION_MAX_ATTEMPTS:
+            self.status = Notification.FAILED
+            logger.error('notification %s failed %s times: %s', self.pk, self.attempts, self.last_error)
+        else:
+            delay = min(NOTIFICATION_RETRY_SECONDS * 2 ** (self.attempts - 1), NOTIFICATION_MAX_RETRY_SECONDS)
+            self.next_attempt = timezone.now() + timedelta(seconds=delay)
+        self.save(update_fields=['status', 'attempts', 'next_attempt', 'last_error'])
+
+
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'status', 'attempts', 'next_attempt', 'create_date', 'sent_date')
+    list_filter = ('status',)
+    search_fields = ('subject', 'submitter')
+    readonly_fields = ('key', 'create_date', 'sent_date', 'last_error')
+    display = 'Notifications'
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+from collections import OrderedDict
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import QuerySet
+from django.http import JsonResponse, StreamingHttpResponse
+from django.middleware.gzip import GZipMiddleware
+
+# ?v=2 returns the lists as JSON arrays, without it each list is sent as a
+# JSON encoded string inside the response like the original endpoints did
+JSON_VERSION_PARAM = 'v'
+JSON_VERSION = '2'
+JSON_CHUNK_SIZE = 500
+
+
+def wants_json_version(request, version=JSON_VERSION):
+    return request.GET.get(JSON_VERSION_PARAM) == version
+
+
+def iter_json_array(rows, encoder, chunk_size=JSON_CHUNK_SIZE):
+    """
+    Encode a list or values() queryset as a JSON array, a chunk of rows at a time
+    """
+    if isinstance(rows, QuerySet):
+        rows = rows.iterator(chunk_size=chunk_size)
+    yield '['
+    separator = ''
+    chunk = []
+    for row in rows:
+        chunk.append(encoder.encode(row))
+        if len(chunk) >= chunk_size:
+            yield separator + ', '.join(chunk)
+            separator = ', '
+            chunk = []
+    if chunk:
+        yield separator + ', '.join(chunk)
+    yield ']'
+
+
+def iter_json_object(lists, extra, encoder):
+    yield '{'
+    separator = ''
+    for key, rows in lists.items():
+        yield '%s%s: ' % (separator, encoder.encode(key))
+        for part in iter_json_array(rows, encoder):
+            yield part
+        separator = ', '
+    for key, value in extra.items():
+        yield '%s%s: %s' % (separator, encoder.encode(key), encoder.encode(value))
+        separator = ', '
+    yield '}'
+
+
+def streaming_json_response(request, content):
+    response = StreamingHttpResponse(content, content_type='application/json')
+    # compressed when the browser accepts it, without enabling gzip site wide
+    return GZipMiddleware().process_response(request, response)
+
+
+def json_list_response(request, rows):
+    """
+    Respond with a single list of rows
+    :param request: HttpRequest, ?v=2 streams a plain JSON array
+    :param rows: list or values() queryset
+    """
+    if not wants_json_version(request):
+        return JsonResponse(json.dumps(list(rows), cls=DjangoJSONEncoder), safe=False)
+    return streaming_json_response(request, iter_json_array(rows, DjangoJSONEncoder()))
+
+
+def json_lists_response(request, lists, extra=None):
+    """
+    Respond with an object holding one or more lists of rows
+    :param request: HttpRequest, ?v=2 streams the lists as JSON arrays
+    :param lists: OrderedDict of key to list or values() queryset
+    :param extra: dict of other keys, serialized as they are
+    """
+    extra = extra or {}
+    if not wants_json_version(request):
+        data = OrderedDict(
+            (key, json.dumps(list(rows), cls=DjangoJSONEncoder)) for key, rows in lists.items())
+        data.update(extra)
+        return JsonResponse(data, safe=False)
+    return streaming_json_response(request, iter_json_object(lists, extra, DjangoJSONEncoder()))
@@ -172,6 +172,8 @@ TEMPLATES = [
 # MIDDLEWARE CONFIGURATION
 # See: https://docs.djangoproject.com/en/dev/ref/settings/#middleware-classes
 MIDDLEWARE = (
+    # First so the timing covers the other middleware and their queries.
+    'activity.middleware.TimingMiddleware',
     # Default Django middleware.
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -182,7 +184,6 @@ MIDDLEWARE = (
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'simple_history.middleware.HistoryRequestMiddleware',
     'social_django.middleware.SocialAuthExceptionMiddleware',
-    'activity.middleware.TimingMiddleware'
     # 'debug_toolbar.middleware.DebugToolbarMiddleware',
 )
 # END MIDDLEWARE CONFIGURATION
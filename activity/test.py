@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db.models import Sum
+from django.template import engines
+from django.test import TestCase
+from django.utils import timezone
+
+from activity import instrumentation
+from activity.external import ExternalDataClient
+from activity.instrumentation import (
+    ViewStats, MetricsRegistry, RequestTimer, metrics, instrument_template_render, start_request, end_request,
+    fingerprint_sql)
+from activity.models import QueryFingerprint, SlowQuery, Notification
+from activity.util import email_group, get_tables, get_activity_tables_headers
+from indicators.models import CollectedData, IndicatorRollup, PeriodicTarget
+from workflow.models import Program, Country, ActivityUser
+
+
+class InstrumentationTestCase(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.user)
+
+    def test_view_stats_percentiles(self):
+        """Check percentiles are read from the histogram buckets"""
+        stats = ViewStats()
+        for total_ms in [3] * 90 + [120] * 9 + [45000]:
+            stats.add(total_ms, 2, 1, 0)
+        summary = stats.summary()
+        self.assertEqual((summary['p50_ms'], summary['p95_ms'], summary['p99_ms']), (5, 150, 150))
+        self.assertEqual(stats.percentile(1), 60000)
+        self.assertEqual(summary['avg_sql_count'], 2)
+
+    def test_template_timer(self):
+        """Check template rendering is added to the request timer"""
+        instrument_template_render()
+        timer = start_request()
+        try:
+            engines['django'].from_string('{{ value }}').render({'value': 1})
+        finally:
+            end_request()
+        self.assertGreater(timer.template_time, 0)
+
+    def test_performance_report(self):
+        """Check requests are timed per view and reported to staff only"""
+        response = self.client.get('/performance/')
+        self.assertIn('X-PROCESSING_TIME_MS', response)
+        self.assertIn('db;dur=', response['Server-Timing'])
+
+        response = self.client.get('/performance/?order=count')
+        views = dict((row['view'], row) for row in json.loads(response.content.decode('utf-8'))['views'])
+        self.assertEqual(views['performance_report']['count'], 1)
+        self.assertGreater(views['performance_report']['avg_sql_count'], 0)
+
+        self.client.logout()
+        self.assertEqual(self.client.get('/performance/').status_code, 302)
+
+    def test_concurrent_flush(self):
+        """Check threads flushing at once do not fail and a failing flush keeps the response"""
+        directory = tempfile.mkdtemp()
+        registry = MetricsRegistry(directory)
+        errors = []
+
+        def record():
+            try:
+                for i in range(50):
+                    registry.record('view', RequestTimer())
+            except Exception as e:
+                errors.append(e)
+
+        try:
+            with mock.patch('activity.instrumentation.PERF_METRICS_FLUSH_SECONDS', 0):
+                threads = [threading.Thread(target=record) for i in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(registry.collect()['view'].count, 400)
+        finally:
+            shutil.rmtree(directory)
+
+        with mock.patch.object(metrics, 'record', side_effect=OSError('disk full')), \
+                self.assertLogs('activity.middleware', 'ERROR'):
+            self.assertEqual(self.client.get('/performance/').status_code, 200)
+
+
+class SlowQueryTestCase(TestCase):
+
+    def test_fingerprint_sql(self):
+        """Check runs of a statement with other parameters share a fingerprint"""
+        first = fingerprint_sql("SELECT * FROM t WHERE id IN (%s, %s) AND name = 'a'")
+        second = fingerprint_sql("SELECT *  FROM t WHERE id IN (%s) AND name = 'b c'")
+        self.assertEqual(first, second)
+        self.assertEqual(first[1], 'SELECT * FROM t WHERE id IN (...) AND name = ?')
+
+    def test_slow_query_capture(self):
+        """Check the queries over the threshold are stored with their view and stack"""
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+        threshold = instrumentation.SLOW_QUERY_MS
+        instrumentation.SLOW_QUERY_MS = 0
+        try:
+            self.client.get('/performance/')
+            self.client.get('/performance/')
+        finally:
+            instrumentation.SLOW_QUERY_MS = threshold
+
+        samples = SlowQuery.objects.filter(view='performance_report')
+        self.assertTrue(samples.exists())
+        self.assertIn('activity/middleware.py:', samples[0].stack)
+        fingerprint = QueryFingerprint.objects.get(sql__contains='auth_user')
+        self.assertEqual(fingerprint.count, 2)
+        self.assertEqual(fingerprint.samples.count(), 2)
+
+
+class BenchmarkTestCase(TestCase):
+
+    def test_generate_tenant_and_benchmark(self):
+        """Check a small tenant is generated and benchmarked against a baseline"""
+        call_command('generate_tenant', countries=1, provinces=2, districts=2, admin3=1, villages=1, sites=5,
+                     beneficiaries=2, programs=2, agreements=3, indicators=2, periods=3, collected=10,
+                     force=True, stdout=StringIO())
+        program = Program.objects.get(name='Synthetic Country 1 Program 1')
+        self.assertEqual(CollectedData.objects.filter(program=program).count(), 20)
+        self.assertEqual(CollectedData.disaggregation_value.through.objects.filter(
+            collecteddata__program=program).count(), 40)
+        self.assertEqual(PeriodicTarget.objects.filter(indicator__program=program).count(), 6)
+        self.assertEqual(IndicatorRollup.objects.filter(program=program).aggregate(
+            total=Sum('data_count'))['total'], 20)
+
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'baseline.json')
+            call_command('run_benchmarks', only=['feed_programs', 'indicator_export'], repeat=1,
+                         output=output, stderr=StringIO())
+            with open(output) as baseline_file:
+                baseline = json.load(baseline_file)
+            self.assertEqual(set(baseline['results']), {'feed_programs', 'indicator_export'})
+            self.assertEqual(baseline['results']['feed_programs']['status'], 200)
+            self.assertEqual(baseline['dataset']['collected_data'], 40)
+
+            baseline['results']['indicator_export']['queries'] = 0
+            with open(output, 'w') as baseline_file:
+                json.dump(baseline, baseline_file)
+            with self.assertRaisesMessage(CommandError, 'indicator_export'):
+                call_command('run_benchmarks', only=['indicator_export'], repeat=1,
+                             baseline=output, stdout=StringIO(), stderr=StringIO())
+
+
+class FailingConnection(object):
+
+    def open(self):
+        raise IOError('relay down')
+
+    def close(self):
+        pass
+
+
+class NotificationTestCase(TestCase):
+
+    def setUp(self):
+        self.countries = [Country.objects.create(country='Country %s' % i) for i in range(2)]
+        user = User.objects.create_user('approver', 'approver@example.com', 'password')
+        self.approver = ActivityUser(user=user, name='approver', country=self.countries[0], organization=None)
+        self.approver.save()
+
+    def test_outbox(self):
+        """Check approval emails are queued once and sent once to each recipient"""
+        for i in range(2):
+            email_group(country=Country.objects.filter(id__in=[c.id for c in self.countries]),
+                        group=self.approver, link='Link: /workflow/projectagreement_detail/1/',
+                        subject='Project Initiation Approved', message='Approved\n',
+                        submiter='submitter@example.com')
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(Notification.objects.filter(status=Notification.PENDING).count(), 1)
+
+        call_command('send_notifications', stdout=StringIO())
+        self.assertEqual(mail.outbox[0].to, ['approver@example.com', 'submitter@example.com'])
+        self.assertEqual(mail.outbox[0].body, 'Approved\nLink: /workflow/projectagreement_detail/1/')
+        # the copy to the admins
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(Notification.objects.get().status, Notification.SENT)
+
+    def test_retry(self):
+        """Check a failing relay leaves the notification pending with a backoff"""
+        notification = Notification.objects.queue('Subject', 'Message', approver=self.approver,
+                                                  country_ids=[self.countries[0].id])
+        self.assertEqual(Notification.objects.send_pending(connection=FailingConnection()), (0, 1))
+        notification.refresh_from_db()
+        self.assertEqual((notification.status, notification.attempts), (Notification.PENDING, 1))
+        self.assertGreater(notification.next_attempt, timezone.now())
+        self.assertIn('relay down', notification.last_error)
+        # not due yet
+        self.assertEqual(Notification.objects.send_pending(), (0, 0))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Table API stub, its responses carry an ETag and honour If-None-Match
+    """
+    requests = []
+
+    def do_GET(self):
+        StubHandler.requests.append((self.path, self.headers.get('If-None-Match')))
+        body = json.dumps({'path': self.path, 'data_count': 3}).encode('utf-8')
+        etag = '"%s"' % self.path
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ExternalDataClientTestCase(TestCase):
+
+    def setUp(self):
+        StubHandler.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_cache(self):
+        """Check responses are served from memory, disk and revalidated with their ETag"""
+        client = ExternalDataClient(ttl=60, cache_dir=self.cache_dir)
+        self.assertEqual(client.get_json(self.url + '/table/1/')['path'], '/table/1/')
+        self.assertEqual(client.get_json(self.url + '/table/1/')['path'], '/table/1/')
+        self.assertEqual(len(StubHandler.requests), 1)
+
+        # a new process reads the disk cache
+        client = ExternalDataClient(ttl=60, cache_dir=self.cache_dir)
+        self.assertEqual(client.get_json(self.url + '/table/1/')['data_count'], 3)
+        self.assertEqual(len(StubHandler.requests), 1)
+
+        # past the ttl the server answers 304 Not Modified
+        self.assertEqual(client.get_json(self.url + '/table/1/', ttl=0)['data_count'], 3)
+        self.assertEqual(StubHandler.requests[-1], ('/table/1/', '"/table/1/"'))
+
+    def test_prune(self):
+        """Check the responses cached on disk are deleted once they are older than max_age"""
+        client = ExternalDataClient(ttl=60, cache_dir=self.cache_dir, max_age=3600)
+        client.get_json(self.url + '/table/1/')
+        client.get_json(self.url + '/table/2/')
+        self.assertEqual(client.prune(), 0)
+        for name in os.listdir(self.cache_dir):
+            for filename in os.listdir(os.path.join(self.cache_dir, name)):
+                if filename.startswith(client.cache_key(self.url + '/table/1/', None)):
+                    os.utime(os.path.join(self.cache_dir, name, filename), (0, 0))
+        self.assertEqual(client.prune(), 2)
+
+        # the pruned response is downloaded again by a new process
+        client = ExternalDataClient(ttl=60, cache_dir=self.cache_dir)
+        client.get_json(self.url + '/table/1/')
+        client.get_json(self.url + '/table/2/')
+        self.assertEqual(len(StubHandler.requests), 3)
+
+    def test_get_many(self):
+        """Check many urls are fetched in order and a failing one is None"""
+        client = ExternalDataClient(cache_dir=None, workers=3)
+        urls = [self.url + '/table/%s/' % i for i in range(6)] + ['http://127.0.0.1:1/']
+        with self.assertLogs('activity.external', 'WARNING'):
+            responses = client.get_many(urls)
+        self.assertEqual([response.json()['path'] for response in responses[:6]],
+                         ['/table/%s/' % i for i in range(6)])
+        self.assertIsNone(responses[6])
+
+    def test_tables_without_site(self):
+        """Check no tables is no query and a missing site sends no token"""
+        with self.assertNumQueries(0):
+            self.assertEqual(get_tables([]), [])
+        with self.assertLogs('activity.util', 'WARNING'):
+            self.assertEqual(get_activity_tables_headers(), {'content-type': 'application/json'})
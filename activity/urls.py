@@ -59,6 +59,7 @@ router.register(r'pindicators', PogramIndicatorReadOnlyViewSet,
                 basename='pindicators')
 router.register(r'periodictargets', PeriodicTargetReadOnlyViewSet,
                 basename='periodictargets')
+router.register(r'budgetrollup', BudgetRollupViewSet, basename='budgetrollup')
 
 
 urlpatterns = [  # rest framework
@@ -71,6 +72,8 @@ urlpatterns = [  # rest framework
     # enable the admin:
     path('admin/doc/', include('django.contrib.admindocs.urls')),
     path('admin/', admin.site.urls),
+    # request latency report for staff
+    path('performance/', views.performance_report, name='performance_report'),
     re_path(r'^(?P<selected_countries>\w+)/$',
             views.index, name='index'),
 
@@ -1,13 +1,22 @@
+import logging
 import unicodedata
-import json
-import requests
 
-from workflow.models import Country, ActivityUser, ActivitySites
-from django.contrib.auth.models import User
-from django.core.mail import mail_admins, EmailMessage
+from workflow.models import Country, ActivityUser, ActivitySites, USER_COUNTRIES_CACHE_KEY
+from activity.models import Notification
+from activity.external import external_data
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from django.core.exceptions import PermissionDenied
 from django.contrib.auth.decorators import user_passes_test
 
+logger = logging.getLogger(__name__)
+
+# seconds the country IDs of a user are cached. The cache is cleared when the
+# countries change, but only in the process that saved them unless CACHES is
+# a shared backend, the timeout bounds how long the others keep revoked access
+USER_COUNTRIES_CACHE_TIMEOUT = getattr(settings, 'USER_COUNTRIES_CACHE_TIMEOUT', 300)
+
 
 # CREATE NEW DATA DICTIONARY OBJECT
 def silo_to_dict(silo):
@@ -27,61 +36,114 @@ def silo_to_dict(silo):
     return parsed_data
 
 
-def get_country(user):
+def get_country_ids(user):
     """
-    Returns the object the view is displaying.
+    IDs of the countries a user has access to, memoized on the user object for
+    the request and in the cache until the user's countries change or for
+    USER_COUNTRIES_CACHE_TIMEOUT seconds
+    :param user: User
+    :return: list of Country IDs
     """
-    user_countries = ActivityUser.objects.all().filter(
-        user__id=user.id).values('countries')
+    country_ids = getattr(user, '_country_ids', None)
+    if country_ids is not None:
+        return country_ids
+
+    cache_key = USER_COUNTRIES_CACHE_KEY % user.id
+    country_ids = cache.get(cache_key)
+    if country_ids is None:
+        country_ids = list(ActivityUser.objects.filter(
+            user__id=user.id, countries__isnull=False)
+            .order_by('countries').values_list('countries', flat=True))
+        cache.set(cache_key, country_ids, USER_COUNTRIES_CACHE_TIMEOUT)
+
+    user._country_ids = country_ids
+    return country_ids
 
-    get_countries = Country.objects.all().filter(id__in=user_countries)
 
-    return get_countries
+def get_country(user):
+    """
+    Returns the countries a user has access to, filtered on the cached ID list
+    """
+    return Country.objects.all().filter(id__in=get_country_ids(user))
 
 
 def email_group(country, group, link, subject, message, submiter=None):
-    # email incident to admins in each country assoicated with the projects program
-    for single_country in country.all():
-        country = Country.objects.all().filter(country=single_country)
-        get_group_emails = User.objects.all().filter(
-            activity_user=group, 
-            activity_user__country=country).values_list('email', flat=True)
-        email_link = link
-        formatted_email = email_link
-        subject = str(subject)
-        message = str(message) + formatted_email
-
-        to = [str(item) for item in get_group_emails]
-        if submiter:
-            to.append(submiter)
-        email = EmailMessage(subject, message, 'systems@mercycorps.org', to)
-        email.send()
-    mail_admins(subject, message, fail_silently=False)
+    """
+    Queue an email to the group in each country associated with the project's
+    program, the submitter and the admins. It is sent by the send_notifications
+    command so a slow or failing mail relay does not hold the request
+    :param country: Country queryset or manager of the program
+    :param group: ActivityUser to notify
+    """
+    Notification.objects.queue(
+        subject=str(subject), message=str(message) + link, approver=group,
+        country_ids=country.values_list('id', flat=True), submitter=submiter)
+
+
+def bulk_update_with_history(objs, model, fields, batch_size=None, reason=None):
+    """
+    bulk_update the objects and write their simple_history change rows in
+    one insert, bulk_update skips the save signals that normally write them
+    :param objs: saved model instances
+    :param model: model class with a HistoricalRecords field named history
+    :param fields: fields to update
+    :param reason: history change reason
+    """
+    now = timezone.now()
+    model.objects.bulk_update(objs, fields, batch_size=batch_size)
+    history_model = model.history.model
+    history_fields = [field for field in model._meta.fields
+                      if field.name not in history_model._history_excluded_fields]
+    history_model.objects.bulk_create([
+        history_model(history_date=now, history_type='~', history_change_reason=reason,
+                      **dict((field.attname, getattr(obj, field.attname)) for field in history_fields))
+        for obj in objs], batch_size=batch_size)
+
+
+def get_activity_tables_headers():
+    """
+    Headers of the ActivityTables API requests, with the token of the site
+    when there is one
+    """
+    token = ActivitySites.objects.filter(site_id=1).first()
+    if token is not None and token.activity_tables_token:
+        return {'content-type': 'application/json',
+                'Authorization': 'Token ' + token.activity_tables_token}
+    logger.warning('ActivityTables token not found, the tables are requested without one')
+    return {'content-type': 'application/json'}
 
 
 def get_table(url, data=None):
     """
     Get table data from a Silo.  First get the Data url from the silo details
-    then get data and return it
+    then get data and return it, through the shared cached client
 
     :param url: URL to silo meta detail info
-    :param data:
+    :param data: return the data member of the response only
     :return: json dump of table data
     """
-    token = ActivitySites.objects.get(site_id=1)
-    if token.activity_tables_token:
-        headers = {'content-type': 'application/json',
-                   'Authorization': 'Token ' + token.activity_tables_token}
-    else:
-        headers = {'content-type': 'application/json'}
-        print("Token Not Found")
-
-    response = requests.get(url, headers=headers, verify=True)
+    table = external_data.get_json(url, headers=get_activity_tables_headers())
     if data:
-        data = json.loads(response.content['data'])
-    else:
-        data = json.loads(response.content)
-    return data
+        return table['data']
+    return table
+
+
+def get_tables(urls):
+    """
+    Get the data of many tables at once, see ExternalDataClient.get_many
+    :return: list of the table data in the order of the urls, None for the
+        tables that could not be read
+    """
+    urls = list(urls)
+    if not urls:
+        return []
+    tables = []
+    for response in external_data.get_many(urls, headers=get_activity_tables_headers()):
+        try:
+            tables.append(response.json() if response is not None and response.ok else None)
+        except ValueError:
+            tables.append(None)
+    return tables
 
 
 def user_to_activity(user, response):
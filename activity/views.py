@@ -7,20 +7,23 @@ from django.contrib import messages
 from django.contrib.auth import logout
 from django.contrib.auth.models import Group
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import render
 from django.shortcuts import get_object_or_404
 from django.db.models import Sum, Q, Count
 
-from indicators.models import CollectedData, Indicator
+from indicators.models import CollectedData, Indicator, IndicatorRollup
 
 from workflow.models import (
-    ProjectAgreement, ProjectComplete, Program,
+    ProjectAgreement, Program,
     SiteProfile, Sector, Country, ActivityUser,
     ActivitySites, ActivityBookmarks, FormGuidance
 )
 from activity.tables import IndicatorDataTable
+from activity.instrumentation import metrics, REPORT_COLUMNS
 from activity.util import get_country
+from workflow.rollups import get_approval_rollup
 from activity.forms import (
     RegistrationForm, NewUserRegistrationForm,
     NewActivityUserRegistrationForm, BookmarkForm
@@ -64,8 +67,11 @@ def index(request, selected_countries=None, id=0, sector=0):
     filter_for_quantitative_data_sums = {
         'indicator__key_performance_indicator': True,
         'periodic_target__isnull': False,
-        'achieved__isnull': False,
+        'actual_total__isnull': False,
     }
+    # the sector filter goes through the collected data agreement, which the
+    # indicator rollup does not keep, so that one case is summed from the raw rows
+    filter_by_sector = False
 
     # get data for just one program or all programs
     if int(program_id) == 0:
@@ -75,40 +81,14 @@ def index(request, selected_countries=None, id=0, sector=0):
         # filter by all programs then filter by sector if found
         if int(sector) > 0:
             filter_for_quantitative_data_sums['agreement__sector__in'] = sectors
+            filter_by_sector = True
             get_site_profile = SiteProfile.objects.all().prefetch_related('country', 'district', 'province').filter(
                 Q(Q(projectagreement__sector__in=sectors)), country__in=selected_countries).filter(status=1)
             get_site_profile_indicator = SiteProfile.objects.all().prefetch_related(
                 'country', 'district', 'province').filter(
                 Q(collecteddata__program__country__in=selected_countries)).filter(status=1)
-            agreement_total_count = ProjectAgreement.objects.all().filter(
-                sector__in=sectors, program__country__in=selected_countries).count()
-            complete_total_count = ProjectComplete.objects.all().filter(
-                project_agreement__sector__in=sectors, program__country__in=selected_countries).count()
-            agreement_approved_count = ProjectAgreement.objects.all().filter(
-                approval='approved', sector__in=sectors, program__country__in=selected_countries).count()
-            complete_approved_count = ProjectComplete.objects.all().filter(
-                approval='approved', project_agreement__sector__in=sectors,
-                program__country__in=selected_countries).count()
-
-            agreement_awaiting_count = ProjectAgreement.objects.all().filter(
-                approval='awaiting approval', sector__in=sectors,
-                program__country__in=selected_countries).count()
-
-            complete_awaiting_count = ProjectComplete.objects.all().filter(
-                approval='awaiting approval', project_agreement__sector__in=sectors,
-                program__country__in=selected_countries).count()
-
-            agreement_open_count = ProjectAgreement.objects.all().filter(Q(Q(approval='open') | Q(approval="") | Q(
-                approval=None)), sector__id__in=sectors, program__country__in=selected_countries).count()
-            complete_open_count = ProjectComplete.objects.all().filter(
-                Q(Q(approval='open') | Q(approval="") | Q(approval=None)), project_agreement__sector__in=sectors,
-                program__country__in=selected_countries).count()
-            agreement_wait_count = ProjectAgreement.objects.all().filter(
-                Q(approval='in progress') & Q(Q(approval='in progress') | Q(approval=None) | Q(approval="")),
-                sector__in=sectors, program__country__in=selected_countries).count()
-            complete_wait_count = ProjectComplete.objects.all().filter(
-                Q(approval='in progress') & Q(Q(approval='in progress') | Q(approval=None) | Q(approval="")),
-                project_agreement__sector__in=sectors, program__country__in=selected_countries).count()
+            approval_rollup = get_approval_rollup(
+                countries=selected_countries, sectors=sectors)
 
         else:
             get_site_profile = SiteProfile.objects.all().prefetch_related(
@@ -116,65 +96,37 @@ def index(request, selected_countries=None, id=0, sector=0):
             get_site_profile_indicator = SiteProfile.objects.all().prefetch_related(
                 'country', 'district', 'province').filter(
                 Q(collecteddata__program__country__in=selected_countries)).filter(status=1)
-            agreement_total_count = ProjectAgreement.objects.all().filter(
-                program__country__in=selected_countries).count()
-            complete_total_count = ProjectComplete.objects.all().filter(
-                program__country__in=selected_countries).count()
-            agreement_approved_count = ProjectAgreement.objects.all().filter(
-                approval='approved', program__country__in=selected_countries).count()
-            complete_approved_count = ProjectComplete.objects.all().filter(
-                approval='approved', program__country__in=selected_countries).count()
-
-            agreement_awaiting_count = ProjectAgreement.objects.all().filter(
-                approval='awaiting approval', program__country__in=selected_countries).count()
-            complete_awaiting_count = ProjectComplete.objects.all().filter(
-                approval='awaiting approval', program__country__in=selected_countries).count()
-            agreement_open_count = ProjectAgreement.objects.all().filter(Q(Q(approval='open') | Q(
-                approval="") | Q(approval=None)), program__country__in=selected_countries).count()
-            complete_open_count = ProjectComplete.objects.all().filter(Q(Q(approval='open') | Q(
-                approval="") | Q(approval=None)), program__country__in=selected_countries).count()
-            agreement_wait_count = ProjectAgreement.objects.all().filter(
-                Q(approval='in progress') & Q(Q(approval='in progress') | Q(approval=None) | Q(approval="")),
-                program__country__in=selected_countries).count()
-            complete_wait_count = ProjectComplete.objects.all().filter(
-                Q(approval='in progress') & Q(Q(approval='in progress') | Q(approval=None) | Q(approval="")),
-                program__country__in=selected_countries).count()
+            approval_rollup = get_approval_rollup(countries=selected_countries)
 
     else:
         filter_for_quantitative_data_sums['indicator__program__id'] = program_id
 
         get_filtered_name = Program.objects.get(id=program_id)
-        agreement_total_count = ProjectAgreement.objects.all().filter(program__id=program_id).count()
-        complete_total_count = ProjectComplete.objects.all().filter(program__id=program_id).count()
-        agreement_approved_count = ProjectAgreement.objects.all().filter(
-            program__id=program_id, approval='approved').count()
-        complete_approved_count = ProjectComplete.objects.all().filter(
-            program__id=program_id, approval='approved').count()
-        agreement_open_count = ProjectAgreement.objects.all().filter(
-            program__id=program_id, approval='open').count()
-        complete_open_count = ProjectComplete.objects.all().filter(
-            Q(Q(approval='open') | Q(approval="")), program__id=program_id).count()
-        agreement_wait_count = ProjectAgreement.objects.all().filter(Q(program__id=program_id), Q(
-            approval='in progress') & Q(Q(approval='in progress') | Q(approval=None) | Q(approval=""))).count()
-        complete_wait_count = ProjectComplete.objects.all().filter(Q(program__id=program_id), Q(
-            approval='in progress') & Q(Q(approval='in progress') | Q(approval=None) | Q(approval=""))).count()
+        approval_rollup = get_approval_rollup(program=program_id)
         get_site_profile = SiteProfile.objects.all().prefetch_related(
             'country', 'district', 'province').filter(projectagreement__program__id=program_id).filter(status=1)
         get_site_profile_indicator = SiteProfile.objects.all().prefetch_related(
             'country', 'district', 'province').filter(Q(collecteddata__program__id=program_id)).filter(status=1)
 
-        agreement_awaiting_count = ProjectAgreement.objects.all().filter(
-            program__id=program_id, approval='awaiting approval').count()
-        complete_awaiting_count = ProjectComplete.objects.all().filter(
-            program__id=program_id, approval='awaiting approval').count()
-
-    get_quantitative_data_sums = CollectedData.objects.all()\
-        .filter(**filter_for_quantitative_data_sums)\
-        .exclude(achieved=None, periodic_target=None, program__funding_status="Archived")\
-        .order_by('indicator__program', 'indicator__number')\
-        .values('indicator__lop_target', 'indicator__program__id', 'indicator__program__name',
-                'indicator__number', 'indicator__name', 'indicator__id')\
-        .annotate(targets=Sum('periodic_target'), actuals=Sum('achieved'))
+    agreement_counts = approval_rollup['agreement']
+    complete_counts = approval_rollup['complete']
+
+    if filter_by_sector:
+        filter_for_quantitative_data_sums['achieved__isnull'] = \
+            filter_for_quantitative_data_sums.pop('actual_total__isnull')
+        get_quantitative_data_sums = CollectedData.objects.all()\
+            .filter(**filter_for_quantitative_data_sums)\
+            .order_by('indicator__program', 'indicator__number')\
+            .values('indicator__lop_target', 'indicator__program__id', 'indicator__program__name',
+                    'indicator__number', 'indicator__name', 'indicator__id')\
+            .annotate(targets=Sum('periodic_target__target'), actuals=Sum('achieved'))
+    else:
+        get_quantitative_data_sums = IndicatorRollup.objects.all()\
+            .filter(**filter_for_quantitative_data_sums)\
+            .order_by('indicator__program', 'indicator__number')\
+            .values('indicator__lop_target', 'indicator__program__id', 'indicator__program__name',
+                    'indicator__number', 'indicator__name', 'indicator__id')\
+            .annotate(targets=Sum('target_total'), actuals=Sum('actual_total'))
 
     # Evidence and Objectives are for the global leader dashboard items and are the same every time
     count_evidence = CollectedData.objects.all().filter(indicator__isnull=False)\
@@ -253,16 +205,16 @@ def index(request, selected_countries=None, id=0, sector=0):
     elif total_evidence_adoption_count <= total_indicator_data_count/4:
         evidence_adoption = red
 
-    return render(request, "index.html", {'agreement_total_count': agreement_total_count,
-                                          'agreement_approved_count': agreement_approved_count,
-                                          'agreement_open_count': agreement_open_count,
-                                          'agreement_wait_count': agreement_wait_count,
-                                          'agreement_awaiting_count': agreement_awaiting_count,
-                                          'complete_open_count': complete_open_count,
-                                          'complete_approved_count': complete_approved_count,
-                                          'complete_total_count': complete_total_count,
-                                          'complete_wait_count': complete_wait_count,
-                                          'complete_awaiting_count': complete_awaiting_count,
+    return render(request, "index.html", {'agreement_total_count': agreement_counts['total'],
+                                          'agreement_approved_count': agreement_counts['approved'],
+                                          'agreement_open_count': agreement_counts['open'],
+                                          'agreement_wait_count': agreement_counts['in_progress'],
+                                          'agreement_awaiting_count': agreement_counts['awaiting_approval'],
+                                          'complete_open_count': complete_counts['open'],
+                                          'complete_approved_count': complete_counts['approved'],
+                                          'complete_total_count': complete_counts['total'],
+                                          'complete_wait_count': complete_counts['in_progress'],
+                                          'complete_awaiting_count': complete_counts['awaiting_approval'],
                                           'programs': get_programs, 'getSiteProfile': get_site_profile,
                                           'countries': user_countries, 'selected_countries': selected_countries,
                                           'getFilteredName': get_filtered_name, 'getSectors': get_sectors,
@@ -457,3 +409,19 @@ def logout_view(request):
     logout(request)
     # Redirect to a success page.
     return HttpResponseRedirect("/")
+
+
+@staff_member_required
+def performance_report(request):
+    """
+    Latency percentiles, SQL and template time of the slowest views, ?order=
+    sorts by another column of the report and ?limit= sets the number of views
+    """
+    order_by = request.GET.get('order', 'p95_ms')
+    if order_by not in REPORT_COLUMNS:
+        order_by = 'p95_ms'
+    try:
+        limit = int(request.GET.get('limit', 20))
+    except ValueError:
+        limit = 20
+    return JsonResponse({'views': metrics.report(order_by=order_by, limit=limit)})
@@ -8,12 +8,13 @@ from django.shortcuts import render
 from workflow.models import ProjectAgreement, ProjectComplete, Program, SiteProfile, Country, ActivitySites
 from .models import ProgramNarratives, JupyterNotebooks
 from formlibrary.models import TrainingAttendance, Distribution, Beneficiary
-from indicators.models import CollectedData, Indicator, ActivityTable
+from indicators.models import CollectedData, Indicator, ActivityTable, IndicatorRollup
 
 from django.db.models import Sum
 from django.db.models import Q
 
-from activity.util import get_country, get_table
+from activity.util import get_country, get_tables
+from workflow.rollups import approval_status_counts, budget_totals, get_program_budget_rollup
 
 from django.contrib.auth.decorators import login_required
 import requests
@@ -92,31 +93,26 @@ def default_custom_dashboard(request, id=0, status=0):
     # transform to list if a submitted country
     selected_countries_list = Country.objects.all().filter(program__id=program_id)
 
-    get_quantitative_data_sums = CollectedData.objects.filter(
-        indicator__program__id=program_id, achieved__isnull=False, indicator__key_performance_indicator=True)\
-        .exclude(achieved=None).order_by(
-        'indicator__number').values('indicator__number', 'indicator__name', 'indicator__id')\
-        .annotate(targets=Sum('periodic_target__target'), actuals=Sum('achieved')).exclude(achieved=None)
+    get_quantitative_data_sums = IndicatorRollup.objects.filter(
+        indicator__program__id=program_id, actual_total__isnull=False, indicator__key_performance_indicator=True)\
+        .order_by('indicator__number').values('indicator__number', 'indicator__name', 'indicator__id')\
+        .annotate(targets=Sum('target_total'), actuals=Sum('actual_total'))
 
     total_targets = get_quantitative_data_sums.aggregate(Sum('targets'))
     total_actuals = get_quantitative_data_sums.aggregate(Sum('actuals'))
 
     get_filtered_name = Program.objects.get(id=program_id)
 
-    get_projects_count = ProjectAgreement.objects.all().filter(
-        program__id=program_id, program__country__in=countries).count()
     get_budget_estimated = ProjectAgreement.objects.all().filter(
         program__id=program_id, program__country__in=countries).annotate(estimated=Sum('total_estimated_budget'))
-    get_awaiting_approval_count = ProjectAgreement.objects.all().filter(
-        program__id=program_id, approval='awaiting approval', program__country__in=countries).count()
-    get_approved_count = ProjectAgreement.objects.all().filter(
-        program__id=program_id, approval='approved', program__country__in=countries).count()
-    get_rejected_count = ProjectAgreement.objects.all().filter(
-        program__id=program_id, approval='rejected', program__country__in=countries).count()
-    get_in_progress_count = ProjectAgreement.objects.all().filter(program__id=program_id).filter(
-        Q(Q(approval='in progress') | Q(approval=None)), program__country__in=countries).count()
-    no_status_count = ProjectAgreement.objects.all().filter(
-        program__id=program_id).filter(Q(Q(approval=None) | Q(approval=""))).count()
+    agreement_counts = approval_status_counts(ProjectAgreement.objects.filter(
+        program__id=program_id, program__country__in=countries))
+    get_projects_count = agreement_counts['total']
+    get_awaiting_approval_count = agreement_counts['awaiting_approval']
+    get_approved_count = agreement_counts['approved']
+    get_rejected_count = agreement_counts['rejected']
+    get_in_progress_count = agreement_counts['in_progress'] + agreement_counts['no_status']
+    no_status_count = agreement_counts['no_status']
 
     get_site_profile = SiteProfile.objects.all().filter(
         Q(projectagreement__program__id=program_id) | Q(collecteddata__program__id=program_id))
@@ -143,22 +139,13 @@ def default_custom_dashboard(request, id=0, status=0):
         get_projects = ProjectAgreement.objects.all().filter(
             program__id=program_id, program__country__in=countries)
 
-    get_project_completed = []
-
-    total_budgetted = 0.00
-    total_actual = 0.00
-
-    get_projects_complete = ProjectComplete.objects.all()
-    for project in get_projects:
-        for complete in get_projects_complete:
-            if complete.actual_budget is not None:
-                if project.id == complete.project_agreement_id:
-                    total_budgetted = float(
-                        total_budgetted) + float(project.total_estimated_budget)
-                    total_actual = float(total_actual) + \
-                        float(complete.actual_budget)
-
-                    get_project_completed.append(project)
+    # completed projects of the cached program rollup, limited to the listed agreements
+    agreement_ids = set(get_projects.values_list('id', flat=True))
+    get_project_completed = [row for row in get_program_budget_rollup(program_id)['agreements']
+                             if row['agreement_id'] in agreement_ids]
+    budget_totals_completed = budget_totals(get_project_completed)
+    total_budgetted = budget_totals_completed['estimated']
+    total_actual = budget_totals_completed['actual']
 
     return render(request, "customdashboard/customdashboard/visual_dashboard.html",
                   {'get_site_profile': get_site_profile, 'get_budget_estimated': get_budget_estimated,
@@ -185,10 +172,10 @@ def public_dashboard(request, id=0, public=0):
     get_quantitative_data_sums_2 = CollectedData.objects.all().filter(
         indicator__program__id=program_id, achieved__isnull=False)\
         .order_by('indicator__source').values('indicator__number', 'indicator__source', 'indicator__id')
-    get_quantitative_data_sums = CollectedData.objects.filter(
-        indicator__program__id=program_id, achieved__isnull=False).exclude(achieved=None)\
+    get_quantitative_data_sums = IndicatorRollup.objects.filter(
+        indicator__program__id=program_id, actual_total__isnull=False)\
         .order_by('indicator__number').values('indicator__number', 'indicator__name', 'indicator__id')\
-        .annotate(targets=Sum('periodic_target__target'), actuals=Sum('achieved'))
+        .annotate(targets=Sum('target_total'), actuals=Sum('actual_total'))
     get_indicator_count = Indicator.objects.all().filter(program__id=program_id).count()
 
     get_indicator_data = CollectedData.objects.all().filter(
@@ -211,19 +198,14 @@ def public_dashboard(request, id=0, public=0):
     get_site_profile_indicator = SiteProfile.objects.all().filter(
         Q(collecteddata__program__id=program_id))
 
-    get_projects_count = ProjectAgreement.objects.all().filter(
-        program__id=program_id).count()
-    get_awaiting_approval_count = ProjectAgreement.objects.all().filter(
-        program__id=program_id, approval='awaiting approval').count()
-    get_approved_count = ProjectAgreement.objects.all().filter(
-        program__id=program_id, approval='approved').count()
-    get_rejected_count = ProjectAgreement.objects.all().filter(
-        program__id=program_id, approval='rejected').count()
-    get_in_progress_count = ProjectAgreement.objects.all().filter(Q(program__id=program_id) & Q(
-        Q(approval='in progress') | Q(approval=None) | Q(approval=""))).count()
-
-    no_status_count = ProjectAgreement.objects.all().filter(
-        Q(program__id=program_id) & Q(Q(approval=None) | Q(approval=""))).count()
+    agreement_counts = approval_status_counts(
+        ProjectAgreement.objects.filter(program__id=program_id))
+    get_projects_count = agreement_counts['total']
+    get_awaiting_approval_count = agreement_counts['awaiting_approval']
+    get_approved_count = agreement_counts['approved']
+    get_rejected_count = agreement_counts['rejected']
+    get_in_progress_count = agreement_counts['in_progress'] + agreement_counts['no_status']
+    no_status_count = agreement_counts['no_status']
 
     get_notebooks = JupyterNotebooks.objects.all().filter(program__id=program_id)
 
@@ -239,18 +221,12 @@ def public_dashboard(request, id=0, public=0):
     evidence_tables_count = get_evidence.count()
     evidence_tables = []
 
-    try:
-        for table in get_evidence:
-
-            table.table_data = get_table(table.url)
-
-            print(table.table_data)
-
+    # the tables are fetched in parallel, the unreadable ones are left out
+    for table, table_data in zip(get_evidence, get_tables([table.url for table in get_evidence])):
+        if table_data is not None:
+            table.table_data = table_data
             evidence_tables.append(table)
 
-    except Exception as e:
-        pass
-
     for p in get_projects:
         agreement_id_list.append(p.id)
 
@@ -265,14 +241,7 @@ def public_dashboard(request, id=0, public=0):
 
     get_beneficiaries = Beneficiary.objects.all().filter(training__in=training_id_list)
 
-    get_project_completed = []
-
-    get_projects_complete = ProjectComplete.objects.all()
-    for project in get_projects:
-        for complete in get_projects_complete:
-            if complete.actual_budget is not None:
-                if project.id == complete.project_agreement_id:
-                    get_project_completed.append(project)
+    get_project_completed = get_program_budget_rollup(program_id)['agreements']
 
     # public dashboards have a different template display
     if int(public) == 1:
@@ -53,6 +53,38 @@ class FlatJsonSerializer(PythonSerializer):
         return super(PythonSerializer, self).getvalue()
 
 
+def get_query_plan(serializer, prefix=''):
+    """
+    Work out the select_related and prefetch_related lookups a serializer
+    needs so a page of rows is rendered with a fixed number of queries
+    :param serializer: serializer instance, a many=True serializer is planned from its child
+    :param prefix: lookup prefix of a nested serializer
+    :return: tuple of (select_related list, prefetch_related list)
+    """
+    serializer = getattr(serializer, 'child', serializer)
+    select_related = []
+    prefetch_related = []
+    for field in serializer.fields.values():
+        if field.source == '*' or '.' in field.source or field.write_only:
+            continue
+        lookup = prefix + field.source
+        if isinstance(field, serializers.ManyRelatedField):
+            prefetch_related.append(lookup)
+        elif isinstance(field, serializers.ListSerializer):
+            prefetch_related.append(lookup)
+            nested_select, nested_prefetch = get_query_plan(field.child, lookup + '__')
+            prefetch_related.extend(nested_select + nested_prefetch)
+        elif isinstance(field, serializers.BaseSerializer):
+            select_related.append(lookup)
+            nested_select, nested_prefetch = get_query_plan(field, lookup + '__')
+            select_related.extend(nested_select)
+            prefetch_related.extend(nested_prefetch)
+        elif isinstance(field, serializers.RelatedField) and not field.use_pk_only_optimization():
+            # hyperlinks and primary keys only read the <field>_id column
+            select_related.append(lookup)
+    return select_related, prefetch_related
+
+
 class UserSerializer(serializers.HyperlinkedModelSerializer):
 
     class Meta:
@@ -200,6 +232,8 @@ class IndicatorLightSerializer(serializers.ModelSerializer):
 
     def get_datacount(self, obj):
         # Returns the number of collected data points by an indicator
+        if hasattr(obj, 'datacount'):
+            return obj.datacount
         return obj.collecteddata_set.count()
 
     def get_sector(self, obj):
@@ -218,6 +252,8 @@ class ProgramIndicatorSerializer(serializers.ModelSerializer):
     indicators_count = serializers.SerializerMethodField()
 
     def get_indicators_count(self, obj):
+        if hasattr(obj, 'indicators_count'):
+            return obj.indicators_count
         return obj.indicator_set.count()
 
     class Meta:
@@ -370,6 +406,8 @@ class CollectedDataSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = CollectedData
         fields = '__all__'
+        # the periodic targets are routed as periodictargets, not periodictarget
+        extra_kwargs = {'periodic_target': {'view_name': 'periodictargets-detail'}}
 
 
 class activitytableSerializer(serializers.HyperlinkedModelSerializer):
@@ -386,12 +424,13 @@ class DisaggregationValueSerializer(serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = DisaggregationValue
+        fields = '__all__'
 
 
 class LoggedUserSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = LoggedUser
-        fields = ('username', 'country', 'email')
+        fields = ('username', 'country', 'email', 'login_date')
 
 
 class ChecklistSerializer(serializers.HyperlinkedModelSerializer):
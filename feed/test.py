@@ -8,7 +8,19 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from feed.views import KeysetPagination
+from indicators.models import CollectedData, Indicator, PeriodicTarget
+from workflow.models import (
+    ActivityUser, Country, Organization, Program, ProjectAgreement, SiteProfile, Stakeholder
+)
 
 
 class SimpleTest(TestCase):
@@ -17,3 +29,100 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class KeysetPaginationTest(TestCase):
+
+    def setUp(self):
+        self.programs = [Program.objects.create(name="program %s" % i, gaitid=str(i)) for i in range(5)]
+        # programs created without a date are listed first
+        Program.objects.filter(id=self.programs[0].id).update(create_date=None)
+
+    def get_page(self, url):
+        pagination = KeysetPagination()
+        request = Request(APIRequestFactory().get(url))
+        page = pagination.paginate_queryset(Program.objects.all(), request)
+        return page, pagination.get_next_link()
+
+    def test_pages_cover_every_row_once(self):
+        """Check walking the cursors returns every program once"""
+        seen = []
+        url, pages = '/api/program/?page_size=2', 0
+        while url:
+            page, url = self.get_page(url)
+            seen.extend(program.id for program in page)
+            pages += 1
+        self.assertEqual(pages, 3)
+        self.assertEqual(seen[0], self.programs[0].id)
+        self.assertEqual(sorted(seen), sorted(program.id for program in self.programs))
+
+    def test_page_size(self):
+        """Check the page size is positive and capped at max_page_size"""
+        pagination = KeysetPagination()
+        for page_size, expected in (('2', 2), ('5000', 1000), ('0', 100), ('-3', 100), ('two', 100)):
+            request = Request(APIRequestFactory().get('/api/program/', {'page_size': page_size}))
+            self.assertEqual(pagination.get_page_size(request), expected)
+
+    def test_invalid_cursor(self):
+        """Check a tampered cursor is rejected"""
+        with self.assertRaises(NotFound):
+            self.get_page('/api/program/?cursor=notacursor')
+
+
+class FeedQueryCountTest(TestCase):
+
+    def setUp(self):
+        organization = Organization.objects.create(name="activity")
+        country = Country.objects.create(country="testcountry", organization=organization)
+        program = Program.objects.create(name="testprogram", gaitid="1")
+        program.country.add(country)
+        site = SiteProfile.objects.create(name="testsite", country=country)
+        stakeholder = Stakeholder.objects.create(name="teststakeholder", country=country, stakeholder_register=True)
+        for i in range(12):
+            agreement = ProjectAgreement.objects.create(program=program, project_name="project %s" % i)
+            agreement.site.add(site)
+            agreement.stakeholder.add(stakeholder)
+        indicator = Indicator.objects.create(name="testindicator")
+        indicator.program.add(program)
+        periodic_target = PeriodicTarget.objects.create(indicator=indicator, period="Year 1", target=10)
+        for i in range(12):
+            collected = CollectedData.objects.create(achieved=i, indicator=indicator, program=program,
+                                                     periodic_target=periodic_target)
+            collected.site.add(site)
+        user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+        activity_user = ActivityUser.objects.create(name="john", user=user)
+        activity_user.countries.add(country)
+        self.auth = 'Token %s' % user.auth_token.key
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_constant_queries_per_page(self):
+        """Check the number of queries does not grow with the page size"""
+        self.client.get('/api/initiations/', HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(self.count_queries('/api/initiations/?page_size=2'),
+                         self.count_queries('/api/initiations/?page_size=12'))
+        self.assertEqual(self.count_queries('/api/collecteddata/?page_size=2'),
+                         self.count_queries('/api/collecteddata/?page_size=12'))
+        response = self.client.get('/api/collecteddata/?page_size=12', HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(len(response.json()['results']), 12)
+        self.assertIn('/api/periodictargets/', response.json()['results'][0]['periodic_target'])
+
+    def test_program_indicator_counts(self):
+        """Check the program indicator counts are annotated, not counted per row"""
+        for i in range(4):
+            program = Program.objects.create(name="program %s" % i, gaitid="p%s" % i)
+            for j in range(3):
+                indicator = Indicator.objects.create(name="indicator %s" % j)
+                indicator.program.add(program)
+                CollectedData.objects.create(achieved=j, indicator=indicator, program=program)
+        self.client.get('/api/pindicators/', HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(self.count_queries('/api/pindicators/?page_size=1'),
+                         self.count_queries('/api/pindicators/?page_size=5'))
+        response = self.client.get('/api/pindicators/?page_size=5', HTTP_AUTHORIZATION=self.auth)
+        program = response.json()['results'][1]
+        self.assertEqual(program['indicators_count'], 3)
+        self.assertEqual([indicator['datacount'] for indicator in program['indicator_set']], [1, 1, 1])
@@ -1,15 +1,23 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import base64
+from collections import OrderedDict
+
+from django.db.models import Count, F, Prefetch, Q
 from django.shortcuts import get_object_or_404
+from django.utils.dateparse import parse_datetime
 
 from rest_framework import viewsets
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.utils.urls import replace_query_param
 import django_filters
 
 from .serializers import *
-from activity.util import get_country
+from activity.util import get_country_ids
+from workflow.rollups import get_country_budget_rollup, get_program_budget_rollup
 
 from workflow.mixins import APIDefaultsMixin
 
@@ -43,6 +51,141 @@ class SmallResultsSetPagination(PageNumberPagination):
     max_page_size = 50
 
 
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on (create_date, id). The cursor carries the position of
+    the last row of the page, so the next page is a range scan from there
+    instead of an OFFSET, and rows added while paging are not skipped.
+    Rows without a create_date come first.
+    """
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+
+        queryset = queryset.order_by(F('create_date').asc(nulls_first=True), 'id')
+        if position is not None:
+            queryset = queryset.filter(self.after(*position))
+
+        page = list(queryset[:page_size + 1])
+        self.next_position = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_position = (page[-1].create_date, page[-1].pk)
+        return page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    @staticmethod
+    def after(create_date, pk):
+        """
+        Rows sorted after the (create_date, id) position
+        """
+        if create_date is None:
+            return Q(create_date__isnull=True, id__gt=pk) | Q(create_date__isnull=False)
+        return Q(create_date__gt=create_date) | Q(create_date=create_date, id__gt=pk)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            create_date, pk = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii').split('|')
+            if create_date:
+                create_date = parse_datetime(create_date)
+                if create_date is None:
+                    raise ValueError(encoded)
+            else:
+                create_date = None
+            return create_date, int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, create_date, pk):
+        position = '%s|%s' % (create_date.isoformat() if create_date else '', pk)
+        encoded = base64.urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(*self.next_position)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+
+class FeedListMixin(object):
+    """
+    List limited to the logged in user's countries, keyset paginated, with a
+    ?fields=id,name parameter to only serialize some of the fields.
+    The related lookups are planned from the serializer fields, extra ones
+    can be declared in select_related_fields and prefetch_related_fields.
+    """
+    pagination_class = KeysetPagination
+    country_lookup = 'country__in'
+    # set when the country lookup goes through a many to many and repeats rows
+    country_distinct = False
+    fields_query_param = 'fields'
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    def list(self, request, *args, **kwargs):
+        user_countries = get_country_ids(request.user)
+        queryset = self.get_queryset().filter(**{self.country_lookup: user_countries})
+        if self.country_distinct:
+            queryset = queryset.distinct()
+        queryset = self.apply_query_plan(self.filter_queryset(queryset))
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def get_query_plan(self):
+        select_related, prefetch_related = get_query_plan(self.get_serializer())
+        return (list(self.select_related_fields) + select_related,
+                list(self.prefetch_related_fields) + prefetch_related)
+
+    def apply_query_plan(self, queryset):
+        """
+        Replace the manager's default related lookups with the ones the
+        serialized fields need
+        """
+        select_related, prefetch_related = self.get_query_plan()
+        queryset = queryset.select_related(None).prefetch_related(None)
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super(FeedListMixin, self).get_serializer(*args, **kwargs)
+        request = getattr(self, 'request', None)
+        fields = request.query_params.get(self.fields_query_param) if request else None
+        if fields and request.method == 'GET':
+            selected = set(field.strip() for field in fields.split(','))
+            target = getattr(serializer, 'child', serializer)
+            for name in set(target.fields) - selected:
+                target.fields.pop(name)
+        return serializer
+
+
 class PeriodicTargetReadOnlyViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = PeriodicTargetSerializer
 
@@ -54,15 +197,34 @@ class PeriodicTargetReadOnlyViewSet(viewsets.ReadOnlyModelViewSet):
         return queryset
 
 
+class BudgetRollupViewSet(viewsets.ViewSet):
+    """
+    Estimated budget against actual cost of the completed projects, per
+    country of the logged in user on the list and per program on retrieve
+    """
+    lookup_value_regex = '[0-9]+'
+
+    def list(self, request):
+        rollups = get_country_budget_rollup(get_country_ids(request.user))
+        return Response([dict(rollup, country=country_id) for country_id, rollup in sorted(rollups.items())])
+
+    def retrieve(self, request, pk=None):
+        if not Program.objects.filter(id=pk, country__in=get_country_ids(request.user)).exists():
+            raise NotFound()
+        return Response(dict(get_program_budget_rollup(pk), program=int(pk)))
+
+
 class PogramIndicatorReadOnlyViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = ProgramIndicatorSerializer
     pagination_class = StandardResultsSetPagination
 
     def get_queryset(self):
-        queryset = Program.objects.prefetch_related('indicator_set',
-                                                    'indicator_set__indicator_type',
-                                                    'indicator_set__sector', 'indicator_set__level',
-                                                    'indicator_set__collecteddata_set').all()
+        # the counts are annotated so the serializer does not run a count() per row
+        indicators = Indicator.objects.select_related('sector')\
+            .prefetch_related(None).prefetch_related('indicator_type', 'level')\
+            .annotate(datacount=Count('collecteddata', distinct=True))
+        queryset = Program.objects.annotate(indicators_count=Count('indicator', distinct=True))\
+            .prefetch_related(Prefetch('indicator_set', queryset=indicators))
         return queryset
 
 # API Classes
@@ -76,7 +238,7 @@ class UserViewSet(viewsets.ModelViewSet):
     serializer_class = UserSerializer
 
 
-class ProgramViewSet(viewsets.ModelViewSet):
+class ProgramViewSet(FeedListMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`,
     `update` and `destroy` actions.
@@ -84,16 +246,11 @@ class ProgramViewSet(viewsets.ModelViewSet):
     limit to users logged in country permissions
     """
 
-    def list(self, request):
-        user_countries = get_country(request.user)
-        queryset = Program.objects.all().filter(country__in=user_countries)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
-
     filter_fields = ('country__country', 'name')
     filter_backends = (django_filters.rest_framework.DjangoFilterBackend,)
     queryset = Program.objects.all()
     serializer_class = ProgramSerializer
+    country_distinct = True
 
 
 class SectorViewSet(viewsets.ModelViewSet):
@@ -123,7 +280,7 @@ class OfficeViewSet(viewsets.ModelViewSet):
     serializer_class = OfficeSerializer
 
 
-class SiteProfileViewSet(viewsets.ModelViewSet):
+class SiteProfileViewSet(FeedListMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`,
     `update` and `destroy` actions.
@@ -131,15 +288,9 @@ class SiteProfileViewSet(viewsets.ModelViewSet):
     limit to users logged in country permissions
     """
 
-    def list(self, request):
-        user_countries = get_country(request.user)
-        queryset = SiteProfile.objects.all().filter(country__in=user_countries)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
-
     filter_fields = ('country__country',)
     filter_backends = (django_filters.rest_framework.DjangoFilterBackend,)
-    queryset = SiteProfile .objects.all()
+    queryset = SiteProfile.objects.all()
     serializer_class = SiteProfileSerializer
 
 
@@ -152,7 +303,7 @@ class CountryViewSet(viewsets.ModelViewSet):
     serializer_class = CountrySerializer
 
 
-class AgreementViewSet(viewsets.ModelViewSet):
+class AgreementViewSet(FeedListMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`,
     `update` and `destroy` actions.
@@ -160,13 +311,6 @@ class AgreementViewSet(viewsets.ModelViewSet):
     limit to users logged in country permissions
     """
 
-    def list(self, request):
-        user_countries = get_country(request.user)
-        queryset = ProjectAgreement.objects.all().filter(
-            program__country__in=user_countries)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
-
     """
     def post(self,request):
 
@@ -181,10 +325,11 @@ class AgreementViewSet(viewsets.ModelViewSet):
     filter_backends = (django_filters.rest_framework.DjangoFilterBackend,)
     queryset = ProjectAgreement.objects.all()
     serializer_class = AgreementSerializer
-    pagination_class = SmallResultsSetPagination
+    country_lookup = 'program__country__in'
+    country_distinct = True
 
 
-class CompleteViewSet(viewsets.ModelViewSet):
+class CompleteViewSet(FeedListMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`,
     `update` and `destroy` actions.
@@ -192,21 +337,15 @@ class CompleteViewSet(viewsets.ModelViewSet):
     limit to users logged in country permissions
     """
 
-    def list(self, request):
-        user_countries = get_country(request.user)
-        queryset = ProjectComplete.objects.all().filter(
-            program__country__in=user_countries)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
-
     filter_fields = ('program__country__country', 'program__name')
     filter_backends = (django_filters.rest_framework.DjangoFilterBackend,)
     queryset = ProjectComplete.objects.all()
     serializer_class = CompleteSerializer
-    pagination_class = SmallResultsSetPagination
+    country_lookup = 'program__country__in'
+    country_distinct = True
 
 
-class IndicatorViewSet(viewsets.ModelViewSet):
+class IndicatorViewSet(FeedListMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`,
     `update` and `destroy` actions.
@@ -214,16 +353,12 @@ class IndicatorViewSet(viewsets.ModelViewSet):
     limit to users logged in country permissions
     """
 
-    def list(self, request):
-        user_countries = get_country(request.user)
-        queryset = Indicator.objects.all().filter(program__country__in=user_countries)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
-
     filter_fields = ('program__country__country', 'program__name')
     filter_backends = (django_filters.rest_framework.DjangoFilterBackend,)
     queryset = Indicator.objects.all()
     serializer_class = IndicatorSerializer
+    country_lookup = 'program__country__in'
+    country_distinct = True
 
 
 class ReportingFrequencyViewSet(viewsets.ModelViewSet):
@@ -294,7 +429,7 @@ class LevelViewSet(viewsets.ModelViewSet):
     serializer_class = LevelSerializer
 
 
-class StakeholderViewSet(viewsets.ModelViewSet):
+class StakeholderViewSet(FeedListMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`,
     `update` and `destroy` actions.
@@ -302,12 +437,6 @@ class StakeholderViewSet(viewsets.ModelViewSet):
     Limited to logged in users accessible countires
     """
 
-    def list(self, request):
-        user_countries = get_country(request.user)
-        queryset = Stakeholder.objects.all().filter(country__in=user_countries)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
-
     filter_fields = ('country__country',)
     filter_backends = (django_filters.rest_framework.DjangoFilterBackend,)
     queryset = Stakeholder.objects.all()
@@ -431,25 +560,19 @@ class DocumentationViewSet(viewsets.ModelViewSet):
     serializer_class = DocumentationSerializer
 
 
-class CollectedDataViewSet(viewsets.ModelViewSet):
+class CollectedDataViewSet(FeedListMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`,
     `update` and `destroy` actions.
     """
 
-    def list(self, request):
-        user_countries = get_country(request.user)
-        queryset = CollectedData.objects.all().filter(
-            program__country__in=user_countries)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
-
     filter_fields = ('indicator__program__country__country',
                      'indicator__program__name')
     filter_backends = (django_filters.rest_framework.DjangoFilterBackend,)
     queryset = CollectedData.objects.all()
     serializer_class = CollectedDataSerializer
-    pagination_class = SmallResultsSetPagination
+    country_lookup = 'program__country__in'
+    country_distinct = True
 
 
 class activitytableViewSet(viewsets.ModelViewSet):
@@ -464,7 +587,7 @@ class activitytableViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
     def get_queryset(self):
-        user_countries = get_country(self.request.user)
+        user_countries = get_country_ids(self.request.user)
         queryset = ActivityTable.objects.filter(country__in=user_countries)
         table_id = self.request.query_params.get('table_id', None)
         if table_id is not None:
@@ -478,23 +601,18 @@ class activitytableViewSet(viewsets.ModelViewSet):
     pagination_class = StandardResultsSetPagination
 
 
-class DisaggregationValueViewSet(viewsets.ModelViewSet):
+class DisaggregationValueViewSet(FeedListMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`,
     `update` and `destroy` actions.
     """
 
-    def list(self, request):
-        user_countries = get_country(request.user)
-        queryset = DisaggregationValue.objects.all().filter(country__in=user_countries)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
-
-    filter_fields = ('country__country', 'indicator__program__name')
+    filter_fields = ('disaggregation_label__disaggregation_type__country__country',
+                     'collecteddata__indicator__program__name')
     filter_backends = (django_filters.rest_framework.DjangoFilterBackend,)
     queryset = DisaggregationValue.objects.all()
     serializer_class = DisaggregationValueSerializer
-    pagination_class = StandardResultsSetPagination
+    country_lookup = 'disaggregation_label__disaggregation_type__country__in'
 
 # Returns a list of all project agreement and feed to Hikaya
 
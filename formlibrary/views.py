@@ -10,6 +10,7 @@ from .forms import TrainingAttendanceForm, BeneficiaryForm, DistributionForm
 from workflow.models import FormGuidance, Program, ProjectAgreement
 from django.utils.decorators import method_decorator
 from activity.util import get_country, group_excluded
+from activity.responses import json_lists_response
 
 from django.shortcuts import render
 from django.contrib import messages
@@ -421,11 +422,7 @@ class TrainingListObjects(View, AjaxableResponseMixin):
                                                                    project_agreement_id=project_id).values(
                 'id', 'create_date', 'training_name', 'project_agreement__project_name')
 
-        get_training = json.dumps(list(get_training), cls=DjangoJSONEncoder)
-
-        final_dict = {'get_training': get_training}
-
-        return JsonResponse(final_dict, safe=False)
+        return json_lists_response(request, {'get_training': get_training})
 
 
 class BeneficiaryListObjects(View, AjaxableResponseMixin):
@@ -447,12 +444,7 @@ class BeneficiaryListObjects(View, AjaxableResponseMixin):
                 program__id=program_id,
                 training__project_agreement=project_id).values('id', 'beneficiary_name', 'create_date')
 
-        get_beneficiaries = json.dumps(
-            list(get_beneficiaries), cls=DjangoJSONEncoder)
-
-        final_dict = {'get_beneficiaries': get_beneficiaries}
-
-        return JsonResponse(final_dict, safe=False)
+        return json_lists_response(request, {'get_beneficiaries': get_beneficiaries})
 
 
 class DistributionListObjects(View, AjaxableResponseMixin):
@@ -473,12 +465,7 @@ class DistributionListObjects(View, AjaxableResponseMixin):
                 program_id=program_id,
                 initiation_id=project_id).values('id', 'distribution_name', 'create_date', 'program')
 
-        get_distribution = json.dumps(
-            list(get_distribution), cls=DjangoJSONEncoder)
-
-        final_dict = {'get_distribution': get_distribution}
-
-        return JsonResponse(final_dict, safe=False)
+        return json_lists_response(request, {'get_distribution': get_distribution})
 
 
 # program and project & training filters
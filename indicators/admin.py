@@ -94,6 +94,8 @@ admin.site.register(StrategicObjective, StrategicObjectiveAdmin)
 admin.site.register(Level)
 admin.site.register(ExternalService, ExternalServiceAdmin)
 admin.site.register(ExternalServiceRecord, ExternalServiceRecordAdmin)
+admin.site.register(ExternalIndicator, ExternalIndicatorAdmin)
 admin.site.register(ActivityTable, activitytableAdmin)
 admin.site.register(DataCollectionFrequency)
 admin.site.register(PeriodicTarget, PeriodicTargetAdmin)
+admin.site.register(IndicatorRollup, IndicatorRollupAdmin)
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection, transaction
+
+
+def add_batch_arguments(parser, batch_size=500):
+    """
+    Options shared by the commands that run on BatchRunner
+    """
+    parser.add_argument('--batch_size', type=int, default=batch_size,
+                        help='indicators per batch, each batch is committed on its own')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='batches processed in parallel, each worker has its own database connection')
+    parser.add_argument('--checkpoint', action='store',
+                        help='file recording the finished indicators, a rerun with the same file skips them')
+
+
+class BatchRunner(object):
+    """
+    Run a bulk operation over a list of indicator ids, a batch at a time.
+    Each batch commits in its own transaction and, with a checkpoint file,
+    is recorded once committed so an interrupted run can be resumed
+    """
+
+    def __init__(self, command, batch_size=500, workers=1, checkpoint=None):
+        """
+        :param command: management command, progress is written to its stdout
+        :param batch_size: ids per batch
+        :param workers: number of threads processing batches
+        :param checkpoint: path of the checkpoint file
+        """
+        self.command = command
+        self.batch_size = max(batch_size, 1)
+        self.workers = max(workers, 1)
+        self.checkpoint = checkpoint
+        self.totals = {}
+        self.total = 0
+        self.processed = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_options(cls, command, options):
+        return cls(command, batch_size=options['batch_size'], workers=options['workers'],
+                   checkpoint=options['checkpoint'])
+
+    def finished_ids(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return set()
+        with open(self.checkpoint) as checkpoint:
+            return set(int(line) for line in checkpoint if line.strip())
+
+    def run(self, ids, process):
+        """
+        :param ids: indicator ids to process
+        :param process: callable taking a list of ids and returning a dict of
+            counts, called inside the batch transaction
+        :return: dict of the counts summed over every batch
+        """
+        finished = self.finished_ids()
+        ids = sorted(set(ids) - finished)
+        if finished:
+            self.command.stdout.write(self.command.style.WARNING(
+                'resuming, %s indicators already processed' % len(finished)))
+        batches = [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+
+        self.total = len(ids)
+        self.started = time.time()
+        if self.workers == 1:
+            for batch in batches:
+                self.run_batch(process, batch)
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # list() re-raises the first exception of a worker
+                list(executor.map(lambda batch: self.run_threaded_batch(process, batch), batches))
+        return self.totals
+
+    def run_threaded_batch(self, process, batch):
+        try:
+            self.run_batch(process, batch)
+        finally:
+            # each thread opened its own connection
+            connection.close()
+
+    def run_batch(self, process, batch):
+        with transaction.atomic():
+            counts = process(batch)
+        with self._lock:
+            if self.checkpoint:
+                with open(self.checkpoint, 'a') as checkpoint:
+                    checkpoint.write(''.join('%s\n' % pk for pk in batch))
+            for key, value in (counts or {}).items():
+                self.totals[key] = self.totals.get(key, 0) + value
+            self.processed += len(batch)
+            elapsed = max(time.time() - self.started, 0.001)
+            self.command.stdout.write('%s/%s indicators, %.0f indicators/s' % (
+                self.processed, self.total, self.processed / elapsed))
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from indicators.models import CollectedData, IndicatorRollup, periodic_target_index
+
+
+class Command(BaseCommand):
+    help = """
+        Link collected data records without a periodic target to the target whose start and end
+        dates hold their collection date. Records saved from now on are linked on save, run this
+        once to repair the existing ones.
+        usage: manage.py assign_periodic_targets [--program_id 1 2] [--batch_size 1000] [--dry-run]
+        """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--program_id', nargs='+', type=int)
+        parser.add_argument('--batch_size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            help='count the records that would be linked without saving them')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        rows = CollectedData.objects.filter(
+            periodic_target__isnull=True, date_collected__isnull=False, indicator__isnull=False,
+            indicator__periodictarget__start_date__isnull=False).distinct()
+        if options['program_id']:
+            rows = rows.filter(indicator__program__in=options['program_id'])
+            self.stdout.write(self.style.WARNING(
+                'assigning periodic targets for program_id = "%s"' % options['program_id']))
+
+        # only the fields the index reads, the related lookups of the manager are not needed
+        rows = rows.select_related(None).prefetch_related(None).order_by('indicator_id', 'id')\
+            .only('id', 'indicator_id', 'periodic_target_id', 'date_collected').iterator(chunk_size=batch_size)
+
+        checked = 0
+        indicator_ids = set()
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            checked += len(batch)
+            assigned = periodic_target_index.assign(batch)
+            indicator_ids.update(row.indicator_id for row in assigned)
+            if assigned and not options['dry_run']:
+                with transaction.atomic():
+                    CollectedData.objects.bulk_update(assigned, ['periodic_target'])
+            self.stdout.write('%s records checked, %s linked in this batch' % (checked, len(assigned)))
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(
+                'dry run, records of %s indicators would be linked' % len(indicator_ids)))
+            return
+
+        # bulk updates skip the save signals
+        for indicator_id in indicator_ids:
+            IndicatorRollup.objects.refresh(indicator_id)
+        self.stdout.write(self.style.SUCCESS(
+            'periodic targets assigned for %s indicators' % len(indicator_ids)))
@@ -3,17 +3,23 @@
 
 import dateutil.parser
 import csv
+import time
 from time import strptime
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
 from indicators.models import *
 from indicators.views import generate_periodic_targets
+from activity.util import bulk_update_with_history
+
+INDICATOR_TARGET_FIELDS = ['target_frequency', 'target_frequency_start', 'target_frequency_num_periods', 'edit_date']
 
 
 class Command(BaseCommand):
     help = """
         Setup targets for indicators by reading a CSV file
+        usage: manage.py create_targets -f targets.csv [--bulk [--batch_size 200]] [--dry-run]
         """
 
     def add_arguments(self, parser):
@@ -22,152 +28,238 @@ class Command(BaseCommand):
         """
         parser.add_argument('-f', '--file', action='store',
                             nargs='?', required=True, dest='filepath')
+        parser.add_argument('--bulk', action='store_true',
+                            help='load all indicators at once and insert the targets in bulk')
+        parser.add_argument('--batch_size', type=int, default=200,
+                            help='indicators written per transaction in bulk mode')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            help='check the file and count the targets without saving them')
 
     def handle(self, *args, **options):
         file = options['filepath']
         self.stdout.write(self.style.WARNING(
             'creating targetes for indicators from = "%s"' % file))
 
-        with open(file, 'rb') as csvfile:
+        with open(file, newline='') as csvfile:
             indicatorcsv_reader = csv.reader(csvfile)
             # This skips the first row (header) of the CSV file.
             next(indicatorcsv_reader)
+            rows = [parsed for parsed in map(self.parse_row, indicatorcsv_reader) if parsed]
 
-            for row in indicatorcsv_reader:
-                indicator_id = row[0].strip()
-                target_frequency = row[4].strip()
-                month_name = row[5].strip()
-                year = row[6].strip()
-                num_targets = row[7].strip()
-                target_frequency_start = None
-
-                # lookup target_frequency index:
-                target_frequency_id = next((i for i, v in enumerate(
-                    Indicator.TARGET_FREQUENCIES) if v[1] == target_frequency), None)
-                if target_frequency_id is None:
-                    self.stdout.write(self.style.ERROR(
-                        '%s, invalid target_frequency = %s' % (indicator_id, target_frequency)))
-                    continue
-                else:
-                    target_frequency_id += 1
+        if options['bulk'] or options['dry_run']:
+            self.create_bulk(rows, options['batch_size'], options['dry_run'])
+            return
 
-                # make sure month is valid
-                try:
-                    month = strptime(month_name, '%B').tm_mon
-                except ValueError as e:
-                    self.stdout.write(self.style.ERROR(
-                        '%s, invalid month = %s' % (indicator_id, month_name)))
-                    continue
+        for indicator_id, target_frequency_id, target_frequency_start, num_targets in rows:
+            # Fetch the indicator
+            try:
+                indicator = Indicator.objects.get(pk=indicator_id)
+            except Indicator.DoesNotExist as e:
+                self.stdout.write(self.style.ERROR(
+                    '%s, indicator does not exist!' % indicator_id))
+                continue
 
-                # make sure year is valid
+            for ptarget in self.build_targets(indicator, target_frequency_id, target_frequency_start, num_targets):
                 try:
-                    year = float(year) if '.' in year else int(year)
-                except ValueError as e:
+                    ptarget.save()
+                except Exception as e:
                     self.stdout.write(self.style.ERROR(
-                        '%s, invalid year = %s' % (indicator_id, year)))
-                    continue
+                        '%s, --- could not create target (%s)' % (indicator.id, ptarget.period)))
+
+            try:
+                PeriodicTarget.objects.assign_collected_data([indicator.id])
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(
+                    '%s, could not associate data records for the periodic targets' % indicator.id))
+
+            try:
+                self.set_target_frequency(indicator, target_frequency_id, target_frequency_start, num_targets)
+                indicator.save()
+                IndicatorRollup.objects.refresh(indicator.id)
+                self.stdout.write(self.style.SUCCESS(
+                    '%s, processed successfully.' % indicator.id))
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(
+                    '%s, failed to save indicator: %s' % (indicator.id, e)))
+
+    def parse_row(self, row):
+        """
+        :return: tuple of (indicator_id, target_frequency_id, target_frequency_start, num_targets),
+            None when the row is not valid
+        """
+        indicator_id = row[0].strip()
+        target_frequency = row[4].strip()
+        month_name = row[5].strip()
+        year = row[6].strip()
+        num_targets = row[7].strip()
+        target_frequency_start = None
+
+        try:
+            indicator_id = int(indicator_id)
+        except ValueError as e:
+            self.stdout.write(self.style.ERROR(
+                '%s, invalid indicator id' % indicator_id))
+            return None
+
+        # lookup target_frequency index:
+        target_frequency_id = next((i for i, v in enumerate(
+            Indicator.TARGET_FREQUENCIES) if v[1] == target_frequency), None)
+        if target_frequency_id is None:
+            self.stdout.write(self.style.ERROR(
+                '%s, invalid target_frequency = %s' % (indicator_id, target_frequency)))
+            return None
+        else:
+            target_frequency_id += 1
+
+        # make sure month is valid
+        try:
+            month = strptime(month_name, '%B').tm_mon
+        except ValueError as e:
+            self.stdout.write(self.style.ERROR(
+                '%s, invalid month = %s' % (indicator_id, month_name)))
+            return None
+
+        # make sure year is valid
+        try:
+            year = float(year) if '.' in year else int(year)
+        except ValueError as e:
+            self.stdout.write(self.style.ERROR(
+                '%s, invalid year = %s' % (indicator_id, year)))
+            return None
+
+        # make sure num_targets is valid
+        try:
+            num_targets = float(
+                num_targets) if '.' in num_targets else int(num_targets)
+        except ValueError as e:
+            self.stdout.write(self.style.ERROR(
+                '%s, invalid num_targets = %s' % (indicator_id, num_targets)))
+            return None
+
+        try:
+            target_frequency_start = datetime.strptime(
+                '%s-%s-%s' % (year, month, '01'), '%Y-%m-%d')
+        except ValueError as e:
+            self.stdout.write(self.style.ERROR('%s, %s target_frequency_start date parse error' % (
+                indicator_id, target_frequency_start)))
+            return None
+
+        return indicator_id, target_frequency_id, target_frequency_start, num_targets
 
-                # make sure num_targets is valid
+    def build_targets(self, indicator, target_frequency_id, target_frequency_start, num_targets):
+        """
+        Generate the periodic targets of an indicator in memory
+        :return: list of unsaved PeriodicTarget
+        """
+        targets = []
+        generated_targets = generate_periodic_targets(
+            target_frequency_id, target_frequency_start, num_targets, None)
+
+        for i, pt in enumerate(generated_targets):
+            try:
+                start_date = dateutil.parser.parse(
+                    pt.get('start_date', None)).date()
+            except (ValueError, AttributeError, TypeError):
+                start_date = None
+
+            try:
+                end_date = dateutil.parser.parse(
+                    pt.get('end_date', None)).date()
+            except (ValueError, AttributeError, TypeError) as e:
+                end_date = None
+
+            if target_frequency_id == Indicator.LOP:
+                period = Indicator.TARGET_FREQUENCIES[0][1]
+            else:
                 try:
-                    num_targets = float(
-                        num_targets) if '.' in num_targets else int(num_targets)
-                except ValueError as e:
+                    period = pt.get('period', None)
+                except AttributeError as e:
                     self.stdout.write(self.style.ERROR(
-                        '%s, invalid num_targets = %s' % (indicator_id, num_targets)))
+                        '%s, --- no period' % indicator.id))
                     continue
 
-                # Fetch the indicator
+            if target_frequency_id == Indicator.LOP:
+                target_value = indicator.lop_target
+            else:
                 try:
-                    indicator = Indicator.objects.get(pk=indicator_id)
-                except Indicator.DoesNotExist as e:
+                    target_value = pt.get('target', '0')
+                except AttributeError as e:
                     self.stdout.write(self.style.ERROR(
-                        '%s, indicator does not exist!' % indicator_id))
-                    continue
+                        '%s, --- there is no target for this period (%s)' % (indicator.id, period)))
 
-                try:
-                    target_frequency_start = datetime.strptime(
-                        '%s-%s-%s' % (year, month, '01'), '%Y-%m-%d')
-                except ValueError as e:
-                    self.stdout.write(self.style.ERROR('%s, %s target_frequency_start date parse error' % (
-                        indicator_id, target_frequency_start)))
-                    continue
+            try:
+                target = float(target_value) if '.' in target_value else int(
+                    target_value)
+            except ValueError as e:
+                self.stdout.write(self.style.ERROR(
+                    '%s, --- target is not a numeric value (%s)' % (indicator.id, target_value)))
+                continue
 
-                generated_targets = generate_periodic_targets(
-                    target_frequency_id, target_frequency_start, num_targets, None)
-
-                for i, pt in enumerate(generated_targets):
-                    try:
-                        start_date = dateutil.parser.parse(
-                            pt.get('start_date', None))
-                        start_date = datetime.strftime(start_date, '%Y-%m-%d')
-                    except (ValueError, AttributeError):
-                        start_date = None
-
-                    try:
-                        end_date = dateutil.parser.parse(
-                            pt.get('end_date', None))
-                        end_date = datetime.strftime(end_date, '%Y-%m-%d')
-                    except (ValueError, AttributeError) as e:
-                        end_date = None
-
-                    if target_frequency_id == Indicator.LOP:
-                        period = Indicator.TARGET_FREQUENCIES[0][1]
-                    else:
-                        try:
-                            period = pt.get('period', None)
-                        except AttributeError as e:
-                            self.stdout.write(self.style.ERROR(
-                                '%s, --- no period' % indicator.id))
-                            continue
-
-                    if target_frequency_id == Indicator.LOP:
-                        target_value = indicator.lop_target
-                    else:
-                        try:
-                            target_value = pt.get('target', '0')
-                        except AttributeError as e:
-                            self.stdout.write(self.style.ERROR(
-                                '%s, --- there is no target for this period (%s)' % (indicator.id, period)))
-
-                    try:
-                        target = float(target_value) if '.' in target_value else int(
-                            target_value)
-                    except ValueError as e:
-                        self.stdout.write(self.style.ERROR(
-                            '%s, --- target is not a numeric value (%s)' % (indicator.id, target_value)))
-                        continue
-
-                    try:
-                        ptarget = PeriodicTarget.objects.create(
-                            indicator=indicator,
-                            period=period,
-                            target=target,
-                            customsort=i,
-                            start_date=start_date,
-                            end_date=end_date,
-                            create_date=timezone.now())
-                    except Exception as e:
-                        self.stdout.write(self.style.ERROR(
-                            '%s, --- could not create target (%s)' % (indicator.id, period)))
-                        continue
-
-                    try:
-                        CollectedData.objects.filter(indicator=indicator,
-                                                     date_collected__range=[ptarget.start_date, ptarget.end_date])\
-                            .update(periodic_target=ptarget)
-                    except Exception as e:
-                        self.stdout.write(self.style.ERROR(
-                            '%s, could not associate data records for periodic_target (%s)' % (indicator.id,
-                                                                                               ptarget.period)))
+            targets.append(PeriodicTarget(
+                indicator=indicator,
+                period=period,
+                target=target,
+                customsort=i,
+                start_date=start_date,
+                end_date=end_date,
+                create_date=timezone.now()))
+        return targets
 
-                try:
-                    indicator.target_frequency = target_frequency_id
-                    if target_frequency_id != Indicator.LOP:
-                        indicator.target_frequency_start = target_frequency_start
-                        indicator.target_frequency_num_periods = num_targets
-                    indicator.save()
-                    self.stdout.write(self.style.SUCCESS(
-                        '%s, processed successfully.' % indicator.id))
-                except Exception as e:
-                    self.stdout.write(self.style.ERROR(
-                        '%s, failed to save indicator: %s' % (indicator.id, e)))
+    def set_target_frequency(self, indicator, target_frequency_id, target_frequency_start, num_targets):
+        indicator.target_frequency = target_frequency_id
+        if target_frequency_id != Indicator.LOP:
+            indicator.target_frequency_start = target_frequency_start
+            indicator.target_frequency_num_periods = num_targets
+
+    def create_bulk(self, rows, batch_size, dry_run=False):
+        """
+        Load every indicator of the file in one query, build all the targets in
+        memory and write them with bulk inserts, batch_size indicators per transaction
+        """
+        indicators = Indicator.objects.select_related(None).prefetch_related(None)\
+            .in_bulk(set(row[0] for row in rows))
+        work = []
+        for indicator_id, target_frequency_id, target_frequency_start, num_targets in rows:
+            indicator = indicators.get(indicator_id)
+            if indicator is None:
+                self.stdout.write(self.style.ERROR(
+                    '%s, indicator does not exist!' % indicator_id))
+                continue
+            self.set_target_frequency(indicator, target_frequency_id, target_frequency_start, num_targets)
+            work.append((indicator, self.build_targets(
+                indicator, target_frequency_id, target_frequency_start, num_targets)))
+
+        total = sum(len(targets) for indicator, targets in work)
+        if dry_run:
+            self.stdout.write(self.style.SUCCESS(
+                'dry run, %s targets would be created for %s indicators' % (total, len(work))))
+            return
+
+        started = time.time()
+        created = 0
+        for start in range(0, len(work), batch_size):
+            batch = work[start:start + batch_size]
+            indicator_ids = [indicator.id for indicator, targets in batch]
+            with transaction.atomic():
+                PeriodicTarget.objects.bulk_create(
+                    [target for indicator, targets in batch for target in targets], batch_size=1000)
+                self.update_indicators([indicator for indicator, targets in batch])
+                PeriodicTarget.objects.assign_collected_data(indicator_ids)
+                # bulk writes skip the save signals
+                IndicatorRollup.objects.rebuild(indicator__in=indicator_ids)
+            for indicator_id in indicator_ids:
+                periodic_target_index.invalidate(indicator_id)
+
+            created += sum(len(targets) for indicator, targets in batch)
+            elapsed = max(time.time() - started, 0.001)
+            self.stdout.write('%s/%s indicators, %s/%s targets, %.0f targets/s' % (
+                start + len(batch), len(work), created, total, created / elapsed))
+
+        self.stdout.write(self.style.SUCCESS(
+            '%s targets created for %s indicators in %.1fs' % (created, len(work), time.time() - started)))
+
+    def update_indicators(self, indicators):
+        now = timezone.now()
+        for indicator in indicators:
+            indicator.edit_date = now
+        bulk_update_with_history(indicators, Indicator, INDICATOR_TARGET_FIELDS, reason='create_targets')
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+from indicators.models import Indicator, Level
+from workflow.models import Program
+
+KPI_LEVEL = "Impact"
+
+
+class Command(BaseCommand):
+    help = """
+        Flag the Impact level indicators of every program without a key performance indicator
+        as key performance indicators. Programs that already have one are left as they are,
+        so it is safe to run nightly.
+        usage: manage.py flag_kpi_indicators [--country_id 1 2] [--dry-run]
+        """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--country_id', nargs='+', type=int)
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            help='list the programs and count the indicators without updating them')
+
+    def handle(self, *args, **options):
+        if not Level.objects.filter(name=KPI_LEVEL).exists():
+            self.stdout.write(self.style.ERROR('there is no "%s" level' % KPI_LEVEL))
+            return
+
+        programs = Program.objects.all()
+        if options['country_id']:
+            programs = programs.filter(country__in=options['country_id'])
+            self.stdout.write(self.style.WARNING(
+                'setting KPI for country_id = "%s"' % options['country_id']))
+
+        # one grouped query for the programs without a KPI indicator
+        programs = programs.order_by().annotate(
+            kpi_count=Count('indicator', filter=Q(indicator__key_performance_indicator=True), distinct=True))\
+            .filter(kpi_count=0)
+        indicators = Indicator.objects.filter(
+            program__in=programs.values('id'), level__name=KPI_LEVEL, key_performance_indicator=False)
+
+        if options['dry_run']:
+            for program in programs.values_list('name', flat=True):
+                self.stdout.write(program)
+            self.stdout.write(self.style.SUCCESS(
+                'dry run, %s indicators would be flagged as KPI' % indicators.distinct().count()))
+            return
+
+        count = Indicator.objects.filter(id__in=indicators.values('id')).update(key_performance_indicator=True)
+        self.stdout.write(self.style.SUCCESS(
+            '%s indicators flagged as KPI' % count))
@@ -2,7 +2,10 @@
 # -*- coding: utf-8 -*-
 
 from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
 from indicators.models import *
+from indicators.batch import BatchRunner, add_batch_arguments
+from activity.util import bulk_update_with_history
 from django.utils import timezone
 
 
@@ -14,10 +17,12 @@ class Command(BaseCommand):
             2.1. Set target frequency to "Life of Program only".
             2.2. Save this target frequency even if other required fields have errors or are incomplete.
             2.2. Assign all data records to the Life of Program target.'
+        Indicators are processed in batches, see --batch_size, --workers and --checkpoint.
         """
 
     def add_arguments(self, parser):
         parser.add_argument('--program_id', nargs='+', type=int)
+        add_batch_arguments(parser)
 
     def handle(self, *args, **options):
         for option in options['program_id'] or []:
@@ -30,44 +35,60 @@ class Command(BaseCommand):
         else:
             indicators = Indicator.objects.all()  # filter(program = 452)
 
-        for ind in indicators:
-            collecteddata_count = ind.collecteddata_set.all().count()
-            if collecteddata_count == 0:
-                ind.periodictarget_set.all().delete()
-                self.stdout.write(self.style.SUCCESS(
-                    "%s, only deleted periodic_targets because data count is %s" % (ind.id, collecteddata_count)))
-            else:
-                try:
-                    # disassociate collected_data records of this indicator with existing periodic targets
-                    ind.collecteddata_set.update(periodic_target=None)
+        ids = indicators.order_by().values_list('id', flat=True).distinct()
+        totals = BatchRunner.from_options(self, options).run(ids, self.convert_to_lop)
+        self.stdout.write(self.style.SUCCESS(
+            '%s indicators set to LOP, %s without data only had their periodic_targets deleted, %s failed' % (
+                totals.get('converted', 0), totals.get('without_data', 0), totals.get('failed', 0))))
 
-                    # remove all existing periodic targets
-                    ind.periodictarget_set.all().delete()
+    def convert_to_lop(self, ids):
+        """
+        Give every indicator of the batch with data a single LOP target and
+        link all its collected data to it, a fixed number of queries per batch
+        """
+        with_data = set(CollectedData.objects.filter(indicator_id__in=ids)
+                        .order_by().values_list('indicator_id', flat=True).distinct())
+        indicators = Indicator.objects.select_related(None).prefetch_related(None)\
+            .filter(id__in=with_data).order_by('id')
+
+        converted = []
+        for ind in indicators:
+            try:
+                # just checking to see if lop_target is a numeric value;
+                # if it is not then exception will be raised.
+                float(ind.lop_target)
+                converted.append(ind)
+            except (TypeError, ValueError) as e:
+                self.stdout.write(self.style.ERROR(
+                    '%s, LOP [%s] is missing or not numeric.' % (ind.id, ind.lop_target)))
+        converted_ids = [ind.id for ind in converted]
+        without_data = [pk for pk in ids if pk not in with_data]
 
-                    # just checking to see if lop_target is a numeric value;
-                    # if it is not then exception will be raised.
-                    lop = float(ind.lop_target)
+        now = timezone.now()
+        with periodic_target_signals_deferred():
+            # disassociate collected_data records with existing periodic targets, then remove them
+            CollectedData.objects.filter(indicator_id__in=converted_ids).update(periodic_target=None)
+            PeriodicTarget.objects.filter(indicator_id__in=without_data + converted_ids).delete()
 
-                    # create a "Life of Program (LOP) Only" target
-                    lop_pt = PeriodicTarget.objects.create(
-                        indicator=ind,
-                        period=ind.TARGET_FREQUENCIES[0][1],
-                        target=ind.lop_target,
-                        create_date=timezone.now())
+            # create a "Life of Program (LOP) Only" target per indicator
+            PeriodicTarget.objects.bulk_create([
+                PeriodicTarget(indicator=ind, period=Indicator.TARGET_FREQUENCIES[0][1],
+                               target=ind.lop_target, create_date=now)
+                for ind in converted])
 
-                    # associate all collected_data records of this indicator with the newly created
-                    # "Life of Program (LOP) Only" target
-                    ind.collecteddata_set.update(periodic_target=lop_pt)
+        # associate all collected_data records with the LOP target of their indicator
+        CollectedData.objects.filter(indicator_id__in=converted_ids).update(
+            periodic_target=Subquery(PeriodicTarget.objects.filter(
+                indicator_id=OuterRef('indicator_id')).order_by('id').values('id')[:1]))
 
-                    # set the target_frequency of this indicator to "Life of Program (LOP) Only" target
-                    ind.target_frequency = Indicator.LOP
-                    ind.save()
+        # set the target_frequency of these indicators to "Life of Program (LOP) Only" target
+        for ind in converted:
+            ind.target_frequency = Indicator.LOP
+            ind.edit_date = now
+        bulk_update_with_history(converted, Indicator, ['target_frequency', 'edit_date'], reason='lop')
 
-                    self.stdout.write(self.style.SUCCESS(
-                        '%s, Processed successfully.' % ind.id))
-                except ValueError as e:
-                    self.stdout.write(self.style.ERROR(
-                        '%s, LOP [%s] is missing or not numeric.' % (ind.id, ind.lop_target)))
-                except Exception as e:
-                    self.stdout.write(self.style.ERROR(
-                        "%s, Error occured: %s" % (ind.id, e)))
+        IndicatorRollup.objects.rebuild(indicator__in=converted_ids)
+        for pk in without_data + converted_ids:
+            periodic_target_index.invalidate(pk)
+        return {'converted': len(converted), 'without_data': len(without_data),
+                'failed': len(with_data) - len(converted)}
@@ -0,0 +1,30 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from indicators.models import IndicatorRollup
+
+
+class Command(BaseCommand):
+    help = """
+        Rebuild the precomputed indicator rollup table from the collected data records.
+        The table is kept up to date on save, run this after bulk loads or direct SQL updates.
+        usage: manage.py rebuild_indicator_rollup [--program_id 1 2]
+        """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--program_id', nargs='+', type=int)
+
+    def handle(self, *args, **options):
+        filters = {}
+        if options['program_id']:
+            filters['indicator__program__in'] = options['program_id']
+            self.stdout.write(self.style.WARNING(
+                'rebuilding indicator rollup for program_id = "%s"' % options['program_id']))
+        else:
+            self.stdout.write(self.style.WARNING(
+                'rebuilding indicator rollup for all indicators'))
+
+        count = IndicatorRollup.objects.rebuild(**filters)
+        self.stdout.write(self.style.SUCCESS(
+            '%s rollup rows written' % count))
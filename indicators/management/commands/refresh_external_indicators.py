@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import requests
+from django.core.management.base import BaseCommand
+from activity.external import external_data
+from indicators.models import ExternalService, ExternalIndicator
+
+
+class Command(BaseCommand):
+    help = """
+        Mirror the indicator feeds of the external services in the ExternalIndicator table.
+        The feeds are requested with the ETag and Last-Modified date of the last refresh and an
+        unmodified feed is not downloaded again, schedule it with cron. The old responses of the
+        external data cache are deleted at the end.
+        usage: manage.py refresh_external_indicators [--service_id 1 2] [--force]
+        """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--service_id', nargs='+', type=int)
+        parser.add_argument('--force', action='store_true', dest='force', default=False,
+                            help='download the feeds even when they are not modified')
+
+    def handle(self, *args, **options):
+        services = ExternalService.objects.exclude(feed_url='')
+        if options['service_id']:
+            services = services.filter(id__in=options['service_id'])
+
+        for service in services:
+            try:
+                counts = ExternalIndicator.objects.refresh(service, force=options['force'])
+            except (requests.RequestException, ValueError, KeyError) as e:
+                self.stderr.write(self.style.ERROR('%s: %s' % (service, e)))
+                continue
+            if counts is None:
+                self.stdout.write('%s: not modified' % service)
+            else:
+                self.stdout.write(self.style.SUCCESS(
+                    '%s: %s created, %s updated, %s deleted' % ((service,) + counts)))
+
+        deleted = external_data.prune()
+        if deleted:
+            self.stdout.write('%s old cached responses deleted' % deleted)
@@ -4,12 +4,17 @@
 import csv
 from django.core.management.base import BaseCommand
 from indicators.models import *
+from indicators.batch import BatchRunner, add_batch_arguments
+from activity.util import bulk_update_with_history
+
+INDICATOR_FIELDS = ['unit_of_measure', 'lop_target', 'baseline', 'baseline_na', 'edit_date']
 
 
 class Command(BaseCommand):
     help = """
         Update lop, unit_of_measure, and baseline values of indicators based on a csv file
         usage: sudo py -W ignore  manage.py update_indicators -f ~/country_data.csv
+        Indicators are processed in batches, see --batch_size, --workers and --checkpoint.
         """
 
     def add_arguments(self, parser):
@@ -18,59 +23,83 @@ class Command(BaseCommand):
         """
         parser.add_argument('-f', '--file', action='store',
                             nargs='?', required=True, dest='filepath')
+        add_batch_arguments(parser)
 
     def handle(self, *args, **options):
         file = options['filepath']
         self.stdout.write(self.style.WARNING(
             'reading indicators info from: "%s"' % file))
 
-        with open(file, 'rb') as csvfile:
+        self.values = {}
+        with open(file, newline='') as csvfile:
             indicatorcsv_reader = csv.reader(csvfile)
             # This skips the first row (header) of the CSV file.
             next(indicatorcsv_reader)
             for row in indicatorcsv_reader:
-                indicator_id = row[0]
-                unit_of_measure = row[4]
-                lop = row[5].replace(',', '')
-                baseline = row[6].replace(',', '')
-                baseline_na = False
-                try:
-                    lop = float(lop) if '.' in lop else int(lop)
-                except ValueError as e:
-                    self.stdout.write(self.style.ERROR(
-                        '%s, invalid lop (%s)' % (indicator_id, lop)))
-                    continue
+                values = self.parse_row(row)
+                if values:
+                    # the last row of an indicator wins, as it did row by row
+                    self.values[values['id']] = values
+
+        totals = BatchRunner.from_options(self, options).run(self.values, self.update_indicators)
+        self.stdout.write(self.style.SUCCESS(
+            '%s indicators updated successfully' % totals.get('updated', 0)))
+
+    def parse_row(self, row):
+        """
+        :return: dict of the indicator id and its new values, None when the row is not valid
+        """
+        indicator_id = row[0]
+        unit_of_measure = row[4]
+        lop = row[5].replace(',', '')
+        baseline = row[6].replace(',', '')
+        baseline_na = False
+        try:
+            indicator_id = int(indicator_id)
+        except ValueError as e:
+            self.stdout.write(self.style.ERROR(
+                '%s, does not exist!' % indicator_id))
+            return None
+
+        try:
+            lop = float(lop) if '.' in lop else int(lop)
+        except ValueError as e:
+            self.stdout.write(self.style.ERROR(
+                '%s, invalid lop (%s)' % (indicator_id, lop)))
+            return None
+
+        try:
+            baseline = float(
+                baseline) if '.' in baseline else int(baseline)
+        except ValueError as e:
+            if baseline and baseline.lower() == 'na' or baseline.lower() == 'n/a' or \
+                    baseline.lower() == 'not applicable':
+                baseline_na = True
+            else:
+                self.stdout.write(self.style.ERROR(
+                    '%s, invalid baseline (%s)' % (indicator_id, baseline)))
+                return None
 
-                try:
-                    baseline = float(
-                        baseline) if '.' in baseline else int(baseline)
-                except ValueError as e:
-                    if baseline and baseline.lower() == 'na' or baseline.lower() == 'n/a' or \
-                            baseline.lower() == 'not applicable':
-                        baseline_na = True
-                    else:
-                        self.stdout.write(self.style.ERROR(
-                            '%s, invalid baseline (%s)' % (indicator_id, baseline)))
-                        continue
+        return {'id': indicator_id, 'unit_of_measure': unit_of_measure, 'lop': lop,
+                'baseline': baseline, 'baseline_na': baseline_na}
 
-                try:
-                    indicator = Indicator.objects.get(pk=indicator_id)
-                except Indicator.DoesNotExist as e:
-                    self.stdout.write(self.style.ERROR(
-                        '%s, does not exist!' % indicator_id))
-                    continue
+    def update_indicators(self, ids):
+        indicators = Indicator.objects.select_related(None).prefetch_related(None).in_bulk(ids)
+        for indicator_id in ids:
+            if indicator_id not in indicators:
+                self.stdout.write(self.style.ERROR(
+                    '%s, does not exist!' % indicator_id))
 
-                try:
-                    indicator.unit_of_measure = unit_of_measure
-                    indicator.lop_target = lop
-                    if baseline_na:
-                        indicator.baseline = None
-                        indicator.baseline_na = True
-                    else:
-                        indicator.baseline = baseline
-                    indicator.save()
-                    self.stdout.write(self.style.SUCCESS(
-                        "%s, updated successfully" % indicator.id))
-                except Exception as e:
-                    self.stdout.write(self.style.ERROR(
-                        '%s, failed to save!' % indicator.id))
+        now = timezone.now()
+        for indicator in indicators.values():
+            values = self.values[indicator.id]
+            indicator.unit_of_measure = values['unit_of_measure']
+            indicator.lop_target = values['lop']
+            if values['baseline_na']:
+                indicator.baseline = None
+                indicator.baseline_na = True
+            else:
+                indicator.baseline = values['baseline']
+            indicator.edit_date = now
+        bulk_update_with_history(list(indicators.values()), Indicator, INDICATOR_FIELDS, reason='update_indicators')
+        return {'updated': len(indicators)}
@@ -0,0 +1,49 @@
+# Generated by Django 2.2 on 2026-10-17 18:26
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def build_indicator_rollup(apps, schema_editor):
+    CollectedData = apps.get_model('indicators', 'CollectedData')
+    IndicatorRollup = apps.get_model('indicators', 'IndicatorRollup')
+    aggregates = CollectedData.objects.filter(indicator__isnull=False).order_by()\
+        .values('indicator', 'program', 'periodic_target')\
+        .annotate(targets=Sum('periodic_target__target'), actuals=Sum('achieved'), data_count=Count('id'))
+    edit_date = timezone.now()
+    IndicatorRollup.objects.bulk_create([
+        IndicatorRollup(indicator_id=row['indicator'], program_id=row['program'],
+                        periodic_target_id=row['periodic_target'], target_total=row['targets'],
+                        actual_total=row['actuals'], data_count=row['data_count'], edit_date=edit_date)
+        for row in aggregates.iterator()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0001_initial'),
+        ('indicators', '0002_auto_20190513_2330'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndicatorRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('target_total', models.DecimalField(blank=True, decimal_places=2, max_digits=20, null=True)),
+                ('actual_total', models.DecimalField(blank=True, decimal_places=2, max_digits=20, null=True)),
+                ('data_count', models.PositiveIntegerField(default=0)),
+                ('edit_date', models.DateTimeField(blank=True, null=True)),
+                ('indicator', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='indicators.Indicator')),
+                ('periodic_target', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='indicators.PeriodicTarget')),
+                ('program', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='workflow.Program')),
+            ],
+            options={
+                'ordering': ('indicator', 'periodic_target'),
+            },
+        ),
+        migrations.RunPython(build_indicator_rollup, migrations.RunPython.noop),
+    ]
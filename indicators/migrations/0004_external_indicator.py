@@ -0,0 +1,45 @@
+# Generated by Django 2.2 on 2026-10-17 19:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indicators', '0003_indicatorrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='externalservice',
+            name='feed_etag',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='externalservice',
+            name='feed_last_modified',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='externalservice',
+            name='feed_refreshed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ExternalIndicator',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('record_id', models.CharField(max_length=255, verbose_name='Unique ID')),
+                ('title', models.CharField(blank=True, max_length=765)),
+                ('data', models.TextField(verbose_name='Feed item JSON')),
+                ('position', models.PositiveIntegerField(default=0)),
+                ('edit_date', models.DateTimeField(blank=True, null=True)),
+                ('external_service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='indicators.ExternalService')),
+            ],
+            options={
+                'ordering': ('external_service', 'position'),
+                'unique_together': {('external_service', 'record_id')},
+            },
+        ),
+    ]
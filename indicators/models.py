@@ -1,15 +1,28 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Count, Sum, Exists, OuterRef, Q, Subquery
+from django.db.models.functions import TruncDate
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
 from django.contrib import admin
 from django.utils import timezone
 
+import json
+import threading
+import time
 import uuid
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
 from simple_history.models import HistoricalRecords
 from decimal import Decimal
 from datetime import datetime, timedelta
 
+from activity.external import external_data
 from workflow.models import (
     Program, Sector, SiteProfile, ProjectAgreement, ProjectComplete,
     Country, Documentation, ActivityUser)
@@ -232,6 +245,10 @@ class ExternalService(models.Model):
     name = models.CharField(max_length=255, blank=True)
     url = models.CharField(max_length=765, blank=True)
     feed_url = models.CharField(max_length=765, blank=True)
+    # validators of the last feed mirrored in ExternalIndicator
+    feed_etag = models.CharField(max_length=255, blank=True)
+    feed_last_modified = models.CharField(max_length=64, blank=True)
+    feed_refreshed = models.DateTimeField(null=True, blank=True)
     create_date = models.DateTimeField(null=True, blank=True)
     edit_date = models.DateTimeField(null=True, blank=True)
 
@@ -240,7 +257,8 @@ class ExternalService(models.Model):
 
 
 class ExternalServiceAdmin(admin.ModelAdmin):
-    list_display = ('name', 'url', 'feed_url', 'create_date', 'edit_date')
+    list_display = ('name', 'url', 'feed_url', 'feed_refreshed', 'create_date', 'edit_date')
+    readonly_fields = ('feed_etag', 'feed_last_modified', 'feed_refreshed')
     display = 'External Indicator Data Service'
 
 
@@ -262,6 +280,120 @@ class ExternalServiceRecordAdmin(admin.ModelAdmin):
     display = 'External Indicator Data Service'
 
 
+class ExternalIndicatorManager(models.Manager):
+    def lookup(self, service_id, record_id):
+        """
+        :return: the feed item of a record of the service, None when the
+            mirror does not have it
+        """
+        indicator = self.filter(external_service_id=service_id, record_id=str(record_id)).first()
+        return indicator.item if indicator is not None else None
+
+    def feed_json(self, service_id):
+        """
+        :return: the mirrored feed of a service as a JSON list, in feed order
+        """
+        items = self.filter(external_service_id=service_id).order_by('position').values_list('data', flat=True)
+        return '[' + ','.join(items) + ']'
+
+    def refresh(self, service, force=False):
+        """
+        Mirror the feed of a service, the request is conditional on the
+        validators of the last refresh and only the records that changed
+        are written
+        :param service: ExternalService
+        :param force: download the feed even when it is not modified
+        :return: tuple of (created, updated, deleted) counts, None when the
+            feed is not modified
+        """
+        headers = {}
+        if not force:
+            if service.feed_etag:
+                headers['If-None-Match'] = service.feed_etag
+            if service.feed_last_modified:
+                headers['If-Modified-Since'] = service.feed_last_modified
+        response = external_data.session.get(service.feed_url, headers=headers, timeout=external_data.timeout)
+        now = timezone.now()
+        if response.status_code == 304:
+            ExternalService.objects.filter(pk=service.pk).update(feed_refreshed=now)
+            service.feed_refreshed = now
+            return None
+        response.raise_for_status()
+        counts = self.sync(service, response.json())
+
+        service.feed_etag = response.headers.get('ETag', '')[:255]
+        service.feed_last_modified = response.headers.get('Last-Modified', '')[:64]
+        service.feed_refreshed = now
+        ExternalService.objects.filter(pk=service.pk).update(
+            feed_etag=service.feed_etag, feed_last_modified=service.feed_last_modified, feed_refreshed=now)
+        return counts
+
+    def sync(self, service, items):
+        """
+        Bring the mirror of a service in line with its feed items
+        :param items: list of dicts of the feed, keyed by nid
+        :return: tuple of (created, updated, deleted) counts
+        """
+        now = timezone.now()
+        existing = {indicator.record_id: indicator for indicator in self.filter(external_service=service)}
+        created, updated, seen = [], [], set()
+        for position, item in enumerate(items):
+            record_id = str(item['nid'])
+            if record_id in seen:
+                continue
+            seen.add(record_id)
+            data = json.dumps(item, sort_keys=True)
+            title = (item.get('title') or '')[:765]
+            indicator = existing.get(record_id)
+            if indicator is None:
+                created.append(self.model(external_service=service, record_id=record_id, title=title,
+                                          data=data, position=position, edit_date=now))
+            elif indicator.data != data or indicator.position != position:
+                indicator.title, indicator.data, indicator.position, indicator.edit_date = title, data, position, now
+                updated.append(indicator)
+        deleted = [indicator.pk for record_id, indicator in existing.items() if record_id not in seen]
+
+        with transaction.atomic():
+            self.bulk_create(created, batch_size=500)
+            self.bulk_update(updated, ['title', 'data', 'position', 'edit_date'], batch_size=500)
+            self.filter(pk__in=deleted).delete()
+        return len(created), len(updated), len(deleted)
+
+
+class ExternalIndicator(models.Model):
+    """
+    Local mirror of the indicator feed of an ExternalService, refreshed by
+    the refresh_external_indicators command
+    """
+    external_service = models.ForeignKey(ExternalService, on_delete=models.CASCADE)
+    record_id = models.CharField("Unique ID", max_length=255)
+    title = models.CharField(max_length=765, blank=True)
+    data = models.TextField("Feed item JSON")
+    position = models.PositiveIntegerField(default=0)
+    edit_date = models.DateTimeField(null=True, blank=True)
+
+    objects = ExternalIndicatorManager()
+
+    class Meta:
+        ordering = ('external_service', 'position')
+        unique_together = (('external_service', 'record_id'),)
+
+    def __str__(self):
+        return self.title
+
+    @property
+    def item(self):
+        return json.loads(self.data)
+
+
+class ExternalIndicatorAdmin(admin.ModelAdmin):
+    list_display = ('external_service', 'record_id', 'title', 'edit_date')
+    list_filter = ('external_service',)
+    search_fields = ('record_id', 'title')
+    readonly_fields = ('external_service', 'record_id', 'title', 'data', 'position', 'edit_date')
+    display = 'External Indicators'
+
+
 class IndicatorManager(models.Manager):
     def get_queryset(self):
         return super(IndicatorManager, self).get_queryset().prefetch_related('program').select_related('sector')
@@ -432,6 +564,66 @@ class Indicator(models.Model):
         return self.name
 
 
+class PeriodicTargetManager(models.Manager):
+    def save_targets(self, indicator, targets, batch_size=500):
+        """
+        Write the targets posted for an indicator with one bulk insert and one
+        bulk update, instead of an upsert per row
+        :param indicator: Indicator
+        :param targets: list of dicts with the id (0 for a new target), period,
+            target, start_date and end_date, in display order
+        :return: True when a target was added or its dates changed
+        """
+        now = timezone.now()
+        existing = self.filter(indicator=indicator).in_bulk(
+            [row['id'] for row in targets if row.get('id')])
+        created = []
+        updated = []
+        dates_changed = False
+        for i, row in enumerate(targets):
+            periodic_target = existing.get(row.get('id'))
+            if periodic_target is None:
+                periodic_target = self.model(indicator=indicator, create_date=now)
+                created.append(periodic_target)
+            else:
+                dates_changed = dates_changed or \
+                    (periodic_target.start_date, periodic_target.end_date) != \
+                    (row.get('start_date'), row.get('end_date'))
+                updated.append(periodic_target)
+            periodic_target.period = row.get('period', '')
+            periodic_target.target = row.get('target', 0)
+            periodic_target.customsort = i
+            periodic_target.start_date = row.get('start_date')
+            periodic_target.end_date = row.get('end_date')
+            periodic_target.edit_date = now
+
+        with transaction.atomic():
+            self.bulk_create(created, batch_size=batch_size)
+            self.bulk_update(updated, ['period', 'target', 'customsort', 'start_date', 'end_date', 'edit_date'],
+                             batch_size=batch_size)
+        # bulk writes skip the save signals
+        periodic_target_index.invalidate(indicator.id)
+        return bool(created) or dates_changed
+
+    def assign_collected_data(self, indicator_ids):
+        """
+        Link each collected data row of the indicators to the periodic target
+        whose dates hold its collection date, in a single UPDATE. Rows outside
+        every target range keep their periodic target
+        :param indicator_ids: list of Indicator IDs
+        :return: number of collected data rows updated
+        """
+        # the target dates are compared with the day the data was collected,
+        # in the current time zone like PeriodicTargetIndex.find
+        periods = self.filter(indicator_id=OuterRef('indicator_id'), start_date__lte=OuterRef('collected_on'),
+                              end_date__gte=OuterRef('collected_on'))
+        return CollectedData.objects.filter(indicator_id__in=indicator_ids)\
+            .annotate(collected_on=TruncDate('date_collected'))\
+            .annotate(in_period=Exists(periods)).filter(in_period=True)\
+            .update(periodic_target=Subquery(
+                periods.order_by('customsort', 'start_date').values('id')[:1]))
+
+
 class PeriodicTarget(models.Model):
     indicator = models.ForeignKey(
         Indicator, null=False, blank=False, on_delete=models.CASCADE)
@@ -445,6 +637,7 @@ class PeriodicTarget(models.Model):
     customsort = models.IntegerField(blank=True, null=True)
     create_date = models.DateTimeField(null=True, blank=True)
     edit_date = models.DateTimeField(null=True, blank=True)
+    objects = PeriodicTargetManager()
 
     def __str__(self):
         if self.indicator.target_frequency == Indicator.LOP \
@@ -472,6 +665,134 @@ class PeriodicTarget(models.Model):
         return self.end_date
 
 
+PERIODIC_TARGET_INDEX_VERSION_KEY = 'indicator_periods_version_%s'
+# the version key only reaches the other processes through a shared cache
+# backend, an indicator loaded more than PERIODIC_TARGET_INDEX_TTL seconds
+# ago is loaded again whatever its version
+PERIODIC_TARGET_INDEX_TTL = getattr(settings, 'PERIODIC_TARGET_INDEX_TTL', 60)
+# indicators kept in memory per process, the least recently used are dropped
+PERIODIC_TARGET_INDEX_MAX_ENTRIES = getattr(settings, 'PERIODIC_TARGET_INDEX_MAX_ENTRIES', 5000)
+
+
+class PeriodicTargetIndex(object):
+    """
+    Dated periodic targets of each indicator sorted by start date, so the
+    target of a collection date is a binary search and a short scan back
+    over the overlapping periods instead of a query.
+    An indicator is loaded on first use and dropped when one of its targets
+    changes; other processes notice it through the version kept in a shared
+    cache, or after PERIODIC_TARGET_INDEX_TTL seconds
+    """
+
+    def __init__(self, ttl=PERIODIC_TARGET_INDEX_TTL, max_entries=PERIODIC_TARGET_INDEX_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._periods = OrderedDict()
+        self._lock = threading.Lock()
+
+    def invalidate(self, indicator_id):
+        # a version that expired reads as None, which reloads the indicator too
+        cache.set(PERIODIC_TARGET_INDEX_VERSION_KEY % indicator_id, uuid.uuid4().hex, self.ttl * 10)
+        with self._lock:
+            self._periods.pop(indicator_id, None)
+
+    def load(self, indicator_ids):
+        """
+        Load the periods of several indicators, one query for all the ones
+        missing or out of date
+        :param indicator_ids: Indicator IDs
+        :return: dict of Indicator ID to its periods, as lookup() reads them
+        """
+        indicator_ids = set(indicator_ids)
+        versions = cache.get_many([PERIODIC_TARGET_INDEX_VERSION_KEY % pk for pk in indicator_ids])
+        versions = dict((pk, versions.get(PERIODIC_TARGET_INDEX_VERSION_KEY % pk)) for pk in indicator_ids)
+        expired = time.monotonic() - self.ttl
+        entries = {}
+        with self._lock:
+            for pk in indicator_ids:
+                entry = self._periods.get(pk)
+                if entry is not None and entry[0] == versions[pk] and entry[1] > expired:
+                    self._periods.move_to_end(pk)
+                    entries[pk] = entry
+        stale = indicator_ids - set(entries)
+        if not stale:
+            return entries
+        periods = dict((pk, ([], [], [])) for pk in stale)
+        targets = PeriodicTarget.objects.filter(
+            indicator_id__in=stale, start_date__isnull=False, end_date__isnull=False)\
+            .order_by('indicator_id', 'start_date', 'customsort')\
+            .values_list('indicator_id', 'start_date', 'end_date', 'customsort', 'id')
+        for indicator_id, start_date, end_date, customsort, pk in targets:
+            starts, max_ends, rows = periods[indicator_id]
+            starts.append(start_date)
+            # latest end of the periods starting up to this one, the scan in
+            # lookup() stops once it is before the date
+            max_ends.append(max(end_date, max_ends[-1]) if max_ends else end_date)
+            # same order as assign_collected_data, customsort then start date,
+            # with the NULLs last like PostgreSQL
+            rows.append((end_date, (customsort is None, customsort or 0, start_date), pk))
+        loaded = time.monotonic()
+        with self._lock:
+            for pk in stale:
+                entries[pk] = self._periods[pk] = (versions[pk], loaded) + periods[pk]
+                self._periods.move_to_end(pk)
+            while len(self._periods) > self.max_entries:
+                self._periods.popitem(last=False)
+        return entries
+
+    @staticmethod
+    def lookup(entry, value):
+        """
+        :param entry: periods of an indicator from load()
+        :param value: date collected
+        :return: ID of the first periodic target holding the date, or None
+        """
+        version, loaded, starts, max_ends, rows = entry
+        best = None
+        position = bisect_right(starts, value) - 1
+        # the periods that hold the date start before it, overlapping ones too
+        while position >= 0 and max_ends[position] >= value:
+            end_date, order, pk = rows[position]
+            if end_date >= value and (best is None or order < best[0]):
+                best = (order, pk)
+            position -= 1
+        return best[1] if best else None
+
+    @staticmethod
+    def collected_on(value):
+        if isinstance(value, datetime):
+            return timezone.localtime(value).date() if timezone.is_aware(value) else value.date()
+        return value
+
+    def find(self, indicator_id, value):
+        """
+        :param indicator_id: Indicator ID
+        :param value: date or datetime collected
+        :return: ID of the periodic target holding the date, or None
+        """
+        if indicator_id is None or value is None:
+            return None
+        return self.lookup(self.load([indicator_id])[indicator_id], self.collected_on(value))
+
+    def assign(self, rows):
+        """
+        Set periodic_target on collected data rows that have none
+        :param rows: CollectedData objects, they are not saved
+        :return: list of the rows that got a periodic target
+        """
+        rows = [row for row in rows if row.periodic_target_id is None and row.date_collected and row.indicator_id]
+        entries = self.load(row.indicator_id for row in rows)
+        assigned = []
+        for row in rows:
+            row.periodic_target_id = self.lookup(entries[row.indicator_id], self.collected_on(row.date_collected))
+            if row.periodic_target_id:
+                assigned.append(row)
+        return assigned
+
+
+periodic_target_index = PeriodicTargetIndex()
+
+
 class PeriodicTargetAdmin(admin.ModelAdmin):
     list_display = ('period', 'target', 'customsort',)
     display = 'Indicator Periodic Target'
@@ -556,3 +877,147 @@ class CollectedDataAdmin(admin.ModelAdmin):
     list_display = ('indicator', 'date_collected', 'create_date', 'edit_date')
     list_filter = ['indicator__program__country__country']
     display = 'Indicator Output/Outcome Collected Data'
+
+
+class IndicatorRollupManager(models.Manager):
+    def aggregate_collected_data(self, **filters):
+        """
+        Group collected data the same way the dashboards sum it, one row per
+        indicator, program and periodic target. The dashboards skip the rows
+        without an achieved value, so their target is not summed either.
+        """
+        return CollectedData.objects.filter(indicator__isnull=False, **filters).order_by()\
+            .values('indicator', 'program', 'periodic_target')\
+            .annotate(targets=Sum('periodic_target__target', filter=Q(achieved__isnull=False)),
+                      actuals=Sum('achieved'), data_count=Count('id'))
+
+    def build_rows(self, aggregates):
+        edit_date = timezone.now()
+        for row in aggregates:
+            yield self.model(indicator_id=row['indicator'], program_id=row['program'],
+                             periodic_target_id=row['periodic_target'], target_total=row['targets'],
+                             actual_total=row['actuals'], data_count=row['data_count'], edit_date=edit_date)
+
+    def refresh(self, indicator_id):
+        """
+        Recompute the rollup rows of a single indicator
+        :param indicator_id: Indicator ID
+        """
+        if indicator_id is None:
+            return
+        with transaction.atomic():
+            self.filter(indicator_id=indicator_id).delete()
+            self.bulk_create(self.build_rows(
+                self.aggregate_collected_data(indicator_id=indicator_id)))
+
+    def rebuild(self, batch_size=1000, **filters):
+        """
+        Recompute the rollup rows of every indicator matching the filters
+        :param batch_size: number of rows inserted per query
+        :return: number of rollup rows written
+        """
+        count = 0
+        with transaction.atomic():
+            self.filter(**filters).delete()
+            batch = []
+            aggregates = self.aggregate_collected_data(**filters).iterator()
+            for rollup in self.build_rows(aggregates):
+                batch.append(rollup)
+                if len(batch) >= batch_size:
+                    self.bulk_create(batch)
+                    count += len(batch)
+                    batch = []
+            self.bulk_create(batch)
+            count += len(batch)
+        return count
+
+
+class IndicatorRollup(models.Model):
+    """
+    Precomputed collected data sums per indicator, program and periodic target,
+    kept up to date by the CollectedData and PeriodicTarget signals below
+    """
+    indicator = models.ForeignKey(Indicator, on_delete=models.CASCADE)
+    program = models.ForeignKey(
+        Program, null=True, blank=True, on_delete=models.SET_NULL)
+    periodic_target = models.ForeignKey(
+        PeriodicTarget, null=True, blank=True, on_delete=models.SET_NULL)
+    target_total = models.DecimalField(
+        max_digits=20, decimal_places=2, null=True, blank=True)
+    actual_total = models.DecimalField(
+        max_digits=20, decimal_places=2, null=True, blank=True)
+    data_count = models.PositiveIntegerField(default=0)
+    edit_date = models.DateTimeField(null=True, blank=True)
+    objects = IndicatorRollupManager()
+
+    class Meta:
+        ordering = ('indicator', 'periodic_target')
+
+    def __str__(self):
+        return "%s - %s" % (self.indicator_id, self.periodic_target_id)
+
+
+class IndicatorRollupAdmin(admin.ModelAdmin):
+    list_display = ('indicator', 'program', 'periodic_target',
+                    'target_total', 'actual_total', 'data_count', 'edit_date')
+    list_filter = ('program',)
+    display = 'Indicator Rollup'
+
+
+@receiver(pre_save, sender=CollectedData)
+def collecteddata_pre_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # rows saved without a periodic target go to the one holding their date
+    if instance.periodic_target_id is None:
+        instance.periodic_target_id = periodic_target_index.find(
+            instance.indicator_id, instance.date_collected)
+    # remember the indicator the row belonged to so both rollups get refreshed
+    if instance.pk:
+        instance._rollup_indicator_id = CollectedData.objects.filter(pk=instance.pk)\
+            .values_list('indicator_id', flat=True).first()
+
+
+@receiver(post_save, sender=CollectedData)
+def collecteddata_post_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous_indicator_id = getattr(instance, '_rollup_indicator_id', None)
+    if previous_indicator_id and previous_indicator_id != instance.indicator_id:
+        IndicatorRollup.objects.refresh(previous_indicator_id)
+    IndicatorRollup.objects.refresh(instance.indicator_id)
+
+
+_periodic_target_signals = threading.local()
+
+
+@contextmanager
+def periodic_target_signals_deferred():
+    """
+    Skip the rollup refresh and index invalidation of each saved or deleted
+    periodic target, for batch jobs that rebuild both once per batch
+    """
+    _periodic_target_signals.deferred = True
+    try:
+        yield
+    finally:
+        _periodic_target_signals.deferred = False
+
+
+def periodic_target_signals_are_deferred(sender):
+    return sender is PeriodicTarget and getattr(_periodic_target_signals, 'deferred', False)
+
+
+@receiver(post_delete, sender=CollectedData)
+@receiver(post_save, sender=PeriodicTarget)
+@receiver(post_delete, sender=PeriodicTarget)
+def refresh_indicator_rollup(sender, instance, raw=False, **kwargs):
+    if not raw and not periodic_target_signals_are_deferred(sender):
+        IndicatorRollup.objects.refresh(instance.indicator_id)
+
+
+@receiver(post_save, sender=PeriodicTarget)
+@receiver(post_delete, sender=PeriodicTarget)
+def invalidate_periodic_target_index(sender, instance, **kwargs):
+    if not periodic_target_signals_are_deferred(sender):
+        periodic_target_index.invalidate(instance.indicator_id)
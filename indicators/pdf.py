@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db.models import Count, Max, Sum
+from django.http import FileResponse, JsonResponse
+from django.urls import reverse
+from weasyprint import HTML, CSS
+
+from .models import Indicator, PeriodicTarget, CollectedData, DisaggregationValue
+
+logger = logging.getLogger(__name__)
+
+# rendered PDFs are kept on disk, named after the report, the program and a
+# fingerprint of its data, so a print of an unchanged program is a file read.
+# They are served by pdf_download only, keep the directory out of MEDIA_ROOT
+PDF_CACHE_DIR = getattr(settings, 'PDF_CACHE_DIR', os.path.join(settings.SITE_ROOT, 'cache', 'pdf'))
+PDF_WORKERS = getattr(settings, 'PDF_WORKERS', 2)
+# the files of a print are deleted PDF_CACHE_MAX_AGE seconds after they were
+# written, when a new print is queued at most every PDF_PRUNE_SECONDS
+PDF_CACHE_MAX_AGE = getattr(settings, 'PDF_CACHE_MAX_AGE', 7 * 24 * 3600)
+PDF_PRUNE_SECONDS = 3600
+# a render still pending after PDF_PENDING_TIMEOUT seconds is taken as lost
+# with the worker that ran it and queued again
+PDF_PENDING_TIMEOUT = getattr(settings, 'PDF_PENDING_TIMEOUT', 600)
+
+PDF_FILENAMES = {
+    'tva': 'tva.pdf',
+    'disaggregation': 'indicators_disaggregation_report.pdf',
+}
+
+PAGE_STYLESHEET = '@page {\
+    size: letter; margin: 1cm;\
+    @bottom-right{\
+        content: "Page " counter(page) " of " counter(pages);\
+    };\
+}'
+
+_executor = ThreadPoolExecutor(max_workers=PDF_WORKERS)
+_pruned = 0
+
+
+def get_pdf_key(report, program_ids):
+    """
+    Cache key of a program report, it changes when an indicator, periodic
+    target, collected data or disaggregation value row of the programs is
+    added, edited or deleted. The values are summed too, so an update that
+    leaves edit_date alone still changes the key
+    :param report: report name, one of PDF_FILENAMES
+    :param program_ids: list of Program IDs in the report
+    :return: '<report>-<program>-<fingerprint>', program is 0 for several programs
+    """
+    program_ids = sorted(set(program_ids))
+    indicators = Indicator.objects.filter(program__id__in=program_ids).order_by()\
+        .aggregate(last_edit=Max('edit_date'), count=Count('id', distinct=True))
+    targets = PeriodicTarget.objects.filter(indicator__program__id__in=program_ids).order_by()\
+        .aggregate(last_edit=Max('edit_date'), count=Count('id', distinct=True), total=Sum('target'))
+    collected = CollectedData.objects.filter(indicator__program__id__in=program_ids).order_by()\
+        .aggregate(last_edit=Max('edit_date'), count=Count('id', distinct=True), total=Sum('achieved'))
+    disaggregations = DisaggregationValue.objects\
+        .filter(collecteddata__indicator__program__id__in=program_ids).order_by()\
+        .aggregate(last_edit=Max('edit_date'), count=Count('id', distinct=True), last_id=Max('id'))
+    fingerprint = '|'.join(str(value) for value in [program_ids] + [
+        aggregates[name] for aggregates in (indicators, targets, collected, disaggregations)
+        for name in sorted(aggregates)])
+    program = program_ids[0] if len(program_ids) == 1 else 0
+    return '%s-%s-%s' % (report, program, hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:16])
+
+
+def get_pdf_path(key):
+    return os.path.join(PDF_CACHE_DIR, '%s.pdf' % key)
+
+
+def get_pdf_program_ids(key):
+    """
+    :return: list of the Program IDs a PDF was queued for, None when unknown
+    """
+    try:
+        with open(get_pdf_path(key) + '.json') as meta:
+            return json.load(meta)['program_ids']
+    except (IOError, ValueError, KeyError):
+        return None
+
+
+def write_pdf_program_ids(key, program_ids):
+    """
+    Keep the Program IDs of a PDF next to it, the status and download views
+    check them against the user's countries
+    """
+    os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+    path = get_pdf_path(key) + '.json'
+    temp_path = '%s.%s.tmp' % (path, threading.get_ident())
+    with open(temp_path, 'w') as meta:
+        json.dump({'program_ids': sorted(set(program_ids))}, meta)
+    os.replace(temp_path, path)
+
+
+def remove_marker(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def write_pdf(key, html):
+    path = get_pdf_path(key)
+    temp_path = '%s.%s.tmp' % (path, threading.get_ident())
+    try:
+        HTML(string=html).write_pdf(temp_path, stylesheets=[CSS(string=PAGE_STYLESHEET)])
+        os.replace(temp_path, path)
+    except Exception as e:
+        logger.exception('PDF rendering failed for %s', key)
+        remove_marker(temp_path)
+        with open(path + '.failed', 'w') as failed:
+            failed.write('%s: %s' % (e.__class__.__name__, e))
+        raise
+    finally:
+        remove_marker(path + '.pending')
+
+
+def get_pdf_status(key):
+    """
+    The status is read from the cache directory, so a poll reaching another
+    worker process than the one rendering sees it too
+    :return: 'ready', 'pending', 'failed' or None when the PDF was never queued
+    """
+    path = get_pdf_path(key)
+    if os.path.exists(path):
+        return 'ready'
+    try:
+        if time.time() - os.path.getmtime(path + '.pending') < PDF_PENDING_TIMEOUT:
+            return 'pending'
+    except OSError:
+        pass
+    if os.path.exists(path + '.failed'):
+        return 'failed'
+    return None
+
+
+def prune_pdf_cache(max_age=None):
+    """
+    Delete the cached prints and their markers older than max_age seconds
+    :return: number of files deleted
+    """
+    global _pruned
+    _pruned = time.time()
+    cutoff = _pruned - (PDF_CACHE_MAX_AGE if max_age is None else max_age)
+    deleted = 0
+    try:
+        entries = list(os.scandir(PDF_CACHE_DIR))
+    except OSError:
+        return deleted
+    for entry in entries:
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                deleted += 1
+        except OSError:
+            continue
+    return deleted
+
+
+def queue_pdf(key, html):
+    """
+    Render the HTML to the cached PDF in the worker pool, unless it is
+    already cached or being rendered
+    :param key: key from get_pdf_key
+    :param html: rendered report HTML
+    :return: status, as get_pdf_status
+    """
+    status = get_pdf_status(key)
+    if status in ('ready', 'pending'):
+        return status
+    if time.time() - _pruned >= PDF_PRUNE_SECONDS:
+        prune_pdf_cache()
+    os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+    path = get_pdf_path(key)
+    try:
+        if time.time() - os.path.getmtime(path + '.pending') >= PDF_PENDING_TIMEOUT:
+            remove_marker(path + '.pending')
+    except OSError:
+        pass
+    try:
+        # the marker is created exclusively, one worker renders a key
+        os.close(os.open(path + '.pending', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return 'pending'
+    remove_marker(path + '.failed')
+    _executor.submit(write_pdf, key, html)
+    return 'pending'
+
+
+def pdf_status_data(key, status):
+    return {
+        'status': status or 'missing',
+        'poll_url': reverse('pdf_status', kwargs={'key': key}),
+        'download_url': reverse('pdf_download', kwargs={'key': key}),
+    }
+
+
+def cached_pdf_response(request, key, render_html, program_ids):
+    """
+    Serve a cached PDF, or queue it and tell the browser where to poll
+    :param request: HttpRequest, an AJAX request always gets the JSON status
+    :param key: key from get_pdf_key
+    :param render_html: callable returning the report HTML, only called on a cache miss
+    :param program_ids: list of Program IDs in the report, already limited to the user's
+    :return: FileResponse when cached, otherwise a 202 JSON status
+    """
+    if get_pdf_program_ids(key) is None:
+        write_pdf_program_ids(key, program_ids)
+    status = get_pdf_status(key)
+    if status in (None, 'failed'):
+        status = queue_pdf(key, render_html())
+    if status == 'ready' and not request.is_ajax():
+        return pdf_file_response(key)
+    return JsonResponse(pdf_status_data(key, status), status=200 if status == 'ready' else 202)
+
+
+def pdf_file_response(key):
+    report = key.split('-', 1)[0]
+    response = FileResponse(open(get_pdf_path(key), 'rb'), content_type='application/pdf')
+    response['Content-Disposition'] = 'attachment; filename=%s' % PDF_FILENAMES.get(report, 'report.pdf')
+    return response
@@ -1,9 +1,31 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from django.test import TestCase
-from indicators.models import Indicator, IndicatorType, DisaggregationType, ReportingFrequency, CollectedData
-from workflow.models import Program, Country, Organization
+import json
+import os
+import tempfile
+from datetime import date, datetime
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.management import call_command
+from django.http import Http404
+from django.test import TestCase, RequestFactory
+from django.utils import timezone
+from django.db.models import Sum
+from indicators.models import (
+    Indicator, IndicatorType, DisaggregationType, ReportingFrequency, CollectedData,
+    PeriodicTarget, IndicatorRollup, DisaggregationLabel, DisaggregationValue, Level, periodic_target_index,
+    PeriodicTargetIndex, ExternalService, ExternalIndicator
+)
+from indicators.views import get_disaggregation_report, DisaggregationReportMixin, pdf_download, pdf_status
+from indicators.pdf import (
+    get_pdf_key, get_pdf_path, get_pdf_status, get_pdf_program_ids, queue_pdf, cached_pdf_response,
+    prune_pdf_cache, PDF_CACHE_DIR)
+from indicators.export import CollectedDataResource, IndicatorResource
+from workflow.models import Program, Country, Organization, ActivityUser
+from activity.export import export_csv_response
 from django.contrib.auth.models import User
 
 
@@ -64,3 +86,312 @@ class IndicatorTestCase(TestCase):
             description="somevaluecollected")
         self.assertEqual(CollectedData.objects.filter(
             id=get_collected.id).count(), 1)
+
+    def test_rollup_follows_collected_data(self):
+        """Check the indicator rollup is kept in sync with CollectedData"""
+        get_indicator = Indicator.objects.get(name="testindicator")
+        periodic_target = PeriodicTarget.objects.create(
+            indicator=get_indicator, period="Year 1", target="50")
+        CollectedData.objects.create(
+            achieved="5", indicator=get_indicator, periodic_target=periodic_target)
+        rollup = IndicatorRollup.objects.filter(indicator=get_indicator)
+        self.assertEqual(rollup.aggregate(total=Sum('actual_total'))['total'], 25)
+        self.assertEqual(rollup.get(periodic_target=periodic_target).target_total, 50)
+
+        CollectedData.objects.get(description="somevaluecollected").delete()
+        self.assertEqual(rollup.aggregate(total=Sum('actual_total'))['total'], 5)
+
+        IndicatorRollup.objects.all().delete()
+        self.assertEqual(IndicatorRollup.objects.rebuild(), 1)
+        self.assertEqual(rollup.get().actual_total, 5)
+
+    def test_streaming_export(self):
+        """Check the streamed CSV has the same layout as the resource export"""
+        for resource, queryset in ((IndicatorResource, Indicator.objects.all()),
+                                   (CollectedDataResource, CollectedData.objects.all())):
+            response = export_csv_response(resource(), queryset, 'export.csv')
+            streamed = b''.join(response.streaming_content).decode('utf-8')
+            self.assertEqual(streamed, resource().export(queryset).csv)
+
+    def test_disaggregation_report(self):
+        """Check the disaggregation report groups the values per program and indicator"""
+        get_indicator = Indicator.objects.get(name="testindicator")
+        get_program = Program.objects.get(name="testprogram")
+        other_program = Program.objects.create(name="otherprogram", gaitid="2")
+        label = DisaggregationLabel.objects.create(
+            disaggregation_type=DisaggregationType.objects.get(disaggregation_type="disagg"), label="female")
+        get_collected = CollectedData.objects.get(description="somevaluecollected")
+        for value in ("4", "6", ""):
+            get_collected.disaggregation_value.add(
+                DisaggregationValue.objects.create(disaggregation_label=label, value=value))
+
+        self.assertEqual(get_disaggregation_report([]), [])
+        report = get_disaggregation_report([get_program.id, other_program.id])
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]['PID'], get_program.id)
+        self.assertEqual(report[0]['IndicatorID'], get_indicator.id)
+        self.assertEqual([(d['Disaggregation'], d['Actuals']) for d in report[0]['disdata']], [('female', 10)])
+
+        mixin = DisaggregationReportMixin()
+        mixin.request = RequestFactory().get('/', {'program': [get_program.id, other_program.id]})
+        programs = Program.objects.filter(id=get_program.id)
+        self.assertEqual(mixin.get_report_program_ids(0, programs), [get_program.id])
+        with self.assertRaises(Http404):
+            mixin.get_report_program_ids(other_program.id, Program.objects.none())
+
+    def test_pdf_cache_key(self):
+        """Check a cached print is served until the program data changes"""
+        get_program = Program.objects.get(name="testprogram")
+        key = get_pdf_key('tva', [get_program.id])
+        self.assertEqual(get_pdf_key('tva', [get_program.id]), key)
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch('indicators.pdf.PDF_CACHE_DIR', cache_dir):
+            with open(get_pdf_path(key), 'wb') as pdf:
+                pdf.write(b'%PDF-1.4')
+            response = cached_pdf_response(
+                RequestFactory().get('/'), key, lambda: self.fail('cached PDF was rendered again'),
+                [get_program.id])
+            self.assertEqual(b''.join(response.streaming_content), b'%PDF-1.4')
+            self.assertIn('filename=tva.pdf', response['Content-Disposition'])
+            response.close()
+
+            # the status is read from the cache directory, any worker process sees it
+            other_key = get_pdf_key('disaggregation', [get_program.id])
+            with mock.patch('indicators.pdf._executor') as executor:
+                self.assertEqual(queue_pdf(other_key, '<p>report</p>'), 'pending')
+                self.assertEqual(queue_pdf(other_key, '<p>report</p>'), 'pending')
+            self.assertEqual(executor.submit.call_count, 1)
+            self.assertEqual(get_pdf_status(other_key), 'pending')
+
+            # the poll and the download are limited to the users of the program countries
+            request = RequestFactory().get('/')
+            request.user = User.objects.get(username='john')
+            self.assertEqual(get_pdf_program_ids(key), [get_program.id])
+            with self.assertRaises(Http404):
+                pdf_download(request, key)
+            ActivityUser.objects.create(user=request.user, name="john").countries.add(
+                Country.objects.get(country="testcountry"))
+            request.user = User.objects.get(username='john')
+            response = pdf_download(request, key)
+            self.assertEqual(b''.join(response.streaming_content), b'%PDF-1.4')
+            response.close()
+            with self.assertRaises(Http404):
+                pdf_status(request, other_key)
+
+            # prints older than PDF_CACHE_MAX_AGE are deleted
+            os.utime(get_pdf_path(key), (0, 0))
+            self.assertEqual(prune_pdf_cache(), 1)
+            self.assertFalse(os.path.exists(get_pdf_path(key)))
+            self.assertEqual(get_pdf_program_ids(key), [get_program.id])
+        self.assertTrue(os.path.basename(get_pdf_path(key)).startswith('tva-%s-' % get_program.id))
+
+        CollectedData.objects.create(
+            achieved="1", description="newvalue", indicator=Indicator.objects.get(name="testindicator"))
+        self.assertNotEqual(get_pdf_key('tva', [get_program.id]), key)
+
+        key = get_pdf_key('tva', [get_program.id])
+        PeriodicTarget.objects.create(
+            indicator=Indicator.objects.get(name="testindicator"), period="Year 1", target="5")
+        self.assertNotEqual(get_pdf_key('tva', [get_program.id]), key)
+        key = get_pdf_key('tva', [get_program.id])
+        CollectedData.objects.filter(description="newvalue").update(achieved="2")
+        self.assertNotEqual(get_pdf_key('tva', [get_program.id]), key)
+        self.assertFalse(os.path.abspath(PDF_CACHE_DIR).startswith(os.path.abspath(settings.MEDIA_ROOT)))
+
+    def test_save_targets(self):
+        """Check posted targets are written in bulk and collected data follows the new periods"""
+        get_indicator = Indicator.objects.get(name="testindicator")
+        existing = PeriodicTarget.objects.create(
+            indicator=get_indicator, period="Year 1", target="10",
+            start_date=date(2018, 1, 1), end_date=date(2018, 12, 31))
+        collected = CollectedData.objects.create(
+            achieved="5", description="2019 value", indicator=get_indicator,
+            date_collected=datetime(2019, 3, 1))
+        # collected on the last day of Year 1, after midnight
+        last_day = CollectedData.objects.create(
+            achieved="3", description="2018 last day", indicator=get_indicator,
+            date_collected=datetime(2018, 12, 31, 10, 0, tzinfo=timezone.utc))
+        CollectedData.objects.filter(id=last_day.id).update(periodic_target=None)
+
+        targets = [
+            {'id': existing.id, 'period': "Year 1", 'target': "15",
+             'start_date': date(2018, 1, 1), 'end_date': date(2018, 12, 31)},
+            {'id': 0, 'period': "Year 2", 'target': "20",
+             'start_date': date(2019, 1, 1), 'end_date': date(2019, 12, 31)},
+        ]
+        self.assertTrue(PeriodicTarget.objects.save_targets(get_indicator, targets))
+        self.assertFalse(PeriodicTarget.objects.save_targets(get_indicator, targets[:1]))
+        self.assertEqual(list(PeriodicTarget.objects.filter(indicator=get_indicator)
+                              .values_list('period', 'target', 'customsort')),
+                         [("Year 1", 15, 0), ("Year 2", 20, 1)])
+
+        self.assertEqual(PeriodicTarget.objects.assign_collected_data([get_indicator.id]), 2)
+        collected.refresh_from_db()
+        self.assertEqual(collected.periodic_target.period, "Year 2")
+        last_day.refresh_from_db()
+        self.assertEqual(last_day.periodic_target_id, existing.id)
+        self.assertIsNone(CollectedData.objects.get(description="somevaluecollected").periodic_target)
+
+    def test_periodic_target_index(self):
+        """Check collected data is linked to the target of its date on save and by the repair command"""
+        get_indicator = Indicator.objects.get(name="testindicator")
+        year_1 = PeriodicTarget.objects.create(
+            indicator=get_indicator, period="Year 1", target="10",
+            start_date=date(2018, 1, 1), end_date=date(2018, 12, 31))
+        collected = CollectedData.objects.create(
+            achieved="5", description="2018 value", indicator=get_indicator,
+            date_collected=datetime(2018, 12, 31, 15, 0, tzinfo=timezone.utc))
+        self.assertEqual(collected.periodic_target_id, year_1.id)
+
+        # a target added later is picked up by the index and the repair command
+        orphan = CollectedData.objects.create(
+            achieved="7", description="2019 value", indicator=get_indicator,
+            date_collected=datetime(2019, 6, 1, tzinfo=timezone.utc))
+        self.assertIsNone(orphan.periodic_target_id)
+        year_2 = PeriodicTarget.objects.create(
+            indicator=get_indicator, period="Year 2", target="20",
+            start_date=date(2019, 1, 1), end_date=date(2019, 12, 31))
+        self.assertEqual(periodic_target_index.find(get_indicator.id, date(2019, 6, 1)), year_2.id)
+        self.assertIsNone(periodic_target_index.find(get_indicator.id, date(2020, 1, 1)))
+
+        # another process only sees the change after the ttl, targets written
+        # without signals too, and keeps max_entries indicators
+        index = PeriodicTargetIndex(ttl=0, max_entries=1)
+        self.assertIsNone(index.find(get_indicator.id, date(2021, 6, 1)))
+        PeriodicTarget.objects.filter(id=year_2.id).update(end_date=date(2021, 12, 31))
+        self.assertEqual(index.find(get_indicator.id, date(2021, 6, 1)), year_2.id)
+        index.load([get_indicator.id, 0])
+        index.find(get_indicator.id, date(2021, 6, 1))
+        self.assertEqual(list(index._periods), [get_indicator.id])
+        # an entry dropped right after it was loaded is still read
+        self.assertEqual(PeriodicTargetIndex(max_entries=0).find(get_indicator.id, date(2021, 6, 1)), year_2.id)
+
+        # overlapping periods pick the same target as assign_collected_data
+        overlapping = Indicator.objects.create(name="overlapping")
+        period_a = PeriodicTarget.objects.create(
+            indicator=overlapping, period="A", target="1", customsort=0,
+            start_date=date(2018, 1, 1), end_date=date(2020, 12, 31))
+        period_b = PeriodicTarget.objects.create(
+            indicator=overlapping, period="B", target="1", customsort=1,
+            start_date=date(2019, 1, 1), end_date=date(2019, 6, 30))
+        self.assertEqual(periodic_target_index.find(overlapping.id, date(2019, 9, 1)), period_a.id)
+        self.assertEqual(periodic_target_index.find(overlapping.id, date(2019, 3, 1)), period_a.id)
+        PeriodicTarget.objects.filter(id=period_b.id).update(customsort=-1)
+        periodic_target_index.invalidate(overlapping.id)
+        self.assertEqual(periodic_target_index.find(overlapping.id, date(2019, 3, 1)), period_b.id)
+        inside_b = CollectedData.objects.create(
+            achieved="1", indicator=overlapping, date_collected=datetime(2019, 3, 1, tzinfo=timezone.utc))
+        self.assertEqual(inside_b.periodic_target_id, period_b.id)
+        CollectedData.objects.filter(id=inside_b.id).update(periodic_target=None)
+        PeriodicTarget.objects.assign_collected_data([overlapping.id])
+        inside_b.refresh_from_db()
+        self.assertEqual(inside_b.periodic_target_id, period_b.id)
+
+        call_command('assign_periodic_targets', stdout=StringIO())
+        orphan.refresh_from_db()
+        self.assertEqual(orphan.periodic_target_id, year_2.id)
+        self.assertEqual(IndicatorRollup.objects.get(periodic_target=year_2).actual_total, 7)
+
+    def test_create_targets_bulk(self):
+        """Check the bulk mode of create_targets writes the targets, history and collected data links"""
+        get_indicator = Indicator.objects.get(name="testindicator")
+        collected = CollectedData.objects.create(
+            achieved="3", description="quarter 2 value", indicator=get_indicator,
+            date_collected=datetime(2018, 5, 10, tzinfo=timezone.utc))
+        # after midnight on the last day of Quarter 2
+        last_day = CollectedData.objects.create(
+            achieved="4", description="quarter 2 last day", indicator=get_indicator,
+            date_collected=datetime(2018, 6, 30, 10, 0, tzinfo=timezone.utc))
+        history_count = get_indicator.history.count()
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csvfile:
+            csvfile.write('id,name,program,level,frequency,month,year,periods\n')
+            csvfile.write('%s,testindicator,,,Quarterly,January,2018,4\n' % get_indicator.id)
+            csvfile.write('0,missing,,,Quarterly,January,2018,4\n')
+        try:
+            call_command('create_targets', filepath=csvfile.name, bulk=True, dry_run=True, stdout=StringIO())
+            self.assertFalse(PeriodicTarget.objects.filter(indicator=get_indicator).exists())
+            call_command('create_targets', filepath=csvfile.name, bulk=True, stdout=StringIO())
+        finally:
+            os.remove(csvfile.name)
+
+        self.assertEqual(list(PeriodicTarget.objects.filter(indicator=get_indicator)
+                              .order_by('customsort').values_list('period', flat=True)),
+                         ['Quarter 1', 'Quarter 2', 'Quarter 3', 'Quarter 4'])
+        get_indicator.refresh_from_db()
+        self.assertEqual(get_indicator.target_frequency, Indicator.QUARTERLY)
+        self.assertEqual(get_indicator.history.count(), history_count + 1)
+        collected.refresh_from_db()
+        self.assertEqual(collected.periodic_target.period, 'Quarter 2')
+        last_day.refresh_from_db()
+        self.assertEqual(last_day.periodic_target.period, 'Quarter 2')
+
+    def test_lop_command(self):
+        """Check the lop command relinks collected data to a single LOP target and can be resumed"""
+        get_indicator = Indicator.objects.get(name="testindicator")
+        PeriodicTarget.objects.create(indicator=get_indicator, period="Year 1", target="10")
+        empty = Indicator.objects.create(name="empty", lop_target="5")
+        PeriodicTarget.objects.create(indicator=empty, period="Year 1", target="5")
+
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'lop.checkpoint')
+            call_command('lop', batch_size=1, checkpoint=checkpoint, stdout=StringIO())
+            with open(checkpoint) as finished:
+                self.assertEqual(sorted(int(pk) for pk in finished), sorted([get_indicator.id, empty.id]))
+            out = StringIO()
+            call_command('lop', checkpoint=checkpoint, stdout=out)
+            self.assertIn('0 indicators set to LOP', out.getvalue())
+
+        lop_target = PeriodicTarget.objects.get(indicator=get_indicator)
+        self.assertEqual(lop_target.period, Indicator.TARGET_FREQUENCIES[0][1])
+        self.assertEqual(CollectedData.objects.get(description="somevaluecollected").periodic_target, lop_target)
+        self.assertEqual(Indicator.objects.get(id=get_indicator.id).target_frequency, Indicator.LOP)
+        self.assertFalse(PeriodicTarget.objects.filter(indicator=empty).exists())
+        self.assertEqual(IndicatorRollup.objects.get(indicator=get_indicator).periodic_target, lop_target)
+
+    def test_flag_kpi_indicators(self):
+        """Check Impact indicators are flagged only in programs without a KPI"""
+        impact = Level(name="Impact")
+        impact.save()
+        get_indicator = Indicator.objects.get(name="testindicator")
+        get_indicator.level.add(impact)
+        other_program = Program.objects.create(name="otherprogram", gaitid="2")
+        kpi = Indicator.objects.create(name="kpi", key_performance_indicator=True)
+        kpi.program.add(other_program)
+        other_impact = Indicator.objects.create(name="otherimpact")
+        other_impact.program.add(other_program)
+        other_impact.level.add(impact)
+
+        call_command('flag_kpi_indicators', dry_run=True, stdout=StringIO())
+        self.assertFalse(Indicator.objects.get(id=get_indicator.id).key_performance_indicator)
+        call_command('flag_kpi_indicators', country_id=[Country.objects.get(country="testcountry").id],
+                     stdout=StringIO())
+        self.assertTrue(Indicator.objects.get(id=get_indicator.id).key_performance_indicator)
+        self.assertFalse(Indicator.objects.get(id=other_impact.id).key_performance_indicator)
+
+    def test_refresh_external_indicators(self):
+        """Check the feed is mirrored once and a not modified feed is left alone"""
+        service = ExternalService.objects.create(name="dig", url="http://dig.test", feed_url="http://dig.test/feed")
+        feed = [{'nid': '7', 'title': 'Wells built', 'sector': 'WASH', 'level': 'output',
+                 'source': 'survey', 'definition': '<p>wells</p>', 'type': 'custom'},
+                {'nid': '8', 'title': 'Latrines built'}]
+        response = mock.Mock(status_code=200, headers={'ETag': '"v1"'})
+        response.json.return_value = feed
+        with mock.patch('activity.external.external_data.session.get', return_value=response) as get:
+            call_command('refresh_external_indicators', stdout=StringIO())
+            self.assertEqual(ExternalIndicator.objects.lookup(service.id, 7)['title'], 'Wells built')
+            self.assertIsNone(ExternalIndicator.objects.lookup(service.id, 9))
+
+            feed[1] = {'nid': '9', 'title': 'Pumps repaired'}
+            self.assertEqual(ExternalIndicator.objects.refresh(ExternalService.objects.get(id=service.id)),
+                             (1, 0, 1))
+            self.assertEqual(get.call_args[1]['headers'], {'If-None-Match': '"v1"'})
+            self.assertEqual([item['nid'] for item in json.loads(ExternalIndicator.objects.feed_json(service.id))],
+                             ['7', '9'])
+
+            response.status_code = 304
+            out = StringIO()
+            call_command('refresh_external_indicators', service_id=[service.id], stdout=out)
+            self.assertIn('not modified', out.getvalue())
+            self.assertEqual(ExternalIndicator.objects.filter(external_service=service).count(), 2)
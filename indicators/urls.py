@@ -54,6 +54,8 @@ urlpatterns = [
             DisaggregationReport.as_view(), name='disrep'),
     re_path(r'^disrepprint/(?P<program>\w+)/$',
             DisaggregationPrint.as_view(), name='disrepprint'),
+    re_path(r'^pdf/(?P<key>[\w-]+)/status/$', pdf_status, name='pdf_status'),
+    re_path(r'^pdf/(?P<key>[\w-]+)/$', pdf_download, name='pdf_download'),
     re_path(r'^report_table/(?P<program>\w+)/(?P<indicator>\w+)/(?P<type>\w+)/$',
             IndicatorReport.as_view(), name='indicator_table'),
     re_path(r'^program_report/(?P<program>\w+)/$',
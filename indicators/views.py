@@ -1,20 +1,24 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from django.db import connection
-from django.http import JsonResponse
+from django.db import connection, transaction
+from django.http import JsonResponse, Http404
 from django.shortcuts import render
 from django.http import HttpResponseRedirect
 from urllib.parse import urlparse
 import re
 
 from .export import IndicatorResource, CollectedDataResource
+from .pdf import (
+    get_pdf_key, get_pdf_status, get_pdf_program_ids, cached_pdf_response, pdf_file_response, pdf_status_data)
+from activity.export import export_csv_response
+from activity.responses import json_list_response, json_lists_response
 from .tables import IndicatorDataTable
 from .forms import IndicatorForm, CollectedDataForm
 from .models import (
     Indicator, PeriodicTarget, DisaggregationLabel, DisaggregationValue,
     CollectedData, IndicatorType, Level, ExternalServiceRecord,
-    ExternalService, ActivityTable
+    ExternalService, ExternalIndicator, ActivityTable, IndicatorRollup
 )
 
 from django.db.models import Count, Sum, Min, Q
@@ -24,7 +28,7 @@ from django.views.generic.detail import View
 from django.views.generic import TemplateView
 from django.utils.decorators import method_decorator
 from django.utils import timezone
-from django.contrib.auth.decorators import user_passes_test
+from django.contrib.auth.decorators import user_passes_test, login_required
 from django.contrib import messages
 from django.core.serializers.json import DjangoJSONEncoder
 from django.core.exceptions import PermissionDenied
@@ -38,12 +42,10 @@ from workflow.mixins import AjaxableResponseMixin
 from workflow.admin import CountryResource
 from workflow.forms import FilterForm
 from feed.serializers import FlatJsonSerializer
-from activity.util import get_country, get_table
+from activity.util import get_country, get_table, get_activity_tables_headers
+from activity.external import external_data
 
 import json
-import requests
-from weasyprint import HTML, CSS
-from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import dateutil.parser
 
@@ -191,19 +193,32 @@ def import_indicator(service=1, deserialize=True):
     :return:
     """
     service = ExternalService.objects.get(id=service)
-    response = requests.get(service.feed_url)
+    response = external_data.get(service.feed_url)
 
     if deserialize:
-        data = json.loads(response.content)  # deserialises it
+        data = response.json()  # deserialises it
     else:
         # send json data back not deserialized data
-        data = response
+        data = response.content
     # debug the json data string uncomment dump and print
     # data2 = json.dumps(json_data) # json formatted string
     # print(data2)
     return data
 
 
+def mirror_external_service(service):
+    """
+    The service with its feed mirrored in ExternalIndicator, a service that
+    was never refreshed is mirrored now, then by refresh_external_indicators
+    :param service: ExternalService ID
+    :return: ExternalService
+    """
+    service = ExternalService.objects.get(id=service)
+    if service.feed_refreshed is None:
+        ExternalIndicator.objects.refresh(service)
+    return service
+
+
 def indicator_create(request, id=0):
     """
     Create an Indicator with a service template first, or custom.  Step one in Inidcator creation.
@@ -242,29 +257,28 @@ def indicator_create(request, id=0):
 
         # checkfor service indicator and update based on values
         if node_id is not None and int(node_id) != 0:
-            get_imported_indicators = import_indicator(service)
-            for item in get_imported_indicators:
-                if item['nid'] == node_id:
-                    get_sector, created = Sector.objects.get_or_create(
-                        sector=item['sector'])
-                    sector = get_sector
-                    get_level, created = Level.objects.get_or_create(
-                        name=item['level'].title())
-                    level = get_level
-                    name = item['title']
-                    source = item['source']
-                    definition = item['definition']
-                    # replace HTML tags if they are in the string
-                    definition = re.sub("<.*?>", "", definition)
-
-                    get_service = ExternalService.objects.get(id=service)
-                    full_url = get_service.url + "/" + item['nid']
-                    external_service_record = ExternalServiceRecord(
-                        record_id=item['nid'], external_service=get_service, full_url=full_url)
-                    external_service_record.save()
-                    get_type, created = IndicatorType.objects.get_or_create(
-                        indicator_type=item['type'].title())
-                    type = get_type
+            get_service = mirror_external_service(service)
+            item = ExternalIndicator.objects.lookup(get_service.id, node_id)
+            if item is not None:
+                get_sector, created = Sector.objects.get_or_create(
+                    sector=item['sector'])
+                sector = get_sector
+                get_level, created = Level.objects.get_or_create(
+                    name=item['level'].title())
+                level = get_level
+                name = item['title']
+                source = item['source']
+                definition = item['definition']
+                # replace HTML tags if they are in the string
+                definition = re.sub("<.*?>", "", definition)
+
+                full_url = get_service.url + "/" + str(item['nid'])
+                external_service_record = ExternalServiceRecord(
+                    record_id=item['nid'], external_service=get_service, full_url=full_url)
+                external_service_record.save()
+                get_type, created = IndicatorType.objects.get_or_create(
+                    indicator_type=item['type'].title())
+                type = get_type
 
         # save form
         new_indicator = Indicator(sector=sector, name=name, source=source,
@@ -380,7 +394,14 @@ class PeriodicTargetView(View):
         return HttpResponse('{"status": "success", "message": "Request processed successfully!"}')
 
 
-def handle_data_collected_records(indicatr, lop, existing_target_frequency, new_target_frequency, generated_pt_ids=[]):
+def parse_target_date(value):
+    try:
+        return dateutil.parser.parse(value).date()
+    except (ValueError, TypeError):
+        return None
+
+
+def handle_data_collected_records(indicatr, lop, existing_target_frequency, new_target_frequency, assign_periods=False):
     # If the target_frequency is changed from LOP to something else then disassociate all
     # collected_data from the LOP periodic_target and then delete the LOP periodic_target
     # if existing_target_frequency == Indicator.LOP and new_target_frequency != Indicator.LOP:
@@ -397,12 +418,11 @@ def handle_data_collected_records(indicatr, lop, existing_target_frequency, new_
         CollectedData.objects.filter(
             indicator=indicatr).update(periodic_target=lop_pt)
 
-    if generated_pt_ids:
-        pts = PeriodicTarget.objects.filter(
-            indicator=indicatr, pk__in=generated_pt_ids)
-        for pt in pts:
-            CollectedData.objects.filter(indicator=indicatr, date_collected__range=[
-                                         pt.start_date, pt.end_date]).update(periodic_target=pt)
+    if assign_periods:
+        PeriodicTarget.objects.assign_collected_data([indicatr.id])
+
+    # queryset updates skip the save signals, recompute the rollup once at the end
+    IndicatorRollup.objects.refresh(indicatr.id)
 
 
 class IndicatorUpdate(UpdateView):
@@ -514,41 +534,18 @@ class IndicatorUpdate(UpdateView):
 
         if periodic_targets and periodic_targets != 'generateTargets':
             # now create/update periodic targets
-            pt_json = json.loads(periodic_targets)
-            generated_pt_ids = []
-            for i, pt in enumerate(pt_json):
-                pk = int(pt.get('id'))
-                if pk == 0:
-                    pk = None
-                try:
-                    start_date = dateutil.parser.parse(
-                        pt.get('start_date', None))
-                    start_date = datetime.strftime(start_date, '%Y-%m-%d')
-                except ValueError:
-                    # raise ValueError("Incorrect data value")
-                    start_date = None
-
-                try:
-                    end_date = dateutil.parser.parse(pt.get('end_date', None))
-                    end_date = datetime.strftime(end_date, '%Y-%m-%d')
-                except ValueError:
-                    # raise ValueError("Incorrect data value")
-                    end_date = None
-
-                # print("i = %s.......................%s............................" % (i, periodic_targets) )
-                periodic_target, created = PeriodicTarget.objects.update_or_create(
-                    indicator=indicatr, id=pk,
-                    defaults={'period': pt.get('period', ''), 'target': pt.get('target', 0), 'customsort': i,
-                              'start_date': start_date, 'end_date': end_date, 'edit_date': timezone.now()})
-                # print("%s|%s = %s, %s" % (created, pk, pt.get('period'), pt.get('target') ))
-                if created:
-                    periodic_target.create_date = timezone.now()
-                    periodic_target.save()
-                    generated_pt_ids.append(periodic_target.id)
-
-            # handle related collected_data records for the new periodic targets
-            handle_data_collected_records(
-                indicatr, lop, existing_target_frequency, new_target_frequency, generated_pt_ids)
+            targets = []
+            for pt in json.loads(periodic_targets):
+                targets.append({
+                    'id': int(pt.get('id')), 'period': pt.get('period', ''), 'target': pt.get('target', 0),
+                    'start_date': parse_target_date(pt.get('start_date', None)),
+                    'end_date': parse_target_date(pt.get('end_date', None))})
+
+            with transaction.atomic():
+                assign_periods = PeriodicTarget.objects.save_targets(indicatr, targets)
+                # handle related collected_data records for the new periodic targets
+                handle_data_collected_records(
+                    indicatr, lop, existing_target_frequency, new_target_frequency, assign_periods)
 
         fields_to_watch = {'indicator_type', 'level', 'name', 'number', 'sector'}
         changed_fields = set(form.changed_data)
@@ -617,6 +614,7 @@ class PeriodicTargetDeleteView(DeleteView):
         collecteddata_count = self.get_object().collecteddata_set.count()
         if collecteddata_count > 0:
             self.get_object().collecteddata_set.all().update(periodic_target=None)
+            IndicatorRollup.objects.refresh(self.get_object().indicator_id)
 
         # super(PeriodicTargetDeleteView).delete(request, args, kwargs)
         indicator = self.get_object().indicator
@@ -898,16 +896,8 @@ def get_table_count(url, table_id):
     :param table_id: The ActivityTable ID to update count from and return
     :return: count : count of rows from ActivityTable
     """
-    token = ActivitySites.objects.get(site_id=1)
-    if token.activity_tables_token:
-        headers = {'content-type': 'application/json',
-                   'Authorization': 'Token ' + token.activity_tables_token}
-    else:
-        headers = {'content-type': 'application/json'}
-        print("Token Not Found")
-
-    response = requests.get(url, headers=headers, verify=True)
-    data = json.loads(response.content)
+    # revalidated on every call, the count is read when the data is saved
+    data = external_data.get_json(url, headers=get_activity_tables_headers(), ttl=0)
     count = None
     try:
         count = data['data_count']
@@ -995,7 +985,8 @@ def service_json(request, service):
     :param service: The remote data service
     :return: JSON object of the indicators from the service
     """
-    service_indicators = import_indicator(service, deserialize=False)
+    service = mirror_external_service(service)
+    service_indicators = ExternalIndicator.objects.feed_json(service.id)
     return HttpResponse(service_indicators, content_type="application/json")
 
 
@@ -1156,9 +1147,7 @@ class IndicatorReport(View, AjaxableResponseMixin):
                 Q(definition__contains=q)
             )
 
-        get_indicators = json.dumps(list(get_indicators), cls=DjangoJSONEncoder)
-
-        return JsonResponse(get_indicators, safe=False)
+        return json_list_response(request, get_indicators)
 
 
 def programIndicatorReport(request, program=0):
@@ -1319,23 +1308,14 @@ class IndicatorReportData(View, AjaxableResponseMixin):
         indicator_data_count = Indicator.objects.all().filter(program__country__in=countries).filter(
             **q).filter(collecteddata__isnull=False).distinct().count()
 
-        indicator_serialized = json.dumps(list(indicator))
-
-        final_dict = {
-            'indicator': indicator_serialized,
-            'indicator_count': indicator_count,
-            'data_count': indicator_data_count
-        }
-
         if request.GET.get('export'):
             indicator_export = Indicator.objects.all().filter(**q)
-            dataset = IndicatorResource().export(indicator_export)
-            response = HttpResponse(
-                dataset.csv, content_type='application/ms-excel')
-            response['Content-Disposition'] = 'attachment; filename=indicator_data.csv'
-            return response
+            return export_csv_response(IndicatorResource(), indicator_export, 'indicator_data.csv')
 
-        return JsonResponse(final_dict, safe=False)
+        return json_lists_response(request, {'indicator': indicator}, {
+            'indicator_count': indicator_count,
+            'data_count': indicator_data_count
+        })
 
 
 class CollectedDataReportData(View, AjaxableResponseMixin):
@@ -1389,17 +1369,9 @@ class CollectedDataReportData(View, AjaxableResponseMixin):
             .filter(program__country__in=countries).filter(**q).aggregate(
             Sum('periodic_target__target'), Sum('achieved'))
 
-        # datetime encoding breaks without using this
-        from django.core.serializers.json import DjangoJSONEncoder
-        collected_serialized = json.dumps(
-            list(get_collected_data), cls=DjangoJSONEncoder)
-
-        final_dict = {
-            'collected': collected_serialized,
+        return json_lists_response(request, {'collected': get_collected_data}, {
             'collected_sum': collected_sum
-        }
-
-        return JsonResponse(final_dict, safe=False)
+        })
 
 
 def dictfetchall(cursor):
@@ -1411,58 +1383,101 @@ def dictfetchall(cursor):
     ]
 
 
+def get_disaggregation_report(program_ids):
+    """
+    Indicator totals with their disaggregation actuals for one or more programs,
+    two grouped queries joined on (program, indicator) in a single pass
+    :param program_ids: list of Program IDs
+    :return: list of indicator rows, each with a "disdata" list
+    """
+    if not program_ids:
+        return []
+    qn = connection.ops.quote_name
+    placeholders = ', '.join(['%s'] * len(program_ids))
+
+    indicator_query = "SELECT p.id AS {PID}, i.id AS {IndicatorID}, i.number AS {INumber}, "\
+        "i.name AS {Indicator}, i.lop_target AS {LOP_Target}, SUM(cd.achieved) AS {Overall} "\
+        "FROM indicators_indicator AS i "\
+        "INNER JOIN indicators_indicator_program AS ip ON ip.indicator_id = i.id "\
+        "INNER JOIN workflow_program AS p ON p.id = ip.program_id "\
+        "LEFT OUTER JOIN indicators_collecteddata AS cd ON i.id = cd.indicator_id "\
+        "WHERE p.id IN ({programs}) "\
+        "GROUP BY p.id, i.id, i.number, i.name, i.lop_target "\
+        "ORDER BY i.name, p.id"
+    disagg_query = "SELECT p.id AS {PID}, i.id AS {IndicatorID}, dt.disaggregation_type AS {DType}, "\
+        "l.customsort AS {customsort}, l.label AS {Disaggregation}, "\
+        "SUM(CAST(NULLIF(dv.value, '') AS decimal)) AS {Actuals} "\
+        "FROM indicators_collecteddata_disaggregation_value AS cdv "\
+        "INNER JOIN indicators_collecteddata AS c ON c.id = cdv.collecteddata_id "\
+        "INNER JOIN indicators_indicator AS i ON i.id = c.indicator_id "\
+        "INNER JOIN indicators_indicator_program AS ip ON ip.indicator_id = i.id "\
+        "INNER JOIN workflow_program AS p ON p.id = ip.program_id "\
+        "INNER JOIN indicators_disaggregationvalue AS dv ON dv.id = cdv.disaggregationvalue_id "\
+        "INNER JOIN indicators_disaggregationlabel AS l ON l.id = dv.disaggregation_label_id "\
+        "INNER JOIN indicators_disaggregationtype AS dt ON dt.id = l.disaggregation_type_id "\
+        "WHERE p.id IN ({programs}) "\
+        "GROUP BY p.id, i.id, dt.disaggregation_type, l.customsort, l.label "\
+        "ORDER BY p.id, i.id, dt.disaggregation_type, l.customsort, l.label"
+
+    # quoted aliases keep their case on PostgreSQL, the templates use them as is
+    aliases = dict((alias, qn(alias)) for alias in (
+        'PID', 'IndicatorID', 'INumber', 'Indicator', 'LOP_Target', 'Overall',
+        'DType', 'customsort', 'Disaggregation', 'Actuals'))
+    with connection.cursor() as cursor:
+        cursor.execute(indicator_query.format(programs=placeholders, **aliases), program_ids)
+        idata = dictfetchall(cursor)
+        cursor.execute(disagg_query.format(programs=placeholders, **aliases), program_ids)
+        disdata = dictfetchall(cursor)
+
+    disaggregations = {}
+    for dis in disdata:
+        disaggregations.setdefault((dis['PID'], dis['IndicatorID']), []).append(dis)
+    for indicator in idata:
+        indicator['disdata'] = disaggregations.get(
+            (indicator['PID'], indicator['IndicatorID']), [])
+    return idata
+
+
 class DisaggregationReportMixin(object):
+    def get_report_program_ids(self, program_id, programs):
+        # a program in the URL, several with ?program=1&program=2, otherwise
+        # every program of the user's countries, narrowed with ?country=
+        program_ids = [int(pk) for pk in self.request.GET.getlist('program') if pk.isdigit()]
+        if program_id:
+            program_ids.append(program_id)
+        if program_ids:
+            # only the programs of the user's countries are reported
+            program_ids = list(programs.filter(id__in=program_ids).values_list('id', flat=True))
+            if not program_ids:
+                raise Http404("Program does not exist")
+        else:
+            country_ids = [int(pk) for pk in self.request.GET.getlist('country') if pk.isdigit()]
+            scope = programs.filter(country__in=country_ids) if country_ids else programs
+            program_ids = list(scope.values_list('id', flat=True))
+        return program_ids
+
+    def get_report_programs(self):
+        countries = get_country(self.request.user)
+        return Program.objects.filter(
+            funding_status="Funded", country__in=countries).distinct()
+
     def get_context_data(self, **kwargs):
         context = super(DisaggregationReportMixin,
                         self).get_context_data(**kwargs)
 
         countries = get_country(self.request.user)
-        programs = Program.objects.filter(
-            funding_status="Funded", country__in=countries).distinct()
+        programs = self.get_report_programs()
         indicators = Indicator.objects.filter(program__country__in=countries)
 
         program_id = int(kwargs.get('program', 0))
+        program_ids = self.get_report_program_ids(program_id, programs)
         program_selected = None
         if program_id:
             program_selected = Program.objects.filter(id=program_id).first()
             if program_selected.indicator_set.count() > 0:
                 indicators = indicators.filter(program=program_id)
 
-        disagg_query = "SELECT i.id AS IndicatorID, dt.disaggregation_type AS DType, "\
-            "l.customsort AS customsort, l.label AS Disaggregation, SUM(CAST(dv.value as decimal)) AS Actuals "\
-            "FROM indicators_collecteddata_disaggregation_value AS cdv "\
-            "INNER JOIN indicators_collecteddata AS c ON c.id = cdv.collecteddata_id "\
-            "INNER JOIN indicators_indicator AS i ON i.id = c.indicator_id "\
-            "INNER JOIN indicators_indicator_program AS ip ON ip.indicator_id = i.id "\
-            "INNER JOIN workflow_program AS p ON p.id = ip.program_id "\
-            "INNER JOIN indicators_disaggregationvalue AS dv ON dv.id = cdv.disaggregationvalue_id "\
-            "INNER JOIN indicators_disaggregationlabel AS l ON l.id = dv.disaggregation_label_id "\
-            "INNER JOIN indicators_disaggregationtype AS dt ON dt.id = l.disaggregation_type_id "\
-            "WHERE p.id = %s "\
-            "GROUP BY IndicatorID, DType, customsort, Disaggregation "\
-            "ORDER BY IndicatorID, DType, customsort, Disaggregation;" % program_id
-        cursor = connection.cursor()
-        cursor.execute(disagg_query)
-        disdata = dictfetchall(cursor)
-
-        indicator_query = "SELECT DISTINCT p.id as PID, i.id AS IndicatorID, i.number AS INumber, "\
-            "i.name AS Indicator, i.lop_target AS LOP_Target, SUM(cd.achieved) AS Overall "\
-            "FROM indicators_indicator AS i "\
-            "INNER JOIN indicators_indicator_program AS ip ON ip.indicator_id = i.id "\
-            "INNER JOIN workflow_program AS p ON p.id = ip.program_id "\
-            "LEFT OUTER JOIN indicators_collecteddata AS cd ON i.id = cd.indicator_id "\
-            "WHERE p.id = %s "\
-            "GROUP BY PID, IndicatorID "\
-            "ORDER BY Indicator; " % program_id
-        cursor.execute(indicator_query)
-        idata = dictfetchall(cursor)
-
-        for indicator in idata:
-            indicator["disdata"] = []
-            for i, dis in enumerate(disdata):
-                if dis['IndicatorID'] == indicator['IndicatorID']:
-                    indicator["disdata"].append(disdata[i])
-
+        idata = get_disaggregation_report(program_ids)
         context['program_id'] = program_id
         context['data'] = idata
         context['getPrograms'] = programs
@@ -1484,23 +1499,17 @@ class DisaggregationPrint(DisaggregationReportMixin, TemplateView):
     template_name = 'indicators/disaggregation_print.html'
 
     def get(self, request, *args, **kwargs):
-        context = super(DisaggregationPrint, self).get_context_data(**kwargs)
-        hmtl_string = render(request, self.template_name, {
-                             'data': context['data'], 'program_selected': context['program_selected']})
-        pdffile = HTML(string=hmtl_string.content)
-
-        result = pdffile.write_pdf(stylesheets=[CSS(
-            string='@page {\
-                size: letter; margin: 1cm;\
-                @bottom-right{\
-                    content: "Page " counter(page) " of " counter(pages);\
-                };\
-            }'
-        )])
-        res = HttpResponse(result, content_type='application/pdf')
-        res['Content-Disposition'] = 'attachment; filename=indicators_disaggregation_report.pdf'
-        res['Content-Transfer-Encoding'] = 'binary'
-        return res
+        program_ids = self.get_report_program_ids(
+            int(kwargs.get('program', 0)), self.get_report_programs())
+
+        def render_html():
+            context = super(DisaggregationPrint, self).get_context_data(**kwargs)
+            return render(request, self.template_name, {
+                'data': context['data'],
+                'program_selected': context['program_selected']}).content
+
+        return cached_pdf_response(
+            request, get_pdf_key('disaggregation', program_ids), render_html, program_ids)
 
 
 class TVAPrint(TemplateView):
@@ -1508,42 +1517,49 @@ class TVAPrint(TemplateView):
 
     def get(self, request, *args, **kwargs):
         program = Program.objects.filter(
-            id=kwargs.get('program', None)).first()
-        indicators = Indicator.objects\
-            .select_related('sector')\
-            .prefetch_related('indicator_type', 'level', 'program')\
-            .filter(program=program)\
-            .annotate(actuals=Sum('collecteddata__achieved'))
-
-        hmtl_string = render(request, 'indicators/tva_print.html',
-                             {'data': indicators, 'program': program})
-        pdffile = HTML(string=hmtl_string.content)
-        result = pdffile.write_pdf(stylesheets=[CSS(
-            string='@page {\
-                size: letter; margin: 1cm;\
-                @bottom-right{\
-                    content: "Page " counter(page) " of " counter(pages);\
-                };\
-            }'
-        )])
-        res = HttpResponse(result, content_type='application/pdf')
-        res['Content-Disposition'] = 'attachment; filename=tva.pdf'
-        res['Content-Transfer-Encoding'] = 'binary'
-        """
-        with tempfile.NamedTemporaryFile(delete=True) as output:
-            output.write(result)
-            output.flush()
-            output = open(output.name, 'r')
-            res.write(output.read())
-        """
-        """
-        # Create the PDF object, using the response object as its "file."
-        p = canvas.Canvas(res)
-        p.drawString(100, 100, 'hello world!')
-        p.showPage()
-        p.save()
-        """
-        return res
+            id=kwargs.get('program', None), country__in=get_country(request.user)).first()
+        if not program:
+            raise Http404("Program does not exist")
+
+        def render_html():
+            indicators = Indicator.objects\
+                .select_related('sector')\
+                .prefetch_related('indicator_type', 'level', 'program')\
+                .filter(program=program)\
+                .annotate(actuals=Sum('indicatorrollup__actual_total'))
+            return render(request, self.template_name,
+                          {'data': indicators, 'program': program}).content
+
+        return cached_pdf_response(
+            request, get_pdf_key('tva', [program.pk]), render_html, [program.pk])
+
+
+def check_pdf_access(user, key):
+    """
+    A queued print is only polled and downloaded by the users of the
+    countries of all its programs
+    """
+    program_ids = set(get_pdf_program_ids(key) or [])
+    if not program_ids or Program.objects.filter(id__in=program_ids, country__in=get_country(user))\
+            .values('id').distinct().count() != len(program_ids):
+        raise Http404("PDF does not exist")
+
+
+@login_required(login_url='/accounts/login/')
+def pdf_status(request, key):
+    """
+    Poll a queued print, the download URL serves it once the status is ready
+    """
+    check_pdf_access(request.user, key)
+    return JsonResponse(pdf_status_data(key, get_pdf_status(key)))
+
+
+@login_required(login_url='/accounts/login/')
+def pdf_download(request, key):
+    check_pdf_access(request.user, key)
+    if get_pdf_status(key) != 'ready':
+        raise Http404("PDF is not ready")
+    return pdf_file_response(key)
 
 
 class TVAReport(TemplateView):
@@ -1571,7 +1587,7 @@ class TVAReport(TemplateView):
             .select_related('sector')\
             .prefetch_related('indicator_type', 'level', 'program')\
             .filter(**filters)\
-            .annotate(actuals=Sum('collecteddata__achieved'))
+            .annotate(actuals=Sum('indicatorrollup__actual_total'))
         context['data'] = indicators
         context['getIndicators'] = Indicator.objects.filter(
             program__country__in=countries).exclude(collecteddata__isnull=True)
@@ -1653,11 +1669,12 @@ class CollectedDataList(ListView):
                                         'activity_table', 'periodic_target', 'achieved')
 
         if self.request.GET.get('export'):
-            dataset = CollectedDataResource().export(indicators)
-            response = HttpResponse(
-                dataset.csv, content_type='application/ms-excel')
-            response['Content-Disposition'] = 'attachment; filename=indicator_data.csv'
-            return response
+            # export the model rows, the values() listing above has no attributes for the resource fields
+            collecteddata_export = CollectedData.objects.all().select_related(
+                'indicator', 'agreement', 'complete', 'program', 'periodic_target')\
+                .filter(program__country__in=countries).filter(**q)\
+                .order_by('indicator__program__name', 'indicator__number')
+            return export_csv_response(CollectedDataResource(), collecteddata_export, 'indicator_data.csv')
 
         return render(request, self.template_name, {
             'indicators': indicators,
@@ -1693,11 +1710,7 @@ class IndicatorExport(View):
         queryset = Indicator.objects.filter(
             **kwargs).filter(program__country__in=countries)
 
-        indicator = IndicatorResource().export(queryset)
-        response = HttpResponse(
-            indicator.csv, content_type='application/ms-excel')
-        response['Content-Disposition'] = 'attachment; filename=indicator.csv'
-        return response
+        return export_csv_response(IndicatorResource(), queryset, 'indicator.csv')
 
 
 class IndicatorDataExport(View):
@@ -1721,20 +1734,13 @@ class IndicatorDataExport(View):
 
         queryset = CollectedData.objects.filter(
             **kwargs).filter(indicator__program__country__in=countries)
-        dataset = CollectedDataResource().export(queryset)
-        response = HttpResponse(
-            dataset.csv, content_type='application/ms-excel')
-        response['Content-Disposition'] = 'attachment; filename=indicator_data.csv'
-        return response
+        return export_csv_response(CollectedDataResource(), queryset, 'indicator_data.csv')
 
 
 class CountryExport(View):
 
     def get(self, *args, **kwargs):
-        country = CountryResource().export()
-        response = HttpResponse(country.csv, content_type="csv")
-        response['Content-Disposition'] = 'attachment; filename=country.csv'
-        return response
+        return export_csv_response(CountryResource(), None, 'country.csv', content_type="csv")
 
 
 def const_table_det_url(url):
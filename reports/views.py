@@ -8,7 +8,9 @@ from .forms import FilterForm
 
 from django.db.models import Q
 from workflow.mixins import AjaxableResponseMixin
-from django.http import HttpResponse, JsonResponse
+from workflow.rollups import approval_status_counts
+from activity.export import export_csv_response
+from django.http import JsonResponse
 
 import json
 import simplejson
@@ -103,16 +105,8 @@ class ReportData(View, AjaxableResponseMixin):
 
         program = Program.objects.all().filter(**program_filter).values(
             'gaitid', 'name', 'funding_status', 'cost_center', 'country__country', 'sector__sector')
-        approval_count = ProjectAgreement.objects.all().filter(
-            **project_filter).filter(approval='awaiting approval').count()
-        approved_count = ProjectAgreement.objects.all().filter(
-            **project_filter).filter(approval='approved').count()
-        rejected_count = ProjectAgreement.objects.all().filter(
-            **project_filter).filter(approval='rejected').count()
-        inprogress_count = ProjectAgreement.objects.all().filter(
-            **project_filter).filter(approval='in progress').count()
-        nostatus_count = ProjectAgreement.objects.all().filter(
-            **project_filter).filter(Q(Q(approval=None) | Q(approval=""))).count()
+        agreement_counts = approval_status_counts(
+            ProjectAgreement.objects.filter(**project_filter))
 
         indicator_count = Indicator.objects.all().filter(
             **indicator_filter).filter(collecteddata__isnull=True).count()
@@ -123,22 +117,18 @@ class ReportData(View, AjaxableResponseMixin):
 
         final_dict = {
             'criteria': program_filter, 'program': program_serialized,
-            'approval_count': approval_count,
-            'approved_count': approved_count,
-            'rejected_count': rejected_count,
-            'inprogress_count': inprogress_count,
-            'nostatus_count': nostatus_count,
+            'approval_count': agreement_counts['awaiting_approval'],
+            'approved_count': agreement_counts['approved'],
+            'rejected_count': agreement_counts['rejected'],
+            'inprogress_count': agreement_counts['in_progress'],
+            'nostatus_count': agreement_counts['no_status'],
             'indicator_count': indicator_count,
             'data_count': indicator_data_count
         }
 
         if request.GET.get('export'):
             program_export = Program.objects.all().filter(**program_filter)
-            program_dataset = ProgramResource().export(program_export)
-            response = HttpResponse(
-                program_dataset.csv, content_type='application/ms-excel')
-            response['Content-Disposition'] = 'attachment; filename=program_data.csv'
-            return response
+            return export_csv_response(ProgramResource(), program_export, 'program_data.csv')
 
         return JsonResponse(final_dict, safe=False)
 
@@ -189,11 +179,7 @@ class ProjectReportData(View, AjaxableResponseMixin):
 
         if request.GET.get('export'):
             project_export = ProjectAgreement.objects.all().filter(**project_filter)
-            dataset = ProjectAgreementResource().export(project_export)
-            response = HttpResponse(
-                dataset.csv, content_type='application/ms-excel')
-            response['Content-Disposition'] = 'attachment; filename=project_data.csv'
-            return response
+            return export_csv_response(ProjectAgreementResource(), project_export, 'project_data.csv')
 
         return JsonResponse(final_dict, safe=False)
 
@@ -230,11 +216,7 @@ class IndicatorReportData(View, AjaxableResponseMixin):
 
         if request.GET.get('export'):
             indicator_export = Indicator.objects.all().filter(**indicator_filter)
-            dataset = IndicatorResource().export(indicator_export)
-            response = HttpResponse(
-                dataset.csv, content_type='application/ms-excel')
-            response['Content-Disposition'] = 'attachment; filename=indicator_data.csv'
-            return response
+            return export_csv_response(IndicatorResource(), indicator_export, 'indicator_data.csv')
 
         return JsonResponse(final_dict, safe=False)
 
@@ -263,11 +245,7 @@ class CollectedDataReportData(View, AjaxableResponseMixin):
 
         if request.GET.get('export'):
             collecteddata_export = CollectedData.objects.all().filter(**collecteddata_filter)
-            dataset = CollectedDataResource().export(collecteddata_export)
-            response = HttpResponse(
-                dataset.csv, content_type='application/ms-excel')
-            response['Content-Disposition'] = 'attachment; filename=collecteddata_data.csv'
-            return response
+            return export_csv_response(CollectedDataResource(), collecteddata_export, 'collecteddata_data.csv')
 
         return JsonResponse(final_dict, safe=False)
 
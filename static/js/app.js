@@ -447,4 +447,22 @@ function confirmshort() {
            document.getElementById('id_short').checked = true;
 
       }
-    }
\ No newline at end of file
+    }
+/*
+* Request a PDF print, while it is rendered on the server poll its status
+* and download it once it is ready
+*/
+function downloadPdf(url, polling) {
+    $.getJSON(url, function (data) {
+        if (data.status == 'ready') {
+            window.location.href = data.download_url;
+        } else if (data.status == 'pending') {
+            if (!polling) {
+                createAlert('info', 'Preparing the PDF, the download will start when it is ready', true);
+            }
+            setTimeout(function () { downloadPdf(data.poll_url, true); }, 2000);
+        } else {
+            createAlert('danger', 'The PDF could not be created, please try again', false);
+        }
+    });
+}
@@ -5,7 +5,7 @@ from .models import *
 from import_export import resources, fields
 from import_export.widgets import ForeignKeyWidget
 from import_export.admin import ImportExportModelAdmin, ExportMixin
-from activity.util import get_country
+from activity.util import get_country_ids
 from adminreport.mixins import ChartReportAdmin
 
 
@@ -60,7 +60,7 @@ class ProjectAgreementAdmin(ImportExportModelAdmin):
         `self.value()`.
         """
         # Filter by logged in users allowable countries
-        user_countries = get_country(request.user)
+        user_countries = get_country_ids(request.user)
         # if not request.user.user.is_superuser:
         return queryset.filter(country__in=user_countries)
 
@@ -96,7 +96,7 @@ class ProjectCompleteAdmin(ImportExportModelAdmin):
         `self.value()`.
         """
         # Filter by logged in users allowable countries
-        user_countries = get_country(request.user)
+        user_countries = get_country_ids(request.user)
         # if not request.user.user.is_superuser:
         return queryset.filter(country__in=user_countries)
 
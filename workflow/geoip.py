@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import csv
+import ipaddress
+import logging
+import threading
+from bisect import bisect_right
+from functools import lru_cache
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+UNDEFINED_COUNTRY = "undefined"
+
+# CSV of "network,country" rows such as "41.0.0.0/11,za", the country is
+# stored lower case like ipinfo.io returned it. Without the file every
+# address resolves to UNDEFINED_COUNTRY, logins never wait on the network
+GEOIP_CIDR_FILE = getattr(settings, 'GEOIP_CIDR_FILE', None)
+GEOIP_CACHE_SIZE = getattr(settings, 'GEOIP_CACHE_SIZE', 4096)
+
+
+class CountryRanges(object):
+    """
+    Address ranges of a CIDR file sorted by their first address, one table
+    per IP version, looked up with a binary search
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tables = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        ranges = {4: [], 6: []}
+        if self.path:
+            try:
+                with open(self.path, newline='') as cidr_file:
+                    for row in csv.reader(cidr_file):
+                        try:
+                            network = ipaddress.ip_network(row[0].strip(), strict=False)
+                        except (IndexError, ValueError):
+                            # header or malformed row
+                            continue
+                        ranges[network.version].append(
+                            (int(network.network_address), int(network.broadcast_address), row[1].strip().lower()))
+            except (IOError, IndexError) as e:
+                logger.error('could not load GEOIP_CIDR_FILE %s: %s', self.path, e)
+        tables = {}
+        for version, rows in ranges.items():
+            rows.sort()
+            tables[version] = ([row[0] for row in rows], rows)
+        return tables
+
+    def tables(self):
+        if self._tables is None:
+            with self._lock:
+                if self._tables is None:
+                    self._tables = self.load()
+        return self._tables
+
+    def country(self, ip):
+        """
+        :param ip: IPv4 or IPv6 address string
+        :return: lower case country code, UNDEFINED_COUNTRY when not found
+        """
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return UNDEFINED_COUNTRY
+        starts, rows = self.tables()[address.version]
+        position = bisect_right(starts, int(address)) - 1
+        if position >= 0 and int(address) <= rows[position][1]:
+            return rows[position][2]
+        return UNDEFINED_COUNTRY
+
+
+country_ranges = CountryRanges(GEOIP_CIDR_FILE)
+
+
+@lru_cache(maxsize=GEOIP_CACHE_SIZE)
+def get_ip_country(ip):
+    if not ip:
+        return UNDEFINED_COUNTRY
+    return country_ranges.country(ip)
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import csv
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from workflow.models import Country, Province, District, AdminLevelThree, Village
+
+# model and foreign key to the parent level, Province hangs from the country
+ADMIN_LEVELS = (
+    (Province, 'country'),
+    (District, 'province'),
+    (AdminLevelThree, 'district'),
+    (Village, 'admin_3'),
+)
+
+
+class Command(BaseCommand):
+    help = """
+        Import the administrative levels of a country from a CSV file, columns 2 to 5 hold
+        the Admin Level 1 (province), 2 (district), 3 and 4 (village) names.
+        The file is read once and only the levels missing in the database are created.
+        usage: manage.py import_adminlevels -f fixtures/Liberia_Admin.csv --country Liberia [--skip-header]
+        """
+
+    def add_arguments(self, parser):
+        parser.add_argument('-f', '--file', action='store',
+                            nargs='?', required=True, dest='filepath')
+        parser.add_argument('--country', required=True,
+                            help='name of an existing country')
+        parser.add_argument('--skip-header', action='store_true', dest='skip_header')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            help='count the missing levels without creating them')
+
+    def handle(self, *args, **options):
+        started = time.time()
+        try:
+            country = Country.objects.get(country=options['country'])
+        except Country.DoesNotExist:
+            raise CommandError('country "%s" does not exist' % options['country'])
+        self.stdout.write(self.style.WARNING(
+            'importing admin levels of %s from "%s"' % (country, options['filepath'])))
+
+        levels = self.read_levels(options['filepath'], options['skip_header'])
+        # row id of every name path of the file, the empty path is the country
+        self.ids = {(): country.id}
+        with transaction.atomic():
+            for (model, parent_field), paths in zip(ADMIN_LEVELS, levels):
+                existing, missing = self.sync_level(model, parent_field, paths, options['dry_run'])
+                self.stdout.write('%s: %s existing, %s %s' % (
+                    model._meta.verbose_name, existing, missing,
+                    'missing' if options['dry_run'] else 'created'))
+
+        self.stdout.write(self.style.SUCCESS(
+            'admin levels of %s imported in %.1fs' % (country, time.time() - started)))
+
+    def read_levels(self, filepath, skip_header=False):
+        """
+        Read the file once
+        :return: list of four sets of name paths, (province,), (province, district), ...
+        """
+        levels = [set(), set(), set(), set()]
+        with open(filepath, newline='') as csvfile:
+            reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+            if skip_header:
+                next(reader, None)
+            for row in reader:
+                path = ()
+                for level, name in enumerate(column.strip() for column in row[1:5]):
+                    # a blank name ends the branch, the levels below it have no parent
+                    if not name:
+                        break
+                    path += (name,)
+                    levels[level].add(path)
+        return levels
+
+    def load_level(self, model, parent_field, parent_ids):
+        """
+        :return: dict of (parent id, name) to row id, the oldest row wins on duplicates
+        """
+        rows = model.objects.filter(**{'%s_id__in' % parent_field: parent_ids})\
+            .order_by('-id').values_list('%s_id' % parent_field, 'name', 'id')
+        return dict(((parent_id, name), pk) for parent_id, name, pk in rows)
+
+    def sync_level(self, model, parent_field, paths, dry_run=False):
+        """
+        Insert the rows of a level that do not exist under their parent yet
+        :return: tuple of (existing count, missing count)
+        """
+        parent_ids = set(self.ids[path[:-1]] for path in paths if path[:-1] in self.ids)
+        level = self.load_level(model, parent_field, parent_ids)
+
+        now = timezone.now()
+        missing = {}
+        for path in paths:
+            parent_id = self.ids.get(path[:-1])
+            key = (parent_id, path[-1])
+            # parents that do not exist yet only happen on a dry run
+            if parent_id is None or key not in level:
+                missing[path] = model(name=path[-1], create_date=now, edit_date=now,
+                                      **{'%s_id' % parent_field: parent_id})
+                if model is Village:
+                    missing[path].district_id = self.ids.get(path[:2])
+        existing = len(paths) - len(missing)
+
+        if missing and not dry_run:
+            model.objects.bulk_create(missing.values(), batch_size=1000)
+            # read the level back for the ids of the new rows
+            level = self.load_level(model, parent_field, parent_ids)
+        for path in paths:
+            pk = level.get((self.ids.get(path[:-1]), path[-1]))
+            if pk is not None:
+                self.ids[path] = pk
+        return existing, len(missing)
@@ -3,15 +3,50 @@
 
 import csv
 import re
+import time
+from itertools import islice
+
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from simple_history.utils import bulk_create_with_history
 from workflow.models import *
+from activity.util import bulk_update_with_history
 from django.utils import timezone
 
+SITE_FIELDS = ['type', 'office', 'contact_leader', 'latitude', 'longitude',
+               'country', 'province', 'district', 'edit_date']
+
+
+class CountryLookups(object):
+    """
+    Provinces, districts and offices of a country by name, loaded once so
+    the rows of the country are matched without a query
+    """
+
+    def __init__(self, country):
+        self.country = country
+        self.provinces = dict((province.name, province)
+                              for province in Province.objects.filter(country=country))
+        self.districts = {}
+        for district in District.objects.filter(province__country=country):
+            self.districts.setdefault(district.name, []).append(district)
+        self.offices = {}
+        for office in Office.objects.filter(province__country=country):
+            self.offices.setdefault(office.name, []).append(office)
+
+    def get_district(self, name, province):
+        districts = self.districts.get(name, [])
+        # a district name can repeat across provinces, prefer the site's own
+        for district in districts:
+            if district.province_id == province.id:
+                return district
+        return districts[0] if districts else None
+
 
 class Command(BaseCommand):
     help = """
-        Uploads sites from a CSV file
-        usage: sudo py -W ignore  manage.py upload_sites -f ~/country_data.csv
+        Uploads sites from a CSV file, sites are matched to the existing ones by name
+        usage: sudo py -W ignore  manage.py upload_sites -f ~/country_data.csv [--batch_size 1000]
         """
 
     def add_arguments(self, parser):
@@ -20,105 +55,152 @@ class Command(BaseCommand):
         """
         parser.add_argument('-f', '--file', action='store',
                             nargs='?', required=True, dest='filepath')
+        parser.add_argument('--batch_size', type=int, default=1000,
+                            help='sites written per transaction')
 
     def handle(self, *args, **options):
         file = options['filepath']
         self.stdout.write(self.style.WARNING(
             'reading sites from: "%s"' % file))
 
-        with open(file, 'rb') as csvfile:
+        self.countries = {}
+        self.profile_types = dict((profile_type.profile, profile_type)
+                                  for profile_type in ProfileType.objects.all())
+        self.summary = {'created': 0, 'updated': 0, 'rejected': 0}
+        started = time.time()
+        rows_read = 0
+
+        with open(file, newline='') as csvfile:
             sites_reader = csv.reader(csvfile)
             # This skips the first row (header) of the CSV file.
             next(sites_reader)
 
-            for row in sites_reader:
-                site_name = row[0].strip()
-                type_of_site = row[1].strip()
-                # read the first 7 characters only
-                # latitude = re.sub('[^0-9]', '', row[2])
-                latitude = re.findall(r'\d+\.\d+', row[2])
-                longitude = re.findall(r'\d+\.\d+', row[3])
-                office_name = row[4].strip()
-                contact = row[5].strip()
-                country_name = row[6].strip()
-                province_name = row[7].strip()
-                district_name = row[8].strip()
-
-                try:
-                    latitude = latitude[0]
-                except IndexError:
-                    latitude = None
-
-                try:
-                    longitude = longitude[0]
-                except IndexError:
-                    longitude = None
-
-                try:
-                    country = Country.objects.get(country=country_name)
-                except Country.DoesNotExist:
-                    self.stdout.write(self.style.ERROR(
-                        '%s, country not found (%s)' % (site_name, country_name)))
-                    continue
-
-                try:
-                    provinces = Province.objects.filter(country=country)
-                    office = Office.objects.get(
-                        name=office_name, province__in=provinces)
-                except Office.DoesNotExist:
-                    self.stdout.write(self.style.WARNING(
-                        '%s, invalid office_name = %s' % (site_name, office_name)))
-                    office = None
-                except Office.MultipleObjectsReturned:
-                    self.stdout.write(self.style.WARNING(
-                        '%s, multiple offices with the same name = %s' % (site_name, office_name)))
-                    office = None
-
-                try:
-                    profile_type = ProfileType.objects.get(
-                        profile=type_of_site)
-                except ProfileType.DoesNotExist:
-                    profile_type = None
-
-                try:
-                    province = Province.objects.get(name=province_name)
-                except Province.DoesNotExist:
-                    self.stdout.write(self.style.ERROR(
-                        '%s, province not found (%s)' % (site_name, province_name)))
-                    continue
-
-                try:
-                    district = District.objects.get(name=district_name)
-                except District.DoesNotExist:
-                    self.stdout.write(self.style.ERROR(
-                        '%s, district not found (%s)' % (site_name, district_name)))
-                    continue
-
-                try:
-                    lat = float(latitude)
-                except ValueError as e:
-                    lat = None
-                    self.stdout.write(self.style.WARNING(
-                        '%s, invalid latitude = %s' % (site_name, latitude)))
-
-                try:
-                    lon = float(longitude)
-                except ValueError as e:
-                    lon = None
-                    self.stdout.write(self.style.WARNING(
-                        '%s, invalid longitude = %s' % (site_name, longitude)))
-
-                try:
-                    site, created = SiteProfile.objects.update_or_create(
-                        name=site_name,
-                        defaults={
-                            'type': profile_type, 'office': office, 'contact_leader': contact,
-                            'latitude': lat, 'longitude': lon, 'country': country, 'province': province,
-                            'district': district, 'create_date': timezone.now()
-                        })
-                    self.stdout.write(self.style.SUCCESS(
-                        '%s site_profile created(%s) successfully!' % (site_name, created)))
-                except Exception as e:
-                    self.stdout.write(self.style.ERROR(
-                        '%s, could not update or create site_profile %s ' % (site_name, e)))
-                    continue
+            while True:
+                rows = list(islice(sites_reader, options['batch_size']))
+                if not rows:
+                    break
+                rows_read += len(rows)
+                sites = {}
+                for row in rows:
+                    site = self.read_site(row)
+                    if site is None:
+                        self.summary['rejected'] += 1
+                    else:
+                        # the last row of a site name wins, as it did row by row
+                        sites[site['name']] = site
+                self.save_sites(sites)
+                self.stdout.write('%s rows read, %s created, %s updated, %s rejected' % (
+                    rows_read, self.summary['created'], self.summary['updated'], self.summary['rejected']))
+
+        elapsed = max(time.time() - started, 0.001)
+        self.stdout.write(self.style.SUCCESS(
+            '%s rows in %.1fs (%.0f rows/s): %s sites created, %s updated, %s rows rejected' % (
+                rows_read, elapsed, rows_read / elapsed, self.summary['created'],
+                self.summary['updated'], self.summary['rejected'])))
+
+    def get_country(self, country_name):
+        if country_name not in self.countries:
+            country = Country.objects.filter(country=country_name).first()
+            self.countries[country_name] = CountryLookups(country) if country else None
+        return self.countries[country_name]
+
+    def read_site(self, row):
+        """
+        Match a CSV row to its country, office, profile type, province and district
+        :return: dict of SiteProfile field values, None when the row is rejected
+        """
+        site_name = row[0].strip()
+        type_of_site = row[1].strip()
+        # read the first 7 characters only
+        # latitude = re.sub('[^0-9]', '', row[2])
+        latitude = re.findall(r'\d+\.\d+', row[2])
+        longitude = re.findall(r'\d+\.\d+', row[3])
+        office_name = row[4].strip()
+        contact = row[5].strip()
+        country_name = row[6].strip()
+        province_name = row[7].strip()
+        district_name = row[8].strip()
+
+        lookups = self.get_country(country_name)
+        if lookups is None:
+            self.stdout.write(self.style.ERROR(
+                '%s, country not found (%s)' % (site_name, country_name)))
+            return None
+
+        offices = lookups.offices.get(office_name, [])
+        office = None
+        if not offices:
+            self.stdout.write(self.style.WARNING(
+                '%s, invalid office_name = %s' % (site_name, office_name)))
+        elif len(offices) > 1:
+            self.stdout.write(self.style.WARNING(
+                '%s, multiple offices with the same name = %s' % (site_name, office_name)))
+        else:
+            office = offices[0]
+
+        province = lookups.provinces.get(province_name)
+        if province is None:
+            self.stdout.write(self.style.ERROR(
+                '%s, province not found (%s)' % (site_name, province_name)))
+            return None
+
+        district = lookups.get_district(district_name, province)
+        if district is None:
+            self.stdout.write(self.style.ERROR(
+                '%s, district not found (%s)' % (site_name, district_name)))
+            return None
+
+        site = {
+            'name': site_name, 'type': self.profile_types.get(type_of_site), 'office': office,
+            'contact_leader': contact, 'country': lookups.country, 'province': province, 'district': district,
+        }
+
+        # invalid coordinates keep the current values, or the defaults of a new site
+        for field, values in (('latitude', latitude), ('longitude', longitude)):
+            try:
+                site[field] = float(values[0])
+            except (IndexError, ValueError):
+                self.stdout.write(self.style.WARNING(
+                    '%s, invalid %s = %s' % (site_name, field, values)))
+        return site
+
+    def save_sites(self, sites):
+        """
+        Update the sites that already exist by name and insert the others,
+        one bulk query each
+        :param sites: dict of site name to SiteProfile field values
+        """
+        now = timezone.now()
+        existing = {}
+        for site in SiteProfile.objects.select_related(None).filter(name__in=list(sites)):
+            existing.setdefault(site.name, []).append(site)
+
+        created = []
+        updated = []
+        for name, values in sites.items():
+            matches = existing.get(name, [])
+            if len(matches) > 1:
+                self.stdout.write(self.style.ERROR(
+                    '%s, could not update or create site_profile, %s sites have this name' % (name, len(matches))))
+                self.summary['rejected'] += 1
+                continue
+            if matches:
+                site = matches[0]
+                updated.append(site)
+            else:
+                site = SiteProfile(create_date=now)
+                created.append(site)
+            for field, value in values.items():
+                setattr(site, field, value)
+            site.edit_date = now
+
+        with transaction.atomic():
+            if connection.features.can_return_ids_from_bulk_insert:
+                bulk_create_with_history(created, SiteProfile)
+            else:
+                # the history rows need the new ids
+                for site in created:
+                    site.save()
+            bulk_update_with_history(updated, SiteProfile, SITE_FIELDS, reason='upload_sites')
+        self.summary['created'] += len(created)
+        self.summary['updated'] += len(updated)
@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-17 18:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loggeduser',
+            name='login_date',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -1,7 +1,5 @@
 from __future__ import unicode_literals
 
-import json
-from urllib.request import urlopen
 from django.contrib.auth.signals import user_logged_in, user_logged_out
 from django.db import models
 from django.contrib import admin
@@ -12,11 +10,12 @@ from datetime import datetime
 import uuid
 
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.core.cache import cache
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 from simple_history.models import HistoricalRecords
-from django.contrib.sessions.models import Session
+from workflow.geoip import get_ip_country
 try:
     from django.utils import timezone
 except ImportError:
@@ -187,6 +186,34 @@ class ActivityUser(models.Model):
         super(ActivityUser, self).save()
 
 
+# cache key of the country IDs a user has access to, see activity.util.get_country_ids
+USER_COUNTRIES_CACHE_KEY = 'activity_user_countries_%s'
+
+
+def clear_user_countries_cache(user_ids):
+    cache.delete_many([USER_COUNTRIES_CACHE_KEY % user_id for user_id in user_ids])
+
+
+@receiver(m2m_changed, sender=ActivityUser.countries.through)
+def activityuser_countries_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        clear_user_countries_cache([instance.user_id])
+    elif action == 'pre_clear':
+        # reverse clear from a country, pk_set is not given
+        clear_user_countries_cache(instance.countries.values_list('user_id', flat=True))
+    else:
+        clear_user_countries_cache(ActivityUser.objects.filter(
+            pk__in=pk_set).values_list('user_id', flat=True))
+
+
+@receiver(post_save, sender=ActivityUser)
+@receiver(post_delete, sender=ActivityUser)
+def activityuser_changed(sender, instance, **kwargs):
+    clear_user_countries_cache([instance.user_id])
+
+
 class ActivityBookmarks(models.Model):
     user = models.ForeignKey(
         ActivityUser, related_name='activitybookmark', on_delete=models.CASCADE)
@@ -1393,6 +1420,41 @@ class ProjectComplete(models.Model):
         return self.project_name.encode('ascii', 'ignore')
 
 
+# cache key of the budget rollup of a program, see workflow.rollups.get_program_budget_rollups
+BUDGET_ROLLUP_CACHE_KEY = 'budget_rollup_%s'
+
+
+def clear_budget_rollup_cache(program_ids):
+    cache.delete_many([BUDGET_ROLLUP_CACHE_KEY % pk for pk in set(program_ids) if pk is not None])
+
+
+@receiver(post_init, sender=ProjectAgreement)
+@receiver(post_init, sender=ProjectComplete)
+def budget_rollup_snapshot(sender, instance, **kwargs):
+    # the program and agreement loaded, a save that moves the row clears the
+    # rollup it leaves too. Deferred fields are not read, it would be a query
+    instance._budget_program_id = instance.__dict__.get('program_id')
+    instance._budget_agreement_id = instance.__dict__.get('project_agreement_id')
+
+
+@receiver(post_save, sender=ProjectAgreement)
+@receiver(post_delete, sender=ProjectAgreement)
+def projectagreement_budget_changed(sender, instance, **kwargs):
+    clear_budget_rollup_cache([instance.program_id, instance._budget_program_id])
+    instance._budget_program_id = instance.program_id
+
+
+@receiver(post_save, sender=ProjectComplete)
+@receiver(post_delete, sender=ProjectComplete)
+def projectcomplete_budget_changed(sender, instance, **kwargs):
+    # the rollup groups the completes by the program of their agreement
+    agreement_ids = [pk for pk in (instance.project_agreement_id, instance._budget_agreement_id) if pk]
+    clear_budget_rollup_cache([instance.program_id, instance._budget_program_id] + list(
+        ProjectAgreement.objects.filter(pk__in=agreement_ids).values_list('program_id', flat=True)))
+    instance._budget_program_id = instance.program_id
+    instance._budget_agreement_id = instance.project_agreement_id
+
+
 # Project Documents, admin is handled in the admin.py
 class Documentation(models.Model):
     name = models.CharField(
@@ -1627,57 +1689,28 @@ class LoggedUser(models.Model):
     country = models.CharField(max_length=100, blank=False)
     email = models.CharField(max_length=100, blank=False,
                              default='user@mercycorps.com')
+    login_date = models.DateTimeField(null=True, blank=True, db_index=True)
 
     def __str__(self):
         return self.username
 
     def login_user(sender, request, user, **kwargs):
-        country = get_user_country(request)
-        active_sessions = Session.objects.filter(
-            expire_date__gte=timezone.now())
-
-        user_id_list = []
-        logged_user_id = request.user.id
-
-        try:
-            for session in active_sessions:
-                data = session.get_decoded()
-
-                user_id_list.append(data.get('_auth_user_id', None))
-
-                if logged_user_id in user_id_list:
-                    LoggedUser(username=user.username,
-                               country=country, email=user.email).save()
-
-                if data.get('google-oauth2_state'):
-                    LoggedUser(username=user.username,
-                               country=country, email=user.email).save()
-
-        except Exception as e:
-            pass
+        # one upsert on the primary key, the active sessions are not scanned
+        LoggedUser.objects.update_or_create(
+            username=user.username,
+            defaults={'country': get_user_country(request), 'email': user.email,
+                      'login_date': timezone.now()})
 
     def logout_user(sender, request, user, **kwargs):
-
-        try:
-            user = LoggedUser.objects.get(pk=user.username)
-            user.delete()
-
-        except LoggedUser.DoesNotExist:
-            pass
+        if user is not None:
+            LoggedUser.objects.filter(pk=user.username).delete()
 
     user_logged_in.connect(login_user)
     user_logged_out.connect(logout_user)
 
 
 def get_user_country(request):
-
-    # Automatically geolocate the connecting IP
-    ip = request.META.get('REMOTE_ADDR')
-    try:
-        response = urlopen('http://ipinfo.io/'+ip+'/json').read()
-        response = json.loads(response)
-        return response['country'].lower()
-
-    except Exception as e:
-        response = "undefined"
-        return response
+    """
+    Geolocate the connecting IP from the local CIDR table, see workflow.geoip
+    """
+    return get_ip_country(getattr(request, 'META', {}).get('REMOTE_ADDR'))
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from .models import ProjectAgreement, ProjectComplete, Program, BUDGET_ROLLUP_CACHE_KEY
+
+# seconds a program budget rollup is cached, it is also cleared when one of
+# its agreements or completes is saved
+BUDGET_ROLLUP_CACHE_TIMEOUT = getattr(settings, 'BUDGET_ROLLUP_CACHE_TIMEOUT', 3600)
+
+# approval buckets shared by the dashboards and reports, each one is
+# evaluated as a conditional COUNT so a rollup is a single query per model
+NO_STATUS = Q(approval=None) | Q(approval="")
+
+APPROVAL_BUCKETS = {
+    'total': None,
+    'approved': Q(approval='approved'),
+    'awaiting_approval': Q(approval='awaiting approval'),
+    'rejected': Q(approval='rejected'),
+    'in_progress': Q(approval='in progress'),
+    'open': Q(approval='open') | NO_STATUS,
+    'no_status': NO_STATUS,
+}
+
+
+def approval_status_counts(queryset):
+    """
+    Count every approval bucket of a ProjectAgreement or ProjectComplete
+    queryset with one conditional aggregation query
+    :param queryset: already filtered queryset
+    :return: dict of bucket name to count
+    """
+    aggregates = {}
+    for bucket, condition in APPROVAL_BUCKETS.items():
+        aggregates[bucket] = Count('pk', filter=condition, distinct=True)
+    return queryset.order_by().aggregate(**aggregates)
+
+
+def get_approval_filters(countries=None, sectors=None, program=None):
+    """
+    Build the agreement and complete filters for a dashboard scope
+    :param countries: countries to limit to, ignored when a program is given
+    :param sectors: sectors to limit to
+    :param program: program ID
+    :return: tuple of (agreement filter, complete filter)
+    """
+    agreement_filter = {}
+    complete_filter = {}
+    if program:
+        agreement_filter['program__id'] = program
+        complete_filter['program__id'] = program
+    elif countries is not None:
+        agreement_filter['program__country__in'] = countries
+        complete_filter['program__country__in'] = countries
+    if sectors is not None:
+        agreement_filter['sector__in'] = sectors
+        complete_filter['project_agreement__sector__in'] = sectors
+    return agreement_filter, complete_filter
+
+
+def get_approval_rollup(countries=None, sectors=None, program=None):
+    """
+    Approval status counts for agreements and completes of a dashboard scope
+    :param countries: countries to limit to
+    :param sectors: sectors to limit to
+    :param program: program ID
+    :return: dict with an 'agreement' and a 'complete' bucket dict
+    """
+    agreement_filter, complete_filter = get_approval_filters(
+        countries=countries, sectors=sectors, program=program)
+    return {
+        'agreement': approval_status_counts(
+            ProjectAgreement.objects.filter(**agreement_filter)),
+        'complete': approval_status_counts(
+            ProjectComplete.objects.filter(**complete_filter)),
+    }
+
+
+BUDGET_ROW_FIELDS = (
+    'project_agreement__program_id', 'project_agreement_id', 'id', 'project_agreement__activity_code',
+    'project_agreement__project_name', 'project_agreement__approval',
+    'project_agreement__total_estimated_budget', 'estimated_budget', 'actual_budget',
+)
+
+
+def budget_totals(rows):
+    """
+    :param rows: agreement budget rows, see get_agreement_budget_rollup
+    :return: dict of estimated, actual and variance totals and the row count
+    """
+    estimated = sum((row['total_estimated_budget'] for row in rows), Decimal('0.00'))
+    actual = sum((row['actual_budget'] for row in rows), Decimal('0.00'))
+    return {'estimated': estimated, 'actual': actual, 'variance': estimated - actual, 'count': len(rows)}
+
+
+def get_agreement_budget_rollup(**filters):
+    """
+    Estimated budget of the agreement against the actual cost of its
+    complete, for every completed agreement matching the filters, in one
+    joined query
+    :param filters: ProjectComplete filters
+    :return: list of dicts ordered by agreement ID
+    """
+    rows = []
+    completes = ProjectComplete.objects.filter(actual_budget__isnull=False, **filters)\
+        .order_by('project_agreement_id').values_list(*BUDGET_ROW_FIELDS)
+    for (program_id, agreement_id, complete_id, activity_code, project_name, approval,
+         total_estimated_budget, estimated_budget, actual_budget) in completes:
+        rows.append({
+            'program_id': program_id, 'agreement_id': agreement_id, 'complete_id': complete_id,
+            'activity_code': activity_code, 'project_name': project_name, 'approval': approval,
+            'total_estimated_budget': total_estimated_budget or Decimal('0.00'),
+            'estimated_budget': estimated_budget or Decimal('0.00'),
+            'actual_budget': actual_budget or Decimal('0.00'),
+        })
+    return rows
+
+
+def get_program_budget_rollups(program_ids):
+    """
+    Budget rollups of several programs, the ones not cached are computed
+    together in one query
+    :param program_ids: Program IDs
+    :return: dict of program ID to a dict of the totals and the agreement rows
+    """
+    program_ids = set(program_ids)
+    cached = cache.get_many([BUDGET_ROLLUP_CACHE_KEY % pk for pk in program_ids])
+    rollups = dict((pk, cached[BUDGET_ROLLUP_CACHE_KEY % pk]) for pk in program_ids
+                   if BUDGET_ROLLUP_CACHE_KEY % pk in cached)
+    missing = program_ids - set(rollups)
+    if missing:
+        rows = dict((pk, []) for pk in missing)
+        for row in get_agreement_budget_rollup(project_agreement__program_id__in=missing):
+            rows[row['program_id']].append(row)
+        for pk, program_rows in rows.items():
+            rollups[pk] = dict(budget_totals(program_rows), agreements=program_rows)
+        cache.set_many(dict((BUDGET_ROLLUP_CACHE_KEY % pk, rollups[pk]) for pk in missing),
+                       BUDGET_ROLLUP_CACHE_TIMEOUT)
+    return rollups
+
+
+def get_program_budget_rollup(program_id):
+    """
+    :param program_id: Program ID
+    :return: dict of estimated, actual, variance and count totals and the
+        agreements rows of the program
+    """
+    return get_program_budget_rollups([int(program_id)])[int(program_id)]
+
+
+def get_country_budget_rollup(country_ids):
+    """
+    Budget totals per country, summed from the cached program rollups. A
+    program in several countries counts in each of them
+    :param country_ids: Country IDs
+    :return: dict of country ID to a dict of the totals and program IDs
+    """
+    country_ids = set(country_ids)
+    country_programs = dict((pk, []) for pk in country_ids)
+    for country_id, program_id in Program.country.through.objects.filter(country_id__in=country_ids)\
+            .order_by('program_id').values_list('country_id', 'program_id'):
+        country_programs[country_id].append(program_id)
+    rollups = get_program_budget_rollups(
+        program_id for programs in country_programs.values() for program_id in programs)
+    countries = {}
+    for country_id, programs in country_programs.items():
+        rows = [row for program_id in programs for row in rollups[program_id]['agreements']]
+        countries[country_id] = dict(budget_totals(rows), programs=programs)
+    return countries
@@ -1,11 +1,30 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from django.test import TestCase
+import gzip
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.http import HttpRequest
+from django.test import RequestFactory, TestCase
 from workflow.models import (
-    Organization, Program, Country, Province, ProjectAgreement, Sector,
-    ProjectComplete, ProjectType, SiteProfile, Office, Monitor, Benchmarks, Budget
+    Organization, Program, Country, Province, District, AdminLevelThree, Village, ProjectAgreement, Sector,
+    ProjectComplete, ProjectType, SiteProfile, Office, Monitor, Benchmarks, Budget,
+    ActivityUser, LoggedUser
 )
+from workflow import geoip
+from activity.responses import json_lists_response
+from activity.util import get_country, get_country_ids
+from workflow.rollups import (
+    approval_status_counts, get_approval_rollup, get_program_budget_rollup, get_country_budget_rollup)
 
 
 class SiteProfileTestCase(TestCase):
@@ -38,6 +57,57 @@ class SiteProfileTestCase(TestCase):
         self.assertEqual(SiteProfile.objects.filter(
             id=get_community.id).count(), 1)
 
+    def test_upload_sites(self):
+        """Check upload_sites updates sites by name, creates the new ones and rejects unknown places"""
+        District.objects.create(name="testdistrict", province=Province.objects.get(name="testprovince"))
+        history_count = SiteProfile.objects.get(name="testcommunity").history.count()
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csvfile:
+            csvfile.write('name,type,lat,lon,office,contact,country,province,district\n')
+            csvfile.write('testcommunity,,34.5,69.1,testoffice,leader,testcountry,testprovince,testdistrict\n')
+            csvfile.write('newsite,,n/a,69.2,testoffice,,testcountry,testprovince,testdistrict\n')
+            csvfile.write('lostsite,,34.5,69.1,testoffice,,testcountry,otherprovince,testdistrict\n')
+        try:
+            out = StringIO()
+            call_command('upload_sites', filepath=csvfile.name, stdout=out)
+        finally:
+            os.remove(csvfile.name)
+
+        self.assertIn('1 sites created, 1 updated, 1 rows rejected', out.getvalue())
+        updated = SiteProfile.objects.get(name="testcommunity")
+        self.assertEqual((updated.contact_leader, float(updated.latitude), updated.district.name),
+                         ("leader", 34.5, "testdistrict"))
+        self.assertEqual(updated.history.count(), history_count + 1)
+        created = SiteProfile.objects.get(name="newsite")
+        self.assertEqual((float(created.latitude), float(created.longitude)), (0, 69.2))
+        self.assertFalse(SiteProfile.objects.filter(name="lostsite").exists())
+
+    def test_import_adminlevels(self):
+        """Check import_adminlevels only creates the levels missing under their parent"""
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csvfile:
+            csvfile.write('code,province,district,level3,village\n')
+            csvfile.write('1,testprovince,north,ward 1,village a\n')
+            csvfile.write('2,testprovince,north,ward 1,village b\n')
+            csvfile.write('3,newprovince,north,ward 1,village a\n')
+            csvfile.write('4,newprovince,south,,\n')
+        try:
+            for i in range(2):
+                call_command('import_adminlevels', filepath=csvfile.name, country="testcountry",
+                             skip_header=True, stdout=StringIO())
+            with self.assertRaises(CommandError):
+                call_command('import_adminlevels', filepath=csvfile.name, country="testcountri",
+                             dry_run=True, stdout=StringIO())
+            self.assertFalse(Country.objects.filter(country="testcountri").exists())
+        finally:
+            os.remove(csvfile.name)
+
+        self.assertEqual(Province.objects.filter(country__country="testcountry").count(), 2)
+        self.assertEqual(sorted(District.objects.values_list('province__name', 'name')),
+                         [('newprovince', 'north'), ('newprovince', 'south'), ('testprovince', 'north')])
+        self.assertEqual(AdminLevelThree.objects.count(), 2)
+        village = Village.objects.get(name="village b")
+        self.assertEqual((village.admin_3.name, village.district.province.name), ("ward 1", "testprovince"))
+        self.assertEqual(Village.objects.count(), 3)
+
 
 class AgreementTestCase(TestCase):
 
@@ -161,3 +231,179 @@ class CompleteTestCase(TestCase):
         get_complete = ProjectComplete.objects.get(project_name="testproject")
         self.assertEqual(ProjectComplete.objects.filter(
             id=get_complete.id).count(), 1)
+
+
+class ApprovalRollupTestCase(TestCase):
+
+    fixtures = ['fixtures/projecttype.json', 'fixtures/sectors.json']
+
+    def setUp(self):
+        new_organization = Organization.objects.create(name="activity")
+        new_country = Country.objects.create(
+            country="testcountry", organization=new_organization)
+        self.program = Program.objects.create(name="testprogram")
+        self.program.country.add(new_country)
+        new_province = Province.objects.create(
+            name="testprovince", country=new_country)
+        new_office = Office.objects.create(
+            name="testoffice", province=new_province)
+        get_sector = Sector.objects.get(id='2')
+        for name, approval in (("approved", "approved"), ("awaiting", "awaiting approval"),
+                               ("progress", "in progress"), ("blank", "")):
+            agreement = ProjectAgreement.objects.create(program=self.program, project_name=name,
+                                                        office=new_office, sector=get_sector, approval=approval)
+            agreement.save()
+        get_agreement = ProjectAgreement.objects.get(project_name="approved")
+        new_complete = ProjectComplete.objects.create(program=self.program, project_name="approved",
+                                                      office=new_office, on_time=True, community_handover=1,
+                                                      project_agreement=get_agreement, approval="approved")
+        new_complete.save()
+
+    def test_approval_status_counts(self):
+        """Check every approval bucket is counted in one query"""
+        with self.assertNumQueries(1):
+            counts = approval_status_counts(
+                ProjectAgreement.objects.filter(program__id=self.program.id))
+        self.assertEqual(counts['total'], 4)
+        self.assertEqual(counts['approved'], 1)
+        self.assertEqual(counts['awaiting_approval'], 1)
+        self.assertEqual(counts['in_progress'], 1)
+        self.assertEqual(counts['no_status'], 1)
+        self.assertEqual(counts['open'], 1)
+        self.assertEqual(counts['rejected'], 0)
+
+    def test_approval_rollup(self):
+        """Check the country and program scopes return the same buckets"""
+        by_program = get_approval_rollup(program=self.program.id)
+        by_country = get_approval_rollup(countries=self.program.country.all())
+        self.assertEqual(by_program, by_country)
+        self.assertEqual(by_program['complete']['total'], 1)
+        self.assertEqual(by_program['complete']['approved'], 1)
+
+    def test_budget_rollup(self):
+        """Check the budget rollup is cached per program and cleared on save"""
+        cache.clear()
+        agreement = ProjectAgreement.objects.get(project_name="approved")
+        agreement.total_estimated_budget = 100
+        agreement.save()
+        complete = ProjectComplete.objects.get(project_agreement=agreement)
+        complete.actual_budget = 80
+        complete.save()
+
+        with self.assertNumQueries(1):
+            rollup = get_program_budget_rollup(self.program.id)
+        self.assertEqual((rollup['estimated'], rollup['actual'], rollup['variance']), (100, 80, 20))
+        self.assertEqual([row['agreement_id'] for row in rollup['agreements']], [agreement.id])
+        with self.assertNumQueries(0):
+            get_program_budget_rollup(self.program.id)
+
+        complete.actual_budget = 120
+        complete.save()
+        self.assertEqual(get_program_budget_rollup(self.program.id)['actual'], 120)
+        country = self.program.country.get()
+        by_country = get_country_budget_rollup([country.id])[country.id]
+        self.assertEqual((by_country['estimated'], by_country['actual'], by_country['count']), (100, 120, 1))
+        self.assertEqual(by_country['programs'], [self.program.id])
+
+        # moving the agreement or the complete clears the program it leaves
+        other_program = Program.objects.create(name="otherprogram", gaitid="2")
+        agreement = ProjectAgreement.objects.get(id=agreement.id)
+        agreement.program = other_program
+        agreement.save()
+        self.assertEqual(get_program_budget_rollup(self.program.id)['count'], 0)
+        self.assertEqual(get_program_budget_rollup(other_program.id)['count'], 1)
+        complete = ProjectComplete.objects.get(id=complete.id)
+        complete.project_agreement = ProjectAgreement.objects.get(project_name="awaiting")
+        complete.save()
+        self.assertEqual(get_program_budget_rollup(other_program.id)['count'], 0)
+        self.assertEqual(get_program_budget_rollup(self.program.id)['count'], 1)
+
+
+class CountryScopeTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        new_organization = Organization.objects.create(name="activity")
+        self.country = Country.objects.create(
+            country="testcountry", organization=new_organization)
+        self.other_country = Country.objects.create(
+            country="othercountry", organization=new_organization)
+        self.user = User.objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.activity_user = ActivityUser.objects.create(
+            name="john", user=self.user)
+        self.activity_user.countries.add(self.country)
+
+    def test_country_ids_cached(self):
+        """Check the country IDs are cached per request and per process"""
+        self.assertEqual(get_country_ids(self.user), [self.country.id])
+        with self.assertNumQueries(0):
+            get_country_ids(self.user)
+            get_country_ids(User(id=self.user.id))
+        self.assertEqual(list(get_country(self.user)), [self.country])
+
+    def test_country_ids_invalidated(self):
+        """Check changing the accessible countries clears the cache"""
+        get_country_ids(self.user)
+        self.activity_user.countries.add(self.other_country)
+        self.assertEqual(sorted(get_country_ids(User(id=self.user.id))),
+                         sorted([self.country.id, self.other_country.id]))
+        self.other_country.countries.clear()
+        self.assertEqual(get_country_ids(User(id=self.user.id)), [self.country.id])
+
+
+class JsonListResponseTestCase(TestCase):
+
+    def setUp(self):
+        new_organization = Organization.objects.create(name="activity")
+        for name in ("first", "second"):
+            Country.objects.create(country=name, organization=new_organization)
+        self.countries = Country.objects.order_by('id').values('id', 'country')
+
+    def test_legacy_shape(self):
+        """Check the lists are JSON strings without a version"""
+        request = RequestFactory().get('/')
+        response = json_lists_response(request, {'countries': self.countries}, {'count': 2})
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(json.loads(data['countries']), list(self.countries))
+        self.assertEqual(data['count'], 2)
+
+    def test_versioned_shape(self):
+        """Check ?v=2 streams the lists as arrays, gzipped when accepted"""
+        request = RequestFactory().get('/?v=2', HTTP_ACCEPT_ENCODING='gzip')
+        response = json_lists_response(request, {'countries': self.countries}, {'count': 2})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        content = gzip.decompress(b''.join(response.streaming_content))
+        data = json.loads(content.decode('utf-8'))
+        self.assertEqual(data['countries'], list(self.countries))
+        self.assertEqual(data['count'], 2)
+
+
+class LoggedUserTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+
+    def test_login_logout(self):
+        """Check a login records the user and its country from the local CIDR table"""
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as cidr_file:
+            cidr_file.write('network,country\n10.1.0.0/16,KE\n2001:db8::/32,ug\n')
+        try:
+            with mock.patch.object(geoip, 'country_ranges', geoip.CountryRanges(cidr_file.name)):
+                geoip.get_ip_country.cache_clear()
+                self.assertEqual(geoip.get_ip_country('10.1.2.3'), 'ke')
+                self.assertEqual(geoip.get_ip_country('2001:db8::1'), 'ug')
+                self.assertEqual(geoip.get_ip_country('10.2.0.1'), 'undefined')
+
+                request = RequestFactory().get('/', REMOTE_ADDR='10.1.2.3')
+                user_logged_in.send(sender=User, request=request, user=self.user)
+                user_logged_in.send(sender=User, request=HttpRequest(), user=self.user)
+        finally:
+            os.remove(cidr_file.name)
+            geoip.get_ip_country.cache_clear()
+
+        logged_user = LoggedUser.objects.get(username='john')
+        self.assertEqual((logged_user.country, logged_user.email), ('undefined', 'lennon@thebeatles.com'))
+        self.assertIsNotNone(logged_user.login_date)
+        user_logged_out.send(sender=User, request=HttpRequest(), user=self.user)
+        self.assertFalse(LoggedUser.objects.exists())
@@ -34,23 +34,23 @@ from django.db.models import Count
 from django.db.models import Q
 from .tables import ProjectAgreementTable
 from .filters import ProjectAgreementFilter
-import json
-import requests
 import logging
 
 from django.core import serializers
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.http import HttpResponse, HttpResponseRedirect
 from django.views.generic.detail import View
 
 from django.contrib.sites.shortcuts import get_current_site
 from django.utils.decorators import method_decorator
 from activity.util import get_country, email_group, group_excluded, group_required
+from activity.external import external_data
+from activity.export import export_csv_response
+from activity.responses import json_lists_response
 from .mixins import AjaxableResponseMixin
 from .export import ProjectAgreementResource, StakeholderResource, SiteProfileResource
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-from django.core.serializers.json import DjangoJSONEncoder
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
@@ -2420,11 +2420,7 @@ class Report(View, AjaxableResponseMixin):
                 Q(activity_code__contains=request.GET["search"]))
 
         if request.GET.get('export'):
-            dataset = ProjectAgreementResource().export(get_agreements)
-            response = HttpResponse(
-                dataset.csv, content_type='application/ms-excel')
-            response['Content-Disposition'] = 'attachment; filename=activity_report.csv'
-            return response
+            return export_csv_response(ProjectAgreementResource(), get_agreements, 'activity_report.csv')
 
         # send the keys and vars
         return render(request, "workflow/report.html",
@@ -2455,11 +2451,7 @@ class ReportData(View, AjaxableResponseMixin):
                     'account_code', 'lin_code', 'estimated_by__name', 'total_estimated_budget',
                     'mc_estimated_budget', 'total_estimated_budget')
 
-        get_agreements = json.dumps(list(get_agreements), cls=DjangoJSONEncoder)
-
-        final_dict = {'get_agreements': get_agreements}
-
-        return JsonResponse(final_dict, safe=False)
+        return json_lists_response(request, {'get_agreements': get_agreements})
 
 
 def country_json(request, country):
@@ -2496,18 +2488,15 @@ def import_service(service_id=1, deserialize=True):
     """
     Import a indicators from a web service (the dig only for now)
     """
-    service = ExternalService.objects.all().filter(id=service_id)
+    service = ExternalService.objects.get(id=service_id)
 
-    response = requests.get(service.feed_url)
-    get_json = json.loads(response.content)
+    response = external_data.get(service.feed_url)
 
     if deserialize:
-        data = json.load(get_json)  # deserialises it
+        data = response.json()  # deserialises it
     else:
         # send json data back not deserialized data
-        data = get_json
-    # debug the json data string uncomment dump and print
-    data2 = json.dumps(data)  # json formatted string
+        data = response.content
 
     return data
 
@@ -2525,18 +2514,16 @@ def export_stakeholders_list(request, **kwargs):
     program_id = int(kwargs['program_id'])
     countries = get_country(request.user)
 
+    get_stakeholders = Stakeholder.objects.select_related(
+        'type', 'country', 'approved_by', 'filled_by', 'formal_relationship_document', 'vetting_document')\
+        .prefetch_related('contact', 'sectors')
     if program_id != 0:
-        get_stakeholders = Stakeholder.objects.prefetch_related('sector').filter(
+        get_stakeholders = get_stakeholders.filter(
             projectagreement__program__id=program_id).distinct()
     else:
-        get_stakeholders = Stakeholder.objects.prefetch_related(
-            'sector').filter(country__in=countries)
+        get_stakeholders = get_stakeholders.filter(country__in=countries)
 
-    dataset = StakeholderResource().export(get_stakeholders)
-    response = HttpResponse(dataset.csv, content_type='application/ms-excel')
-    response['Content-Disposition'] = 'attachment; filename=stakeholders.csv'
-
-    return response
+    return export_csv_response(StakeholderResource(), get_stakeholders, 'stakeholders.csv')
 
 
 def export_sites_list(request, **kwargs):
@@ -2547,14 +2534,10 @@ def export_sites_list(request, **kwargs):
     # if program_id != 0:
     #    get_sites = Sites.objects.prefetch_related('sector').filter(projectagreement__program__id=program_id).distinct()
     # else:
-    get_sites = SiteProfile.objects.prefetch_related(
-        'sector').filter(country__in=countries)
-
-    dataset = SiteProfileResource().export(get_sites)
-    response = HttpResponse(dataset.csv, content_type='application/ms-excel')
-    response['Content-Disposition'] = 'attachment; filename=sites.csv'
+    get_sites = SiteProfile.objects.select_related(
+        'type', 'country', 'filled_by').filter(country__in=countries)
 
-    return response
+    return export_csv_response(SiteProfileResource(), get_sites, 'sites.csv')
 
 
 def save_bookmark(request):
@@ -2589,8 +2572,6 @@ class StakeholderObjects(View, AjaxableResponseMixin):
 
         countries = get_country(request.user)
 
-        countries = get_country(request.user)
-
         if program_id != 0:
             get_stakeholders = Stakeholder.objects.all().filter(projectagreement__program__id=program_id).distinct(
             ).values('id', 'create_date', 'type__name', 'name', 'sectors__sector')
@@ -2603,12 +2584,7 @@ class StakeholderObjects(View, AjaxableResponseMixin):
             get_stakeholders = Stakeholder.objects.all().filter(country__in=countries).values(
                 'id', 'create_date', 'type__name', 'name', 'sectors__sector')
 
-        get_stakeholders = json.dumps(
-            list(get_stakeholders), cls=DjangoJSONEncoder)
-
-        final_dict = {'get_stakeholders': get_stakeholders}
-
-        return JsonResponse(final_dict, safe=False)
+        return json_lists_response(request, {'get_stakeholders': get_stakeholders})
 
 
 class SiteProfileObjects(View, AjaxableResponseMixin):
@@ -2629,8 +2605,6 @@ class SiteProfileObjects(View, AjaxableResponseMixin):
 
         countries = get_country(request.user)
 
-        countries = get_country(request.user)
-
         if program_id != 0:
             get_sites = SiteProfile.objects.all().filter(
                 projectagreement__program__id=program_id).distinct().values('id')
@@ -2642,11 +2616,7 @@ class SiteProfileObjects(View, AjaxableResponseMixin):
         else:
             get_sites = SiteProfile.objects.all().filter(country__in=countries).values('id')
 
-        get_sites = json.dumps(list(get_sites), cls=DjangoJSONEncoder)
-
-        final_dict = {'get_sites': get_sites}
-
-        return JsonResponse(final_dict, safe=False)
+        return json_lists_response(request, {'get_sites': get_sites})
 
 
 class DocumentationListObjects(View, AjaxableResponseMixin):
@@ -2669,8 +2639,4 @@ class DocumentationListObjects(View, AjaxableResponseMixin):
             get_documentation = Documentation.objects.all().prefetch_related('program', 'project', 'project__office')\
                 .filter(program__country__in=countries).values('id', 'name', 'project__project_name', 'create_date')
 
-        get_documentation = json.dumps(
-            list(get_documentation), cls=DjangoJSONEncoder)
-        final_dict = {'get_documentation': get_documentation}
-
-        return JsonResponse(final_dict, safe=False)
+        return json_lists_response(request, {'get_documentation': get_documentation})